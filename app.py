@@ -1,128 +1,2915 @@
 import os
+# With SERVER_MODE=gevent requests are served on greenlets rather than
+# threads (see serve).  The standard library is patched before anything
+# else is imported so PyMongo's socket reads yield to other requests
+# instead of blocking the process.
+if os.environ.get("SERVER_MODE") == "gevent":
+    from gevent import monkey
+    monkey.patch_all()
+import io
 import re
+import sys
+import csv
+import gzip
 import bson
-from datetime import datetime
+import json
+import math
+import random
+import codecs
+import mimetypes
+import base64
+import hmac
+import time
+import shutil
+import zlib
+import hashlib
+import secrets
+import posixpath
+import subprocess
+import click
+import threading
+import urllib.error
+import urllib.parse
+import urllib.request
+from collections import OrderedDict, namedtuple
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from datetime import datetime, timedelta
 from flask import (
-    Flask, flash, render_template,
-    redirect, request, session, url_for)
+    Flask, Response, abort, flash, g, has_request_context, jsonify,
+    make_response, redirect, request, send_from_directory, session,
+    stream_with_context, url_for)
+from markupsafe import escape
+from flask import render_template as flask_render_template
+from flask.sessions import (
+    SecureCookieSession, SecureCookieSessionInterface, SessionInterface,
+    session_json_serializer)
 from flask_pymongo import PyMongo
+from pymongo import (
+    ASCENDING, DESCENDING, TEXT, ReadPreference, ReturnDocument, UpdateOne,
+    monitoring)
+from pymongo.collation import Collation
+from pymongo.errors import (
+    BulkWriteError, DuplicateKeyError, ExecutionTimeout, OperationFailure)
+from bson import json_util
 from bson.objectid import ObjectId
+from werkzeug.datastructures import ImmutableMultiDict
+from werkzeug.test import EnvironBuilder
 from werkzeug.security import generate_password_hash, check_password_hash
+try:
+    import mongomock
+except ImportError:
+    # mongomock is only needed by the tests and benchmark commands.
+    mongomock = None
+try:
+    from PIL import Image
+except ImportError:
+    # Without Pillow "flask build-assets" only fingerprints and
+    # compresses the images, it doesn't make resized or WebP copies.
+    Image = None
+try:
+    import brotli
+except ImportError:
+    # Without brotli only gzip copies of the assets are built.
+    brotli = None
 if os.path.exists("env.py"):
     import env
 
 
+# Validation patterns.
+# These are compiled once when the app starts rather than
+# being looked up every time a validator is called.
+EMAIL_PATTERN = re.compile(r"^[a-z0-9]+[\._]?[a-z0-9]+[@]\w+[.]\w{2,3}$")
+NAME_PATTERN = re.compile(r"^[a-zA-Z-]{0,30}$")
+PW_PATTERN = re.compile(r"^.{6,15}$")
+METER_ID_PATTERN = re.compile(r"^[0-9]{13}$")
+MSN_PATTERN = re.compile(r"^[a-zA-Z0-9]{0,12}$")
+ADDRESS_PATTERN = re.compile(r"^[a-zA-Z0-9 ]{0,50}$")
+POSTCODE_PATTERN = re.compile(r"^[a-zA-Z0-9 ]{6,8}$")
+TEXT_PATTERN = re.compile(r"[a-zA-Z ]+$")
+ALPHANUMERIC_PATTERN = re.compile(r"[a-zA-Z0-9 .]+$")
+SUPPLIER_PATTERN = re.compile(r"^[a-zA-Z0-9 ]{0,30}$")
+ACCOUNT_PATTERN = re.compile(r"^[a-zA-Z0-9 /-]{0,20}$")
+METER_READ_PATTERN = re.compile(r"^[0-9]{0,8}$")
+DATE_PATTERN = re.compile(r"^[0-9/]{10}$")
+POSTCODE_AREA_PATTERN = re.compile(r"^[a-zA-Z]{1,2}")
+# Normalized like a bookings postcode, so any postcode
+# POSTCODE_PATTERN accepts can be searched for.
+POSTCODE_PREFIX_PATTERN = re.compile(r"^[A-Z0-9]{2,8}$")
+METER_ID_PREFIX_PATTERN = re.compile(r"^[0-9]{4,13}$")
+
+
 # Validation functions
 def validate_email(email):
     # Check whether a string matches the email regex.
     # Regex solution sourced from here:
     # https://www.geeksforgeeks.org/check-if-email-address-valid-or-not-in-python/
-    return re.search("^[a-z0-9]+[\._]?[a-z0-9]+[@]\w+[.]\w{2,3}$", email)
+    return EMAIL_PATTERN.search(email)
+
+
+def validate_id(id):
+    # Validate if id is in right format for MongoDB object.
+    # Solution from:
+    # https://stackoverflow.com/questions/28774526/how-to-check-that-mongo-objectid-is-valid-in-python
+    return bson.objectid.ObjectId.is_valid(id)
+
+
+def validate_name(name):
+    # Validates users first & last names.
+    # Only allow letters and hyphens.  No spaces.
+    return NAME_PATTERN.match(name)
+
+
+def validate_pw(pw):
+    # Validate users passwords.
+    # Allow any characters, length 6-15 characters only.
+    return PW_PATTERN.match(pw)
+
+
+def validate_meter_id(id):
+    # Validation meter id.
+    # Allow only numbers, no spaces, must be length of 13 characters.
+    return METER_ID_PATTERN.match(id)
+
+
+def validate_MSN(msn):
+    # Validate meter serial number.
+    # Allow only number and letters, no spaces, length 0-12 characters.
+    return MSN_PATTERN.match(msn)
+
+
+def validate_address(address):
+    # Validate address lines (1st, 2nd & 3rd)
+    # Allow only numbers, letters and spaces, max length 50 characters.
+    return ADDRESS_PATTERN.match(address)
+
+
+def validate_postcode(postcode):
+    # Validate postcodes.
+    # Allow only numbers, letters and spaces, length 6-8 characters.
+    return POSTCODE_PATTERN.match(postcode)
+
+
+def validate_text(text):
+    # Validate text inputs.
+    # Allow only letters and spaces.
+    return TEXT_PATTERN.match(text)
+
+
+def validate_alphanumeric(text):
+    # Validate text inputs.
+    # Allow only numbers, letters, spaces and full stops.
+    return ALPHANUMERIC_PATTERN.match(text)
+
+
+def validate_yes_no(text):
+    # Validate that the input is eiter yes or no.
+    return text == "yes" or text == "no"
+
+
+def validate_property_type(text):
+    # Validate that the input is eiter residential or commercial.
+    return text == "residential" or text == "commercial"
+
+
+def validate_supplier(text):
+    # Validate supplier input.
+    # Allow only numbers, letters and spaces, max length 30 characters.
+    return SUPPLIER_PATTERN.match(text)
+
+
+def validate_account(text):
+    # Validate supplier account number input.
+    # Account numbers may have letters and forward slashes.
+    # Allow only numbers, letters, spaces and
+    # forward slashes, max length 20 characters.
+    return ACCOUNT_PATTERN.match(text)
+
+
+def validate_meter_read(read):
+    # Validate meter read inputs.
+    # Allow only numbers, length 0-8 characters.
+    return METER_READ_PATTERN.match(read)
+
+
+def validate_date(date):
+    # Validate date inputs.
+    # Allow only numbers and for slashes, must be length of 8 characters.
+    return DATE_PATTERN.match(date)
+
+
+def validate_authorisation(text):
+    # Validate that the supplier authorisation checkbox is ticked.
+    return text == "on"
+
+
+# Conversion functions used by the booking schema.
+def normalize_postcode(postcode):
+    # Postcodes are searched upper case and without spaces,
+    # so "ls1 4ap" and "LS14AP" are the same postcode.
+    return postcode.upper().replace(" ", "")
+
+
+def to_date(date):
+    # Convert a dd/mm/yyyy date into a datetime.
+    return datetime.strptime(date, "%d/%m/%Y")
+
+
+def to_meter_read(read):
+    # Meter reads are stored as integers, or None if not provided.
+    return int(read) if read else None
+
+
+def to_authorised(text):
+    # Store the supplier authorisation as a boolean.
+    return text == "on"
+
+
+# A form field in a validation schema: the validator to run, whether
+# the field must be filled in, how to convert the value for storage
+# and the message to flash if the value is invalid.
+Field = namedtuple(
+    "Field", ["name", "validator", "required", "coerce", "message"])
+
+# The booking form, in the order the fields appear on the form.
+# book(), update_booking() and bulk booking all validate against this.
+BOOKING_SCHEMA = [
+    Field("meter_id", validate_meter_id, True, int,
+          "Invalid meter ID provided"),
+    Field("meter_serial_number", validate_MSN, False, str,
+          "Invalid meter serial number provided"),
+    Field("first_address_line", validate_address, True, str,
+          "Invalid address provided"),
+    Field("second_address_line", validate_address, False, str,
+          "Invalid address provided"),
+    Field("third_address_line", validate_address, False, str,
+          "Invalid address provided"),
+    Field("town", validate_text, True, str,
+          "Invalid town/city provided"),
+    Field("county", validate_text, True, str,
+          "Invalid county provided"),
+    Field("postcode", validate_postcode, True, str,
+          "Invalid postcode provided"),
+    Field("meter_location", validate_alphanumeric, True, str,
+          "Invalid meter location provided"),
+    Field("access_instructions", validate_alphanumeric, False, str,
+          "Invalid access instructions provided"),
+    Field("parking_on_site", validate_yes_no, True, str,
+          "Please indicate if parking is available on site"),
+    Field("property_type", validate_property_type, True, str,
+          "Please indicate the property type"),
+    Field("supplier", validate_supplier, True, str,
+          "Invalid supplier provided"),
+    Field("supplier_acc_no", validate_account, False, str,
+          "Invalid supplier account number provided"),
+    Field("meter_read_reg_1", validate_meter_read, False, to_meter_read,
+          "Invalid meter read provided"),
+    Field("meter_read_reg_2", validate_meter_read, False, to_meter_read,
+          "Invalid meter read provided"),
+    Field("install_date", validate_date, True, to_date,
+          "Invalid installation date provided"),
+    Field("supplier_authorisation", validate_authorisation, True,
+          to_authorised, "Please tick the supplier "
+          "authorisation at the bottom of the form"),
+]
+
+# Booking form fields.  Bulk booking CSV files use
+# the same names for their columns.
+BOOKING_FIELDS = [field.name for field in BOOKING_SCHEMA]
+
+
+def validate_form(schema, form):
+    # Validate and convert a whole form against a schema in one pass,
+    # reading each field from the form only once.
+    # Returns the converted values and a list of every error found.
+    data = {}
+    errors = []
+    for field in schema:
+        value = form.get(field.name) or ""
+        # Optional fields that are left empty aren't validated.
+        if value == "" and not field.required:
+            data[field.name] = field.coerce(value)
+            continue
+        if value == "" or not field.validator(value):
+            errors.append(field.message)
+            continue
+        try:
+            data[field.name] = field.coerce(value)
+        except ValueError:
+            # e.g. a date that matches the pattern but doesn't exist.
+            errors.append(field.message)
+    # The same message can come up for more than one field.
+    return data, list(dict.fromkeys(errors))
+
+
+def csv_lines(rows):
+    # Format report rows as CSV text.
+    buffer = io.StringIO()
+    csv.writer(buffer).writerows(rows)
+    return buffer.getvalue()
+
+
+def book_chunk(chunk, email):
+    # Validate and insert one chunk of bulk booking rows.
+    # chunk is a list of (row number, row) tuples.
+    # Returns a report row for each CSV row: (row number, meter ID,
+    # status, message).
+    report = {}
+    bookings = []
+    for number, row in chunk:
+        booking, errors = validate_form(BOOKING_SCHEMA, row)
+        if errors:
+            report[number] = (number, row["meter_id"], "error",
+                              "; ".join(errors))
+        else:
+            booking["user_email_address"] = email
+            booking["application_date"] = datetime.now()
+            booking["postcode_normalized"] = normalize_postcode(
+                booking["postcode"])
+            booking["version"] = 1
+            bookings.append((number, booking))
+    # Find which of the meter IDs in the chunk are
+    # already booked with a single $in query.
+    booked = set(doc["meter_id"] for doc in mongo.db.meter_installs.find(
+        {"meter_id": {"$in": [booking["meter_id"]
+                              for _, booking in bookings]}},
+        {"_id": 0, "meter_id": 1}))
+    unbooked = []
+    for number, booking in bookings:
+        if booking["meter_id"] in booked:
+            report[number] = (number, booking["meter_id"], "error",
+                              "Meter ID already booked")
+        else:
+            # Also catches the same meter ID twice in one chunk.
+            booked.add(booking["meter_id"])
+            unbooked.append((number, booking))
+    # Take the install date places for the whole chunk together.
+    inserts = []
+    reserved = reserve_many_slots(
+        [booking_slots(booking) for _, booking in unbooked])
+    for (number, booking), has_places in zip(unbooked, reserved):
+        if has_places:
+            inserts.append((number, booking))
+            report[number] = (number, booking["meter_id"], "booked", "")
+        else:
+            report[number] = (number, booking["meter_id"], "error",
+                              "Install date fully booked")
+    if inserts:
+        # Unordered so one failing row doesn't stop the rest.
+        # Anything booked since the $in query is rejected by
+        # the unique index on meter_id.
+        try:
+            mongo.db.meter_installs.insert_many(
+                [booking for _, booking in inserts], ordered=False)
+        except BulkWriteError as e:
+            for error in e.details["writeErrors"]:
+                number, booking = inserts[error["index"]]
+                report[number] = (
+                    number, booking["meter_id"], "error",
+                    "Meter ID already booked" if error["code"] == 11000
+                    else error["errmsg"])
+        except Exception:
+            release_slots([slot for _, booking in inserts
+                           for slot in booking_slots(booking)])
+            raise
+        release_slots([slot for number, booking in inserts
+                       if report[number][2] != "booked"
+                       for slot in booking_slots(booking)])
+        for number, booking in inserts:
+            if report[number][2] == "booked":
+                note_meter_booked(booking["meter_id"])
+        record_booking_stats(added=[
+            booking for number, booking in inserts
+            if report[number][2] == "booked"])
+    return [report[number] for number, _ in chunk]
+
+
+def bulk_booking_report(upload, email):
+    # Stream a bulk booking CSV file through book_chunk a chunk at a
+    # time, yielding the CSV report as it goes.  Only one chunk of rows
+    # is ever held in memory, however big the file is.
+    rows = csv.DictReader(codecs.iterdecode(upload, "utf-8-sig"))
+    yield csv_lines([("row", "meter_id", "status", "message")])
+    chunk = []
+    # Row 1 of the file is the header.
+    for number, row in enumerate(rows, start=2):
+        chunk.append((number, {
+            field: (row.get(field) or "").strip()
+            for field in BOOKING_FIELDS}))
+        if len(chunk) == app.config["BULK_CHUNK_SIZE"]:
+            yield csv_lines(book_chunk(chunk, email))
+            chunk = []
+    if chunk:
+        yield csv_lines(book_chunk(chunk, email))
+
+
+app = Flask(__name__)
+
+app.config["MONGO_DBNAME"] = os.environ.get("MONGO_DBNAME")
+app.config["MONGO_URI"] = os.environ.get("MONGO_URI")
+app.secret_key = os.environ.get("SECRET_KEY")
+# Number of CSV rows validated and inserted together by bulk booking.
+app.config["BULK_CHUNK_SIZE"] = int(
+    os.environ.get("BULK_CHUNK_SIZE", 1000))
+# Number of bookings listed per page on the Account page.
+app.config["ACCOUNT_PAGE_SIZE"] = int(
+    os.environ.get("ACCOUNT_PAGE_SIZE", 20))
+# Number of user profiles cached per process and for how many seconds.
+# A change only drops the profile from the cache of the process that
+# made it, so other processes can show the old names (or a deleted
+# account's profile) for up to USER_CACHE_TTL seconds.  Profiles are
+# only displayed; sign in, permissions and session revocation never
+# read them.
+app.config["USER_CACHE_SIZE"] = int(os.environ.get("USER_CACHE_SIZE", 1024))
+app.config["USER_CACHE_TTL"] = float(os.environ.get("USER_CACHE_TTL", 60))
+# Where session data is kept.  "cookie" keeps it in Flask's signed
+# session cookie.  "memory" (for a single web process) and "mongo" (for
+# several) keep it on the server and the cookie only holds a session ID.
+# Server-side sessions expire after SESSION_IDLE_SECONDS without a
+# request, and the memory store keeps at most SESSION_MEMORY_SIZE.
+app.config["SESSION_STORE"] = os.environ.get("SESSION_STORE", "cookie")
+app.config["SESSION_IDLE_SECONDS"] = float(
+    os.environ.get("SESSION_IDLE_SECONDS", 7200))
+app.config["SESSION_MEMORY_SIZE"] = int(
+    os.environ.get("SESSION_MEMORY_SIZE", 10000))
+# Password hashing policy.  Changing the method or iterations upgrades
+# each users stored hash the next time they sign in.
+app.config["PASSWORD_HASH_METHOD"] = os.environ.get(
+    "PASSWORD_HASH_METHOD", "pbkdf2:sha256")
+app.config["PASSWORD_HASH_ITERATIONS"] = int(
+    os.environ.get("PASSWORD_HASH_ITERATIONS", 150000))
+app.config["PASSWORD_SALT_LENGTH"] = int(
+    os.environ.get("PASSWORD_SALT_LENGTH", 8))
+# Password hashing runs in a pool of worker processes so it doesn't pin
+# request threads.  At most HASH_POOL_MAX_QUEUE hashes can be queued or
+# running per process, beyond that requests fail fast.
+# Set HASH_POOL_WORKERS to 0 to hash on the request thread instead.
+app.config["HASH_POOL_WORKERS"] = int(
+    os.environ.get("HASH_POOL_WORKERS", os.cpu_count() or 1))
+app.config["HASH_POOL_MAX_QUEUE"] = int(
+    os.environ.get("HASH_POOL_MAX_QUEUE",
+                   4 * app.config["HASH_POOL_WORKERS"] or 1))
+# Run multi-document writes in transactions.  This needs a replica set
+# (which MongoDB Atlas always is), so it can be switched off for a
+# standalone mongod.
+app.config["MONGO_TRANSACTIONS"] = os.environ.get(
+    "MONGO_TRANSACTIONS", "on") == "on"
+# Deleted accounts have their bookings purged in the background, in
+# batches of PURGE_BATCH_SIZE with a PURGE_BATCH_PAUSE second pause
+# between batches.  Each web process runs a purge worker thread unless
+# PURGE_WORKER_THREAD is off (e.g. when "flask purge-worker" runs as a
+# separate process instead).
+app.config["PURGE_BATCH_SIZE"] = int(
+    os.environ.get("PURGE_BATCH_SIZE", 500))
+app.config["PURGE_BATCH_PAUSE"] = float(
+    os.environ.get("PURGE_BATCH_PAUSE", 0.1))
+app.config["PURGE_POLL_SECONDS"] = float(
+    os.environ.get("PURGE_POLL_SECONDS", 5))
+app.config["PURGE_LEASE_SECONDS"] = float(
+    os.environ.get("PURGE_LEASE_SECONDS", 60))
+app.config["PURGE_WORKER_THREAD"] = os.environ.get(
+    "PURGE_WORKER_THREAD", "on") == "on"
+# Record per route timings, Mongo round trips and template render times
+# for /metrics and the Server-Timing header.
+app.config["INSTRUMENTATION"] = os.environ.get(
+    "INSTRUMENTATION", "on") == "on"
+# Pages that don't depend on the user (home and page not found) are
+# rendered once and cached, see render_cached_page.
+app.config["PAGE_CACHE"] = os.environ.get("PAGE_CACHE", "on") == "on"
+# MongoDB connection pool.  Each web process has one pool of at most
+# MONGO_MAX_POOL_SIZE connections, keeping MONGO_MIN_POOL_SIZE open even
+# when idle.  A request waits up to MONGO_WAIT_QUEUE_TIMEOUT_MS for a
+# free connection (for ever if it isn't set) and up to
+# MONGO_SERVER_SELECTION_TIMEOUT_MS for a server it can use.
+app.config["MONGO_MAX_POOL_SIZE"] = int(
+    os.environ.get("MONGO_MAX_POOL_SIZE", 100))
+app.config["MONGO_MIN_POOL_SIZE"] = int(
+    os.environ.get("MONGO_MIN_POOL_SIZE", 0))
+app.config["MONGO_WAIT_QUEUE_TIMEOUT_MS"] = os.environ.get(
+    "MONGO_WAIT_QUEUE_TIMEOUT_MS")
+app.config["MONGO_SERVER_SELECTION_TIMEOUT_MS"] = int(
+    os.environ.get("MONGO_SERVER_SELECTION_TIMEOUT_MS", 30000))
+# Let the read-only routes (SECONDARY_READ_ROUTES) read from
+# secondaries when one is available.  The reads are causally consistent
+# with the users own writes, see read_session.
+app.config["MONGO_SECONDARY_READS"] = os.environ.get(
+    "MONGO_SECONDARY_READS", "on") == "on"
+# How "python app.py" serves requests: "threaded" runs Flask's server
+# with a thread per request, "gevent" runs a gevent WSGI server with a
+# greenlet per request.  gevent lets one process (and its one Mongo
+# connection pool) wait on many Mongo round trips at once.
+app.config["SERVER_MODE"] = os.environ.get("SERVER_MODE", "threaded")
+# The meter ID availability check answers from a Bloom filter of the
+# booked meter IDs, sized for METER_FILTER_CAPACITY IDs with a
+# METER_FILTER_ERROR_RATE chance of a false "maybe booked" (which is
+# then checked in Mongo).  Each process rebuilds its filter every
+# METER_FILTER_REBUILD_SECONDS, and in between picks up the meter IDs
+# other processes have booked every METER_FILTER_SYNC_SECONDS, so an
+# "available" answer can be that many seconds out of date.
+app.config["METER_FILTER"] = os.environ.get("METER_FILTER", "on") == "on"
+app.config["METER_FILTER_CAPACITY"] = int(
+    os.environ.get("METER_FILTER_CAPACITY", 1000000))
+app.config["METER_FILTER_ERROR_RATE"] = float(
+    os.environ.get("METER_FILTER_ERROR_RATE", 0.01))
+app.config["METER_FILTER_REBUILD_SECONDS"] = float(
+    os.environ.get("METER_FILTER_REBUILD_SECONDS", 300))
+app.config["METER_FILTER_SYNC_SECONDS"] = float(
+    os.environ.get("METER_FILTER_SYNC_SECONDS", 2))
+# Most installs that can be booked on one day, in all and in any one
+# postcode area (the letters at the start of the postcode).  The
+# availability calendar is cached for CAPACITY_CACHE_TTL seconds.
+app.config["CAPACITY_PER_DAY"] = int(
+    os.environ.get("CAPACITY_PER_DAY", 500))
+app.config["CAPACITY_PER_AREA"] = int(
+    os.environ.get("CAPACITY_PER_AREA", 50))
+app.config["CAPACITY_CACHE_TTL"] = float(
+    os.environ.get("CAPACITY_CACHE_TTL", 30))
+# Email addresses (comma separated) of the operators who may use the
+# admin booking search.  Each search query is stopped by the server
+# after SEARCH_MAX_TIME_MS.
+app.config["ADMIN_EMAILS"] = {
+    email.strip().lower() for email in os.environ.get(
+        "ADMIN_EMAILS", "").split(",") if email.strip()}
+app.config["SEARCH_PAGE_SIZE"] = int(os.environ.get("SEARCH_PAGE_SIZE", 25))
+app.config["SEARCH_MAX_TIME_MS"] = int(
+    os.environ.get("SEARCH_MAX_TIME_MS", 200))
+# Bookings read and written out together by the supplier export, and
+# the gzip level it compresses with (low, to spend the time on the
+# network rather than the CPU).
+app.config["EXPORT_BATCH_SIZE"] = int(
+    os.environ.get("EXPORT_BATCH_SIZE", 1000))
+app.config["EXPORT_GZIP_LEVEL"] = int(os.environ.get("EXPORT_GZIP_LEVEL", 1))
+# Token required to reach the internal endpoints.
+# If it isn't set the internal endpoints aren't served at all.
+app.config["INTERNAL_TOKEN"] = os.environ.get("INTERNAL_TOKEN")
+# "flask build-assets" writes the minified, fingerprinted and compressed
+# static files to ASSET_DIR.  Images are also resized to each of the
+# ASSET_IMAGE_WIDTHS that is narrower than the original, and images
+# wider than the widest of them are scaled down to it.
+app.config["ASSET_DIR"] = os.environ.get(
+    "ASSET_DIR", os.path.join(app.static_folder, "dist"))
+app.config["ASSET_IMAGE_WIDTHS"] = [int(width) for width in os.environ.get(
+    "ASSET_IMAGE_WIDTHS", "480,960,1920").split(",")]
+
+
+# Instrumentation.
+# Upper bounds (in seconds) of the latency histogram buckets.
+LATENCY_BUCKETS = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10]
+
+metrics_lock = threading.Lock()
+# Each histogram value is [bucket counts..., count, total seconds].
+request_metrics = {}
+template_metrics = {}
+# Mongo commands by (endpoint, command name): [count, total seconds].
+mongo_metrics = {}
+# Responses by (endpoint, status code).
+response_metrics = {}
+
+
+def observe(histograms, key, seconds):
+    # Add one observation to a latency histogram.
+    # Called with metrics_lock held.
+    histogram = histograms.get(key)
+    if histogram is None:
+        histogram = histograms[key] = [0] * (len(LATENCY_BUCKETS) + 1) + [
+            0.0]
+    for index, bound in enumerate(LATENCY_BUCKETS):
+        if seconds <= bound:
+            histogram[index] += 1
+    histogram[-2] += 1
+    histogram[-1] += seconds
+
+
+def current_endpoint():
+    # The route being served, or "background" outside of a request.
+    if has_request_context():
+        return request.endpoint or "unknown"
+    return "background"
+
+
+class MongoCommandTimer(monitoring.CommandListener):
+    # PyMongo command listener recording every round trip against the
+    # route that made it.  Listeners are called on the thread that ran
+    # the command, so the request context is the one that issued it.
+
+    def started(self, event):
+        pass
+
+    def succeeded(self, event):
+        self.record(event)
+
+    def failed(self, event):
+        self.record(event)
+
+    def record(self, event):
+        seconds = event.duration_micros / 1000000.0
+        endpoint = current_endpoint()
+        with metrics_lock:
+            totals = mongo_metrics.setdefault(
+                (endpoint, event.command_name), [0, 0.0])
+            totals[0] += 1
+            totals[1] += seconds
+        if has_request_context() and "mongo_seconds" in g:
+            g.mongo_ops += 1
+            g.mongo_seconds += seconds
+
+
+def render_template(template_name, **context):
+    # Flask's render_template, timed per template.
+    if not app.config["INSTRUMENTATION"]:
+        return flask_render_template(template_name, **context)
+    start = time.perf_counter()
+    try:
+        return flask_render_template(template_name, **context)
+    finally:
+        seconds = time.perf_counter() - start
+        with metrics_lock:
+            observe(template_metrics, template_name, seconds)
+        if has_request_context() and "template_seconds" in g:
+            g.template_seconds += seconds
+
+
+@app.before_request
+def start_request_timer():
+    if app.config["INSTRUMENTATION"]:
+        g.request_start = time.perf_counter()
+        g.mongo_ops = 0
+        g.mongo_seconds = 0.0
+        g.template_seconds = 0.0
+
+
+@app.after_request
+def record_request_timer(response):
+    # Record the route timings and report them to the browser
+    # in a Server-Timing header.
+    if "request_start" not in g:
+        return response
+    seconds = time.perf_counter() - g.request_start
+    endpoint = request.endpoint or "unknown"
+    with metrics_lock:
+        observe(request_metrics, endpoint, seconds)
+        key = (endpoint, response.status_code)
+        response_metrics[key] = response_metrics.get(key, 0) + 1
+    response.headers["Server-Timing"] = (
+        'app;dur={:.1f}, mongo;dur={:.1f};desc="{} ops", '
+        'tpl;dur={:.1f}'.format(
+            seconds * 1000, g.mongo_seconds * 1000, g.mongo_ops,
+            g.template_seconds * 1000))
+    return response
+
+
+def prometheus_label(value):
+    # Escape a Prometheus label value.
+    return str(value).replace("\\", "\\\\").replace(
+        '"', '\\"').replace("\n", "\\n")
+
+
+def prometheus_histogram(name, label, histograms):
+    # Prometheus text lines for a set of latency histograms.
+    lines = ["# TYPE {} histogram".format(name)]
+    for key, histogram in sorted(histograms.items()):
+        labels = '{}="{}"'.format(label, prometheus_label(key))
+        for bound, count in zip(LATENCY_BUCKETS, histogram):
+            lines.append('{}_bucket{{{},le="{}"}} {}'.format(
+                name, labels, bound, count))
+        lines.append('{}_bucket{{{},le="+Inf"}} {}'.format(
+            name, labels, histogram[-2]))
+        lines.append("{}_count{{{}}} {}".format(name, labels, histogram[-2]))
+        lines.append("{}_sum{{{}}} {}".format(name, labels, histogram[-1]))
+    return lines
+
+
+def prometheus_metrics():
+    # Everything recorded so far, plus the STATS_SOURCES
+    # counters, in Prometheus text format.
+    with metrics_lock:
+        lines = prometheus_histogram(
+            "ww_request_seconds", "endpoint", request_metrics)
+        lines += prometheus_histogram(
+            "ww_template_render_seconds", "template", template_metrics)
+        lines.append("# TYPE ww_responses_total counter")
+        for (endpoint, status), count in sorted(response_metrics.items()):
+            lines.append(
+                'ww_responses_total{{endpoint="{}",status="{}"}} {}'.format(
+                    prometheus_label(endpoint), status, count))
+        for name, field in [("ww_mongo_commands_total", 0),
+                            ("ww_mongo_command_seconds_total", 1)]:
+            lines.append("# TYPE {} counter".format(name))
+            for (endpoint, command), totals in sorted(mongo_metrics.items()):
+                lines.append('{}{{endpoint="{}",command="{}"}} {}'.format(
+                    name, prometheus_label(endpoint),
+                    prometheus_label(command), totals[field]))
+    for source, report in sorted(STATS_SOURCES.items()):
+        for key, value in sorted(report().items()):
+            name = "ww_{}_{}".format(source, key)
+            lines.append("# TYPE {} gauge".format(name))
+            lines.append("{} {}".format(name, float(value)))
+    return "\n".join(lines) + "\n"
+
+
+class PoolMonitor(monitoring.ConnectionPoolListener):
+    # PyMongo connection pool listener counting connections, checkouts
+    # and how long each checkout waited for a free connection.
+    # Checkout events are called on the thread doing the checkout.
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.stats = {
+            "open": 0,
+            "in_use": 0,
+            "checkouts": 0,
+            "checkout_failures": 0,
+            "wait_seconds": 0.0,
+            "max_wait_seconds": 0.0,
+            "pool_clears": 0
+        }
+
+    def count(self, name, amount=1):
+        with self.lock:
+            self.stats[name] += amount
+
+    def connection_check_out_started(self, event):
+        self.local.start = time.perf_counter()
+
+    def connection_checked_out(self, event):
+        wait = time.perf_counter() - self.local.start
+        with self.lock:
+            self.stats["checkouts"] += 1
+            self.stats["in_use"] += 1
+            self.stats["wait_seconds"] += wait
+            self.stats["max_wait_seconds"] = max(
+                self.stats["max_wait_seconds"], wait)
+
+    def connection_check_out_failed(self, event):
+        self.count("checkout_failures")
+
+    def connection_checked_in(self, event):
+        self.count("in_use", -1)
+
+    def connection_created(self, event):
+        self.count("open")
+
+    def connection_closed(self, event):
+        self.count("open", -1)
+
+    def pool_cleared(self, event):
+        self.count("pool_clears")
+
+    def connection_ready(self, event):
+        pass
+
+    def pool_created(self, event):
+        pass
+
+    def pool_closed(self, event):
+        pass
+
+    def report(self):
+        with self.lock:
+            return dict(self.stats)
+
+
+class TopologyMonitor(monitoring.TopologyListener):
+    # Keeps the drivers latest view of the deployment (which it updates
+    # from its own heartbeats), so /healthz can tell whether a primary
+    # is reachable without sending a query.
+    description = None
+
+    def opened(self, event):
+        pass
+
+    def description_changed(self, event):
+        self.description = event.new_description
+
+    def closed(self, event):
+        pass
+
+
+class ReplicaLagMonitor(monitoring.ServerHeartbeatListener):
+    # Records the last write date each server reports in its heartbeat
+    # replies, to work out how far each secondary is behind.
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        # Each value is (is primary, last write date, heartbeat time).
+        self.servers = {}
+
+    def started(self, event):
+        pass
+
+    def succeeded(self, event):
+        with self.lock:
+            self.servers[event.connection_id] = (
+                event.reply.is_writable, event.reply.last_write_date,
+                datetime.utcnow())
+
+    def failed(self, event):
+        with self.lock:
+            self.servers.pop(event.connection_id, None)
+
+    def lag(self):
+        # Seconds each secondary is behind the primary, keyed by address.
+        # The time since each servers last write is measured at its own
+        # heartbeat, so an idle replica set doesn't look lagged.
+        with self.lock:
+            servers = dict(self.servers)
+        primaries = [(heartbeat - written) for writable, written, heartbeat
+                     in servers.values() if writable and written]
+        if not primaries:
+            return {}
+        return {"{}:{}".format(*address): max(0.0, (
+            (heartbeat - written) - primaries[0]).total_seconds())
+            for address, (writable, written, heartbeat) in servers.items()
+            if not writable and written}
+
+
+class LastWriteTracker(monitoring.CommandListener):
+    # Notes the operation and cluster time of the last write each
+    # request makes, which save_last_write keeps in the users session.
+    WRITE_COMMANDS = {"insert", "update", "delete", "findAndModify",
+                      "commitTransaction"}
+
+    def started(self, event):
+        pass
+
+    def succeeded(self, event):
+        if event.command_name in self.WRITE_COMMANDS and (
+                has_request_context()) and "operationTime" in event.reply:
+            g.last_write = {
+                "operationTime": event.reply["operationTime"],
+                "$clusterTime": event.reply.get("$clusterTime")
+            }
+
+    def failed(self, event):
+        pass
+
+
+pool_monitor = PoolMonitor()
+topology_monitor = TopologyMonitor()
+replica_lag_monitor = ReplicaLagMonitor()
+
+
+def mongo_client_options():
+    # PyMongo client options from the MONGO_* settings.
+    options = {
+        "maxPoolSize": app.config["MONGO_MAX_POOL_SIZE"],
+        "minPoolSize": app.config["MONGO_MIN_POOL_SIZE"],
+        "serverSelectionTimeoutMS": app.config[
+            "MONGO_SERVER_SELECTION_TIMEOUT_MS"],
+        "event_listeners": [
+            pool_monitor, topology_monitor, replica_lag_monitor]
+    }
+    if app.config["MONGO_WAIT_QUEUE_TIMEOUT_MS"]:
+        options["waitQueueTimeoutMS"] = int(
+            app.config["MONGO_WAIT_QUEUE_TIMEOUT_MS"])
+    if app.config["INSTRUMENTATION"]:
+        options["event_listeners"].append(MongoCommandTimer())
+    if app.config["MONGO_SECONDARY_READS"]:
+        options["event_listeners"].append(LastWriteTracker())
+    return options
+
+
+mongo = PyMongo(app, **mongo_client_options())
+
+# Read-only routes whose reads can go to a secondary.
+SECONDARY_READ_ROUTES = {
+    "account", "view_booking", "admin_search", "admin_stats",
+    "export_bookings"}
+
+
+def secondary_reads():
+    # Whether this request reads from secondaries.
+    return app.config["MONGO_SECONDARY_READS"] and has_request_context() and (
+        request.endpoint in SECONDARY_READ_ROUTES)
+
+
+def read_db():
+    # The database to read from.  With MONGO_SECONDARY_READS on, the
+    # SECONDARY_READ_ROUTES read from a secondary when one is available
+    # (and the primary when not).  Everything else reads the primary.
+    # Reads from read_db() must pass session=read_session().
+    if secondary_reads():
+        return mongo.db.with_options(
+            read_preference=ReadPreference.SECONDARY_PREFERRED)
+    return mongo.db
+
+
+def read_session():
+    # Causally consistent Mongo session for this requests secondary
+    # reads, or None when reading from the primary.  The session starts
+    # from the users last write (see save_last_write), so a secondary
+    # waits until it has caught up with that write before answering.
+    # A page rendered straight after a booking is made or changed
+    # therefore always shows it.
+    if not secondary_reads():
+        return None
+    if "read_session" not in g:
+        g.read_session = mongo.cx.start_session(causal_consistency=True)
+        last_write = session.get("last_write")
+        if last_write:
+            last_write = json_util.loads(last_write)
+            g.read_session.advance_cluster_time(last_write["$clusterTime"])
+            g.read_session.advance_operation_time(
+                last_write["operationTime"])
+    return g.read_session
+
+
+@app.after_request
+def save_last_write(response):
+    # Keep the time of the requests last write in the users session.
+    # Only replica sets report it (standalone servers have no
+    # secondaries to read from).
+    if g.get("last_write") and g.last_write["$clusterTime"]:
+        # Canonical JSON keeps the signatures keyId a 64-bit integer.
+        session["last_write"] = json_util.dumps(
+            g.last_write, json_options=json_util.CANONICAL_JSON_OPTIONS)
+    return response
+
+
+@app.teardown_request
+def end_read_session(exc):
+    read_db_session = g.pop("read_session", None)
+    if read_db_session:
+        read_db_session.end_session()
+
+
+# Functions reporting a dict of counters for the internal stats
+# endpoint, keyed by the name they are reported under.
+STATS_SOURCES = {}
+
+
+def stats_source(name):
+    # Decorator registering a function with STATS_SOURCES.
+    def register(function):
+        STATS_SOURCES[name] = function
+        return function
+    return register
+
+
+@stats_source("mongo_pool")
+def mongo_pool_report():
+    return pool_monitor.report()
+
+
+@stats_source("replica_lag")
+def replica_lag_report():
+    lag = replica_lag_monitor.lag()
+    return {"secondaries": len(lag),
+            "max_seconds": max(lag.values()) if lag else 0.0}
+
+
+def password_method(method=None, iterations=None):
+    # Build the werkzeug method string for the hashing policy,
+    # e.g. "pbkdf2:sha256:150000".
+    method = method or app.config["PASSWORD_HASH_METHOD"]
+    iterations = iterations or app.config["PASSWORD_HASH_ITERATIONS"]
+    if method.startswith("pbkdf2:"):
+        return "{}:{}".format(method, iterations)
+    return method
+
+
+class HashPoolBusy(Exception):
+    # Raised when the password hashing queue is full.
+    pass
+
+
+hash_pool = None
+hash_pool_lock = threading.Lock()
+hash_pool_slots = threading.BoundedSemaphore(
+    app.config["HASH_POOL_MAX_QUEUE"])
+hash_pool_stats = {
+    "queued": 0,
+    "completed": 0,
+    "rejected": 0,
+    "restarts": 0,
+    "wait_seconds_total": 0.0,
+    "wait_seconds_max": 0.0
+}
+
+
+def timed_call(function, *args):
+    # Run in a pool worker.  Returns when the worker picked the call up
+    # as well as the result, so the time spent queued can be measured.
+    return time.time(), function(*args)
+
+
+def submit_to_hash_pool(function, *args):
+    # Run timed_call(function, *args) in the hashing pool.  If a worker
+    # died the whole pool is broken, so it is dropped (for the next
+    # call to start a new one) and BrokenProcessPool is raised.
+    global hash_pool
+    with hash_pool_lock:
+        # The pool is started on first use so each
+        # web worker process gets its own.
+        if hash_pool is None:
+            hash_pool = ProcessPoolExecutor(
+                max_workers=app.config["HASH_POOL_WORKERS"])
+        pool = hash_pool
+    try:
+        return pool.submit(timed_call, function, *args).result()
+    except BrokenProcessPool:
+        with hash_pool_lock:
+            if hash_pool is pool:
+                hash_pool = None
+                hash_pool_stats["restarts"] += 1
+        pool.shutdown(wait=False)
+        raise
+
+
+def run_in_hash_pool(function, *args):
+    # Run function(*args) in the hashing pool and wait for the result.
+    # Raises HashPoolBusy straight away if the queue is full.
+    if not app.config["HASH_POOL_WORKERS"]:
+        return function(*args)
+    if not hash_pool_slots.acquire(blocking=False):
+        with hash_pool_lock:
+            hash_pool_stats["rejected"] += 1
+        raise HashPoolBusy()
+    try:
+        with hash_pool_lock:
+            hash_pool_stats["queued"] += 1
+        submitted = time.time()
+        try:
+            started, result = submit_to_hash_pool(function, *args)
+        except BrokenProcessPool:
+            # Try once more in a new pool, and if that breaks as well
+            # hash on the request thread rather than fail the request.
+            try:
+                started, result = submit_to_hash_pool(function, *args)
+            except BrokenProcessPool:
+                started, result = timed_call(function, *args)
+        wait = max(started - submitted, 0.0)
+        with hash_pool_lock:
+            hash_pool_stats["completed"] += 1
+            hash_pool_stats["wait_seconds_total"] += wait
+            hash_pool_stats["wait_seconds_max"] = max(
+                hash_pool_stats["wait_seconds_max"], wait)
+        return result
+    finally:
+        with hash_pool_lock:
+            hash_pool_stats["queued"] -= 1
+        hash_pool_slots.release()
+
+
+@stats_source("hash_pool")
+def hash_pool_report():
+    # queued is the current queue depth (waiting or being hashed).
+    with hash_pool_lock:
+        return dict(hash_pool_stats,
+                    workers=app.config["HASH_POOL_WORKERS"],
+                    max_queue=app.config["HASH_POOL_MAX_QUEUE"])
+
+
+def hash_password(password):
+    # Hash a password with the current policy.
+    return run_in_hash_pool(
+        generate_password_hash, password, password_method(),
+        app.config["PASSWORD_SALT_LENGTH"])
+
+
+def verify_password(pwhash, password):
+    # Check a password against its stored hash.
+    return run_in_hash_pool(check_password_hash, pwhash, password)
+
+
+def password_needs_rehash(pwhash):
+    # Stored hashes look like "method$salt$hash".  A hash needs
+    # upgrading if it was made with a different method or iterations.
+    return pwhash.split("$", 1)[0] != password_method()
+
+
+def run_in_transaction(callback):
+    # Run callback(db_session) inside a multi-document transaction,
+    # retrying on transient errors, and return its result.
+    # With MONGO_TRANSACTIONS off, db_session is None.
+    if not app.config["MONGO_TRANSACTIONS"]:
+        return callback(None)
+    with mongo.cx.start_session() as db_session:
+        return db_session.with_transaction(callback)
+
+
+def change_user_details(user, update_user, db_session):
+    # Write a users new details and, if their email address has changed,
+    # move their bookings over to it.  Returns the number of bookings
+    # moved.  The users record is written first so that an email address
+    # already in use fails before any bookings are touched.
+    mongo.db.users.update_one(
+        {"_id": user["_id"]}, {"$set": update_user}, session=db_session)
+    if user["user_email_address"] == update_user["user_email_address"]:
+        return 0
+    # Solution reached referring to:
+    # https://www.w3schools.com/python/python_mongodb_update.asp
+    return mongo.db.meter_installs.update_many(
+        {"user_email_address": user["user_email_address"]},
+        {"$set": {"user_email_address": update_user["user_email_address"]},
+         "$inc": {"version": 1}},
+        session=db_session).modified_count
+
+
+# Email change cascade timings grouped by how many bookings
+# were moved, so accounts of different sizes can be compared.
+# Each value is [count, total seconds, max seconds].
+EMAIL_CASCADE_BUCKETS = [0, 10, 100, 1000, 10000]
+email_cascade_lock = threading.Lock()
+email_cascade_stats = {}
+
+
+def email_cascade_bucket(bookings):
+    # Label for the smallest bucket holding this many bookings.
+    for limit in EMAIL_CASCADE_BUCKETS:
+        if bookings <= limit:
+            return "le_{}".format(limit)
+    return "gt_{}".format(EMAIL_CASCADE_BUCKETS[-1])
+
+
+def record_email_cascade(bookings, seconds):
+    # Record how long an email change cascade took.
+    app.logger.info("Email change moved %d bookings in %.1fms",
+                    bookings, seconds * 1000)
+    with email_cascade_lock:
+        timing = email_cascade_stats.setdefault(
+            email_cascade_bucket(bookings), [0, 0.0, 0.0])
+        timing[0] += 1
+        timing[1] += seconds
+        timing[2] = max(timing[2], seconds)
+
+
+@stats_source("email_cascade")
+def email_cascade_report():
+    with email_cascade_lock:
+        report = {}
+        for bucket, (count, total, longest) in email_cascade_stats.items():
+            report[bucket + "_count"] = count
+            report[bucket + "_seconds_total"] = total
+            report[bucket + "_seconds_max"] = longest
+        return report
+
+
+# The user document fields that pages display.
+# The password hash is never cached.
+USER_PROFILE_FIELDS = {
+    "first_name": 1,
+    "last_name": 1,
+    "user_email_address": 1
+}
+
+# Per process LRU cache of user profiles keyed by email address.
+# Each value is (expiry time, profile).
+user_cache = OrderedDict()
+user_cache_lock = threading.Lock()
+# A token for each profile being fetched into the cache.  Invalidating
+# a user drops its token, so a fetch that read the user before the
+# change doesn't put the old profile back.
+user_cache_fills = {}
+user_cache_stats = {
+    "hits": 0,
+    "misses": 0,
+    "evictions": 0,
+    "invalidations": 0
+}
+
+
+def get_user_profile(email):
+    # Return the profile of the user with this email address, or None.
+    # Profiles are served from user_cache for up to USER_CACHE_TTL
+    # seconds, saving a users query on most page views.
+    now = time.monotonic()
+    with user_cache_lock:
+        entry = user_cache.get(email)
+        if entry and entry[0] > now:
+            user_cache.move_to_end(email)
+            user_cache_stats["hits"] += 1
+            # Hand out a copy so callers can't change the cached one.
+            return dict(entry[1])
+        user_cache_stats["misses"] += 1
+        token = user_cache_fills[email] = object()
+    user = None
+    try:
+        user = read_db().users.find_one(
+            {"user_email_address": email, "deleted": {"$ne": True}},
+            USER_PROFILE_FIELDS, session=read_session())
+    finally:
+        with user_cache_lock:
+            # Users that aren't found aren't cached so a new
+            # registration is seen straight away.  Nor is a user that
+            # was invalidated while it was being read.
+            if user_cache_fills.get(email) is token:
+                del user_cache_fills[email]
+                if user:
+                    user_cache[email] = (
+                        now + app.config["USER_CACHE_TTL"], user)
+                    user_cache.move_to_end(email)
+                    while len(user_cache) > app.config["USER_CACHE_SIZE"]:
+                        user_cache.popitem(last=False)
+                        user_cache_stats["evictions"] += 1
+    return dict(user) if user else None
+
+
+def invalidate_user(email):
+    # Drop a user from user_cache.  Must be called whenever
+    # the users document is changed or deleted.
+    with user_cache_lock:
+        user_cache_fills.pop(email, None)
+        if user_cache.pop(email, None):
+            user_cache_stats["invalidations"] += 1
+
+
+@stats_source("user_cache")
+def user_cache_report():
+    # Each hit is a users query saved.
+    with user_cache_lock:
+        return dict(user_cache_stats, size=len(user_cache))
+
+
+@app.template_global()
+def is_admin():
+    # Whether the signed in user is one of the ADMIN_EMAILS.
+    return session.get("user_email_address") in app.config["ADMIN_EMAILS"]
+
+
+def internal_request():
+    # Check the request carries the INTERNAL_TOKEN.
+    token = app.config["INTERNAL_TOKEN"]
+    return bool(token) and hmac.compare_digest(
+        request.headers.get("X-Internal-Token", ""), token)
+
+
+# Server-side sessions.
+# Each store maps a session ID to the serialized session data, the
+# email address signed in with it (so a users sessions can be revoked)
+# and when it expires.
+class MemorySessionStore:
+    # Per process LRU of sessions, for a single web process.
+
+    def __init__(self, size):
+        self.size = size
+        self.sessions = OrderedDict()
+        self.lock = threading.Lock()
+
+    def load(self, sid):
+        # Return (data, expiry time) or None if there is no such session.
+        with self.lock:
+            entry = self.sessions.get(sid)
+            if entry is None:
+                return None
+            if entry[2] <= datetime.utcnow():
+                del self.sessions[sid]
+                return None
+            self.sessions.move_to_end(sid)
+            return entry[0], entry[2]
+
+    def save(self, sid, data, email, expires):
+        with self.lock:
+            self.sessions[sid] = (data, email, expires)
+            self.sessions.move_to_end(sid)
+            while len(self.sessions) > self.size:
+                self.sessions.popitem(last=False)
+
+    def delete(self, sid):
+        with self.lock:
+            self.sessions.pop(sid, None)
+
+    def delete_user(self, email):
+        with self.lock:
+            for sid in [sid for sid, entry in self.sessions.items()
+                        if entry[1] == email]:
+                del self.sessions[sid]
+
+
+class MongoSessionStore:
+    # Sessions in the sessions collection, shared by every web process.
+    # A TTL index deletes them once they have expired.
+
+    def load(self, sid):
+        # The TTL monitor only runs once a minute,
+        # so expired sessions are filtered out here.
+        doc = mongo.db.sessions.find_one(
+            {"_id": sid, "expires": {"$gt": datetime.utcnow()}})
+        return (doc["data"], doc["expires"]) if doc else None
+
+    def save(self, sid, data, email, expires):
+        mongo.db.sessions.replace_one(
+            {"_id": sid},
+            {"data": data, "user_email_address": email, "expires": expires},
+            upsert=True)
+
+    def delete(self, sid):
+        mongo.db.sessions.delete_one({"_id": sid})
+
+    def delete_user(self, email):
+        mongo.db.sessions.delete_many({"user_email_address": email})
+
+
+SESSION_STORES = {
+    "memory": lambda: MemorySessionStore(app.config["SESSION_MEMORY_SIZE"]),
+    "mongo": MongoSessionStore
+}
+
+
+class ServerSideSession(SecureCookieSession):
+    # A session kept in a session store under sid.  expires is
+    # when the stored copy expires, None if it hasn't been stored.
+
+    def __init__(self, initial=None, sid=None, expires=None):
+        super().__init__(initial)
+        self.sid = sid or secrets.token_urlsafe(32)
+        self.expires = expires
+
+
+class ServerSideSessionInterface(SessionInterface):
+    # Keep session data in a session store and only
+    # put the (random) session ID in the cookie.
+    session_class = ServerSideSession
+    serializer = session_json_serializer
+
+    def __init__(self, store):
+        self.store = store
+
+    def open_session(self, app, request):
+        sid = request.cookies.get(app.session_cookie_name)
+        entry = self.store.load(sid) if sid else None
+        if entry is None:
+            return self.session_class()
+        data, expires = entry
+        return self.session_class(self.serializer.loads(data), sid, expires)
+
+    def save_session(self, app, session, response):
+        domain = self.get_cookie_domain(app)
+        path = self.get_cookie_path(app)
+        if not session:
+            if session.modified:
+                self.store.delete(session.sid)
+                response.delete_cookie(
+                    app.session_cookie_name, domain=domain, path=path)
+            return
+        if session.accessed:
+            response.vary.add("Cookie")
+        now = datetime.utcnow()
+        idle = timedelta(seconds=app.config["SESSION_IDLE_SECONDS"])
+        # An unchanged session is only written back (to push its expiry
+        # back) once half of its idle time has gone, so most requests
+        # only read from the store.
+        if not session.modified and session.expires and (
+                session.expires - now > idle / 2):
+            return
+        new = session.expires is None
+        self.store.save(
+            session.sid, self.serializer.dumps(dict(session)),
+            session.get("user_email_address"), now + idle)
+        session.expires = now + idle
+        if new or session.permanent:
+            response.set_cookie(
+                app.session_cookie_name, session.sid,
+                expires=self.get_expiration_time(app, session),
+                httponly=self.get_cookie_httponly(app),
+                domain=domain, path=path,
+                secure=self.get_cookie_secure(app),
+                samesite=self.get_cookie_samesite(app))
+
+
+if app.config["SESSION_STORE"] != "cookie":
+    app.session_interface = ServerSideSessionInterface(
+        SESSION_STORES[app.config["SESSION_STORE"]]())
+
+
+def rotate_session():
+    # Move the session to a new session ID when a user signs in or out,
+    # so an ID that was used before can't be reused.  Cookie sessions
+    # have no ID to change.
+    if isinstance(app.session_interface, ServerSideSessionInterface):
+        app.session_interface.store.delete(session.sid)
+        session.sid = secrets.token_urlsafe(32)
+        session.expires = None
+        session.modified = True
+
+
+def revoke_user_sessions(email):
+    # Sign a user out of every session they are signed in to.
+    # Only server-side sessions can be revoked.
+    if isinstance(app.session_interface, ServerSideSessionInterface):
+        app.session_interface.store.delete_user(email)
+
+
+# Sort order of the booking list on the Account page.
+# _id makes the order unique so it can be paged with a cursor.
+BOOKING_PAGE_SORT = [
+    ("install_date", ASCENDING),
+    ("first_address_line", ASCENDING),
+    ("_id", ASCENDING)
+]
+
+# Only the fields the booking list on the Account page displays.
+BOOKING_LIST_FIELDS = {
+    "first_address_line": 1,
+    "postcode": 1,
+    "meter_id": 1,
+    "install_date": 1
+}
+
+
+def encode_cursor(booking):
+    # Turn the sort key of a booking into an opaque, URL safe page cursor.
+    key = [booking["install_date"].isoformat(),
+           booking["first_address_line"], str(booking["_id"])]
+    return base64.urlsafe_b64encode(json.dumps(key).encode()).decode()
+
+
+def decode_cursor(cursor):
+    # Turn a page cursor back into a sort key.
+    # Returns None if the cursor has been tampered with.
+    try:
+        install_date, address, booking_id = json.loads(
+            base64.urlsafe_b64decode(cursor.encode()))
+        return (datetime.fromisoformat(install_date),
+                address, ObjectId(booking_id))
+    except (ValueError, TypeError, bson.errors.InvalidId):
+        return None
+
+
+def page_filter(key, direction):
+    # Build the filter matching bookings that sort after (ASCENDING)
+    # or before (DESCENDING) the sort key of a booking.
+    install_date, address, booking_id = key
+    op = "$gt" if direction == ASCENDING else "$lt"
+    return {"$or": [
+        {"install_date": {op: install_date}},
+        {"install_date": install_date,
+         "first_address_line": {op: address}},
+        {"install_date": install_date,
+         "first_address_line": address,
+         "_id": {op: booking_id}}
+    ]}
+
+
+def fetch_bookings_page(query, page_size, after=None, before=None,
+                        projection=BOOKING_LIST_FIELDS):
+    # Fetch one page of bookings in BOOKING_PAGE_SORT order.
+    # after/before are decoded cursors.  One extra booking is fetched
+    # to tell whether there is another page in that direction.
+    # Returns the bookings with the cursors for the previous
+    # and next pages (None when there is no such page).
+    if before:
+        # Walk backwards from the cursor and flip the results round.
+        sort = [(field, DESCENDING) for field, _ in BOOKING_PAGE_SORT]
+        query = dict(query, **page_filter(before, DESCENDING))
+    else:
+        sort = BOOKING_PAGE_SORT
+        if after:
+            query = dict(query, **page_filter(after, ASCENDING))
+    bookings = list(read_db().meter_installs.find(
+        query, projection, session=read_session()).sort(sort).limit(
+            page_size + 1))
+    more = len(bookings) > page_size
+    bookings = bookings[:page_size]
+    if before:
+        bookings.reverse()
+        prev_cursor = encode_cursor(bookings[0]) if more else None
+        next_cursor = encode_cursor(bookings[-1]) if bookings else None
+    else:
+        prev_cursor = encode_cursor(bookings[0]) if (
+            after and bookings) else None
+        next_cursor = encode_cursor(bookings[-1]) if more else None
+    return bookings, prev_cursor, next_cursor
+
+
+def find_own_booking(booking_id, email, projection=None):
+    # Return the booking with this ID if it belongs to the user with
+    # this email address.  Returns None if the ID isn't valid, there is
+    # no such booking or it belongs to someone else.
+    if not validate_id(booking_id):
+        return None
+    return read_db().meter_installs.find_one(
+        {"_id": ObjectId(booking_id), "user_email_address": email},
+        projection, session=read_session())
+
+
+# JSON API.
+# Fields of a booking the API returns, and that ?fields= can pick from.
+API_BOOKING_FIELDS = [field.name for field in BOOKING_SCHEMA] + [
+    "application_date"]
+API_MAX_PAGE_SIZE = 100
+
+
+def booking_version(booking):
+    # Bookings made before versions were added count as version 0.
+    return booking.get("version", 0)
+
+
+def booking_etag(booking, fields):
+    # Strong ETag of a bookings JSON with the given fields.
+    # It changes whenever the bookings version does.
+    return hashlib.sha1("{}:{}:{}".format(
+        booking["_id"], booking_version(booking),
+        ",".join(fields)).encode()).hexdigest()
+
+
+def booking_json(booking, fields):
+    data = {"id": str(booking["_id"]), "version": booking_version(booking)}
+    for field in fields:
+        value = booking.get(field)
+        data[field] = value.isoformat() if isinstance(
+            value, datetime) else value
+    return data
+
+
+def api_fields():
+    # The fields asked for with ?fields=a,b,c (all of them by default),
+    # or None if any of them isn't a booking field.
+    if not request.args.get("fields"):
+        return API_BOOKING_FIELDS
+    fields = request.args["fields"].split(",")
+    if any(field not in API_BOOKING_FIELDS for field in fields):
+        return None
+    return fields
+
+
+def api_error(message, status):
+    return jsonify({"error": message}), status
+
+
+# Supplier names are matched ignoring case, so "British Gas"
+# and "british gas" are the same supplier.
+SUPPLIER_COLLATION = Collation(locale="en", strength=2)
+
+# Indexes needed by the queries the app issues.
+# Each entry is (collection, keys, options).
+INDEXES = [
+    # signin, register, account, update_account and delete_account
+    # all look users up by email address.
+    ("users", [("user_email_address", ASCENDING)], {"unique": True}),
+    # book and update_booking check whether a meter ID is already booked.
+    ("meter_installs", [("meter_id", ASCENDING)], {"unique": True}),
+    # The meter ID filter picks up bookings moved to another meter ID
+    # by other processes.  Only moved bookings have the field.
+    ("meter_installs", [("meter_id_moved", ASCENDING)], {"sparse": True}),
+    # account lists a users bookings sorted by install date and address,
+    # with _id as the tie-breaker for paging.  The same index serves the
+    # update_many/delete_many by email address.
+    ("meter_installs", [("user_email_address", ASCENDING),
+                        ("install_date", ASCENDING),
+                        ("first_address_line", ASCENDING),
+                        ("_id", ASCENDING)], {}),
+    # The JSON API checks a bookings owner and version against an ETag
+    # with a covered query, without fetching the booking itself.
+    ("meter_installs", [("_id", ASCENDING),
+                        ("user_email_address", ASCENDING),
+                        ("version", ASCENDING)], {}),
+    # Admin search: postcode prefixes (kept upper case without spaces),
+    # meter serial numbers, and words in the address or supplier.
+    # Partial meter IDs are a range on the meter_id index above.
+    ("meter_installs", [("postcode_normalized", ASCENDING),
+                        ("_id", ASCENDING)], {}),
+    ("meter_installs", [("meter_serial_number", ASCENDING),
+                        ("_id", ASCENDING)], {}),
+    ("meter_installs", [("first_address_line", TEXT),
+                        ("second_address_line", TEXT),
+                        ("third_address_line", TEXT),
+                        ("town", TEXT),
+                        ("supplier", TEXT)],
+     {"name": "booking_search_text", "default_language": "none"}),
+    # The supplier export reads a suppliers bookings in _id order
+    # (matching the supplier name whatever its case).
+    ("meter_installs", [("supplier", ASCENDING), ("_id", ASCENDING)],
+     {"collation": SUPPLIER_COLLATION}),
+    # The availability calendar reads a date range of day
+    # (or postcode area) counters.
+    ("install_capacity", [("area", ASCENDING), ("date", ASCENDING)], {}),
+    # The purge worker claims the oldest pending job, and queues a job
+    # for any account marked deleted without one.
+    ("purge_jobs", [("status", ASCENDING), ("created", ASCENDING)], {}),
+    ("users", [("deleted", ASCENDING)],
+     {"partialFilterExpression": {"deleted": True}}),
+    # Server-side sessions are deleted once they expire, and
+    # delete_account revokes all of a users sessions.
+    ("sessions", [("expires", ASCENDING)], {"expireAfterSeconds": 0}),
+    ("sessions", [("user_email_address", ASCENDING)], {}),
+]
+
+# Every query shape the app issues, used by the check-indexes command.
+# Each entry is (collection, filter, sort), plus the collation for
+# queries that use one.  The filter values are only
+# placeholders - the query planner picks the same plan for any value.
+QUERY_SHAPES = [
+    ("users", {"user_email_address": "shape@example.com"}, None),
+    ("users", {"_id": ObjectId()}, None),
+    ("users", {"user_email_address": "shape@example.com",
+               "deleted": {"$ne": True}}, None),
+    ("meter_installs", {"meter_id": 1234567890123}, None),
+    ("meter_installs", {"_id": {"$gte": ObjectId()}}, None),
+    ("meter_installs", {"meter_id_moved": {"$gte": datetime.utcnow()}},
+     None),
+    ("meter_installs", {"_id": ObjectId()}, None),
+    ("meter_installs", {"_id": ObjectId(),
+                        "user_email_address": "shape@example.com"}, None),
+    ("meter_installs", {"_id": {"$in": [ObjectId()]},
+                        "user_email_address": "shape@example.com"}, None),
+    ("purge_jobs", {"status": "pending"}, [("created", ASCENDING)]),
+    ("users", {"deleted": True}, None),
+    ("meter_installs", {"postcode_normalized": {"$regex": "^LS1"}},
+     [("postcode_normalized", ASCENDING), ("_id", ASCENDING)]),
+    ("meter_installs", {"meter_id": {"$gte": 1234500000000,
+                                     "$lt": 1234600000000}},
+     [("meter_id", ASCENDING)]),
+    ("meter_installs", {"meter_serial_number": "shape"},
+     [("_id", ASCENDING)]),
+    ("meter_installs", {"$text": {"$search": "shape"}}, None),
+    ("install_capacity", {"area": None, "date": {"$gte": datetime.utcnow()}},
+     None),
+    ("meter_installs", {"supplier": "shape",
+                        "install_date": {"$gte": datetime(2030, 1, 1)},
+                        "_id": {"$gt": ObjectId()}},
+     [("_id", ASCENDING)], SUPPLIER_COLLATION),
+    ("sessions", {"_id": "shape", "expires": {"$gt": datetime.utcnow()}},
+     None),
+    ("sessions", {"user_email_address": "shape@example.com"}, None),
+    ("meter_installs", {"user_email_address": "shape@example.com"},
+     BOOKING_PAGE_SORT),
+    ("meter_installs", dict(
+        {"user_email_address": "shape@example.com"},
+        **page_filter((datetime(2030, 1, 1), "", ObjectId()), ASCENDING)),
+     BOOKING_PAGE_SORT),
+]
+
+
+def create_indexes():
+    # Build any missing indexes.  create_index is a no-op
+    # when an identical index already exists.
+    for collection, keys, options in INDEXES:
+        mongo.db[collection].create_index(keys, **options)
+
+
+def duplicate_keys(collection, keys, limit=10):
+    # Values of an index's keys held by more than one document, which
+    # stop a unique index from being built, with how many hold each.
+    return list(mongo.db[collection].aggregate([
+        {"$group": {"_id": {field: "$" + field for field, _ in keys},
+                    "count": {"$sum": 1}}},
+        {"$match": {"count": {"$gt": 1}}},
+        {"$limit": limit}
+    ], allowDiskUse=True))
+
+
+def plan_stages(plan):
+    # Walk an explain() plan tree and yield every stage name in it.
+    yield plan.get("stage")
+    if "inputStage" in plan:
+        yield from plan_stages(plan["inputStage"])
+    for stage in plan.get("inputStages", []):
+        yield from plan_stages(stage)
+
+
+# Counters for the purge work done by this process.
+purge_lock = threading.Lock()
+purge_stats = {
+    "jobs_finished": 0,
+    "batches": 0,
+    "bookings_deleted": 0
+}
+
+
+def queue_account_purge(user, db_session=None):
+    # Queue a job to delete a deleted users bookings.  Jobs are keyed
+    # on the users _id so queueing the same account twice is harmless.
+    mongo.db.purge_jobs.update_one(
+        {"_id": user["_id"]},
+        {"$setOnInsert": {
+            "user_email_address": user["user_email_address"],
+            "status": "pending",
+            "created": datetime.utcnow(),
+            "bookings_deleted": 0
+        }}, upsert=True, session=db_session)
+
+
+def mark_account_deleted(user, db_session):
+    # Mark an account deleted and queue its purge job, in one
+    # transaction when MONGO_TRANSACTIONS is on.  Without transactions
+    # queue_missed_purges catches an account marked deleted whose job
+    # was never queued.
+    mongo.db.users.update_one(
+        {"_id": user["_id"]},
+        {"$set": {"deleted": True, "deleted_at": datetime.utcnow()}},
+        session=db_session)
+    queue_account_purge(user, db_session)
+
+
+def queue_missed_purges():
+    # Queue a job for every account marked deleted.  Accounts that
+    # already have one are left as they are.
+    for user in mongo.db.users.find(
+            {"deleted": True}, {"user_email_address": 1}):
+        queue_account_purge(user)
+
+
+def claim_purge_job():
+    # Take the oldest pending job that no other worker holds a lease on.
+    # The lease runs out if a worker dies part way through a job,
+    # letting another worker pick it up where it left off.
+    now = datetime.utcnow()
+    return mongo.db.purge_jobs.find_one_and_update(
+        {"status": "pending", "$or": [
+            {"lease_until": None}, {"lease_until": {"$lt": now}}]},
+        {"$set": {"lease_until": now + timedelta(
+            seconds=app.config["PURGE_LEASE_SECONDS"])}},
+        sort=[("created", ASCENDING)],
+        return_document=ReturnDocument.AFTER)
+
+
+def run_purge_job(job):
+    # Delete the bookings of a deleted account a batch at a time,
+    # pausing between batches to spread the load, then delete the users
+    # record.  Everything is safe to repeat so a job that was cut short
+    # by a restart just carries on when it's picked up again.
+    email = job["user_email_address"]
+    # A batch that was being deleted when the job was cut short is
+    # finished first.
+    batch = job.get("batch")
+    resumed = batch is not None
+    while True:
+        # Stop as soon as the users record has gone.  It's only deleted
+        # once all of its bookings are, and after that the email address
+        # may belong to a new account whose bookings must be left alone.
+        if not mongo.db.users.find_one(
+                {"_id": job["_id"], "deleted": True}, {"_id": 1}):
+            break
+        if not resumed:
+            batch = list(mongo.db.meter_installs.find(
+                {"user_email_address": email},
+                dict(BOOKING_STATS_FIELDS, meter_id=1, postcode=1)
+            ).limit(app.config["PURGE_BATCH_SIZE"]))
+            if not batch:
+                # Only now that the bookings are gone is the users
+                # record deleted, so the email address can't be
+                # registered again in the meantime.
+                mongo.db.users.delete_one(
+                    {"_id": job["_id"], "deleted": True})
+                break
+            # Checkpoint the batch before deleting it, so that if the
+            # job is cut short its meter IDs, slots and statistics are
+            # still released when it's picked up again.
+            mongo.db.purge_jobs.update_one(
+                {"_id": job["_id"]}, {"$set": {"batch": batch}})
+        deleted = mongo.db.meter_installs.delete_many(
+            {"_id": {"$in": [doc["_id"] for doc in batch]},
+             "user_email_address": email}).deleted_count
+        # Releasing a meter ID (or slot) twice could hide another
+        # booking, so if some of a new batch had already gone (deleted
+        # by another worker) they are left to the next rebuild.  A
+        # checkpointed batch was deleted by this job before it stopped.
+        if resumed or deleted == len(batch):
+            for doc in batch:
+                note_meter_released(doc["meter_id"])
+            release_slots([slot for doc in batch
+                           for slot in booking_slots(doc)])
+            record_booking_stats(removed=batch)
+        # Record progress, clear the checkpoint and renew the lease.
+        mongo.db.purge_jobs.update_one(
+            {"_id": job["_id"]},
+            {"$inc": {"bookings_deleted": deleted},
+             "$unset": {"batch": ""},
+             "$set": {"lease_until": datetime.utcnow() + timedelta(
+                 seconds=app.config["PURGE_LEASE_SECONDS"])}})
+        with purge_lock:
+            purge_stats["batches"] += 1
+            purge_stats["bookings_deleted"] += deleted
+        resumed = False
+        time.sleep(app.config["PURGE_BATCH_PAUSE"])
+    mongo.db.purge_jobs.update_one(
+        {"_id": job["_id"]},
+        {"$set": {"status": "done", "finished": datetime.utcnow()}})
+    with purge_lock:
+        purge_stats["jobs_finished"] += 1
+
+
+def run_purge_jobs():
+    # Run pending purge jobs until there are none left.
+    queue_missed_purges()
+    job = claim_purge_job()
+    while job:
+        run_purge_job(job)
+        job = claim_purge_job()
+
+
+def purge_worker():
+    # Background loop run by the purge worker thread or command.
+    while True:
+        try:
+            run_purge_jobs()
+        except Exception:
+            app.logger.exception("Account purge failed, will retry")
+        time.sleep(app.config["PURGE_POLL_SECONDS"])
+
+
+@stats_source("account_purge")
+def purge_report():
+    # pending_jobs and oldest_pending_seconds show how far
+    # the purge workers are lagging behind account deletions.
+    oldest = mongo.db.purge_jobs.find_one(
+        {"status": "pending"}, {"created": 1},
+        sort=[("created", ASCENDING)])
+    with purge_lock:
+        return dict(
+            purge_stats,
+            pending_jobs=mongo.db.purge_jobs.count_documents(
+                {"status": "pending"}),
+            oldest_pending_seconds=(
+                datetime.utcnow() - oldest["created"]).total_seconds()
+            if oldest else 0.0)
+
+
+# Booked meter IDs.
+class CountingBloomFilter:
+    # Bloom filter with a small counter in each slot rather than a bit,
+    # so items can be removed as well as added.  Saying an item is not
+    # in the filter is always right; saying it is may be wrong.
+    # The items added are kept too, so adding an item twice counts it
+    # once and removing one that was never added is ignored - otherwise
+    # it would take counts away from other items, which could then
+    # wrongly be said not to be in the filter.
+
+    def __init__(self, capacity, error_rate):
+        self.size = math.ceil(
+            -capacity * math.log(error_rate) / math.log(2) ** 2)
+        self.hashes = max(1, round(self.size / capacity * math.log(2)))
+        self.counts = bytearray(self.size)
+        self.items = set()
+        self.lock = threading.Lock()
+
+    def positions(self, item):
+        # Double hashing: the k positions are h1 + i * h2.
+        digest = hashlib.blake2b(str(item).encode(), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], "little")
+        h2 = int.from_bytes(digest[8:], "little") | 1
+        return [(h1 + i * h2) % self.size for i in range(self.hashes)]
+
+    def add(self, item):
+        with self.lock:
+            if item in self.items:
+                return
+            self.items.add(item)
+            for position in self.positions(item):
+                # A full counter stays full, as it can't
+                # tell how many items were added since.
+                if self.counts[position] < 255:
+                    self.counts[position] += 1
+
+    def remove(self, item):
+        with self.lock:
+            if item not in self.items:
+                return
+            self.items.remove(item)
+            for position in self.positions(item):
+                if 0 < self.counts[position] < 255:
+                    self.counts[position] -= 1
+
+    def __contains__(self, item):
+        return all(self.counts[position]
+                   for position in self.positions(item))
+
+
+# The filter of booked meter IDs, None until it has been built.
+# While it is rebuilt, changes are applied to the new filter as well.
+meter_filter = None
+meter_filter_building = None
+meter_filter_lock = threading.Lock()
+meter_filter_stats = {
+    "checks": 0,
+    "answered_by_filter": 0,
+    "rebuilds": 0,
+    "synced": 0
+}
+# The bookings sync_meter_filter has added to the filter, with when
+# they were booked (or moved), so they aren't added twice.
+meter_filter_synced = {}
+meter_filter_synced_since = None
+# ObjectIds are made from the clock of the process that made them, so
+# each sync looks back this far to allow for clocks being out.
+METER_FILTER_SYNC_OVERLAP = timedelta(seconds=60)
+
+
+def rebuild_meter_filter():
+    # Build a new filter from every booked meter ID (read from the
+    # meter_id index alone) and swap it in for the old one.
+    global meter_filter, meter_filter_building, meter_filter_synced_since
+    new_filter = CountingBloomFilter(
+        app.config["METER_FILTER_CAPACITY"],
+        app.config["METER_FILTER_ERROR_RATE"])
+    with meter_filter_lock:
+        meter_filter_building = new_filter
+        # Bookings made from here on may be missed by the scan below,
+        # so the next sync starts from now.
+        meter_filter_synced.clear()
+        meter_filter_synced_since = datetime.utcnow()
+    try:
+        for booking in mongo.db.meter_installs.find(
+                {}, {"_id": 0, "meter_id": 1}).hint([("meter_id", ASCENDING)]):
+            new_filter.add(booking["meter_id"])
+    finally:
+        with meter_filter_lock:
+            if meter_filter_building is new_filter:
+                meter_filter = new_filter
+                meter_filter_stats["rebuilds"] += 1
+            meter_filter_building = None
+
+
+def meter_filters():
+    with meter_filter_lock:
+        return [f for f in [meter_filter, meter_filter_building] if f]
+
+
+def note_meter_booked(meter_id):
+    # Must be called whenever a booking is made for a meter ID.
+    for bloom in meter_filters():
+        bloom.add(meter_id)
+
+
+def note_meter_released(meter_id):
+    # Must be called whenever a booking for a meter ID is deleted or
+    # moved to another meter ID.  A filter being rebuilt may not have
+    # read the booking yet, so it is left alone; at worst it keeps
+    # saying the ID may be booked, which is checked in Mongo.
+    with meter_filter_lock:
+        bloom = meter_filter
+    if bloom is not None:
+        bloom.remove(meter_id)
+
+
+def sync_meter_filter():
+    # Add the meter IDs booked, or moved to, by other processes since
+    # the filter was built.  Bookings this process made are already in
+    # the filter, so adding them again changes nothing.
+    global meter_filter_synced_since
+    with meter_filter_lock:
+        since = meter_filter_synced_since
+    if since is None:
+        return
+    now = datetime.utcnow()
+    start = since - METER_FILTER_SYNC_OVERLAP
+    bookings = list(mongo.db.meter_installs.find(
+        {"_id": {"$gte": ObjectId.from_datetime(start)}},
+        {"meter_id": 1}))
+    bookings += mongo.db.meter_installs.find(
+        {"meter_id_moved": {"$gte": start}},
+        {"meter_id": 1, "meter_id_moved": 1})
+    with meter_filter_lock:
+        if meter_filter_synced_since is not since:
+            # Rebuilt in the meantime.
+            return
+        new = []
+        for booking in bookings:
+            key = booking["_id"], booking["meter_id"]
+            if key not in meter_filter_synced:
+                meter_filter_synced[key] = booking.get(
+                    "meter_id_moved", booking["_id"].generation_time)
+                new.append(booking["meter_id"])
+        # Forget bookings too old to be read again.
+        for key, when in list(meter_filter_synced.items()):
+            if when.replace(tzinfo=None) < start:
+                del meter_filter_synced[key]
+        meter_filter_synced_since = now
+        meter_filter_stats["synced"] += len(new)
+    for meter_id in new:
+        note_meter_booked(meter_id)
+
+
+def meter_id_available(meter_id):
+    # Whether a meter ID has not been booked.  IDs the filter has
+    # never seen are answered straight away; only possible hits
+    # are looked up in Mongo.  "Available" is only a hint, as another
+    # process may have booked the ID since this processes filter was
+    # last synced - the unique index on meter_id has the final say.
+    with meter_filter_lock:
+        bloom = meter_filter
+        meter_filter_stats["checks"] += 1
+    if bloom is not None and meter_id not in bloom:
+        with meter_filter_lock:
+            meter_filter_stats["answered_by_filter"] += 1
+        return True
+    return not mongo.db.meter_installs.count_documents(
+        {"meter_id": meter_id}, limit=1)
+
+
+def meter_filter_worker():
+    # Rebuild this processes filter now and then every
+    # METER_FILTER_REBUILD_SECONDS, syncing it every
+    # METER_FILTER_SYNC_SECONDS in between.
+    while True:
+        try:
+            rebuild_meter_filter()
+        except Exception as e:
+            # Keep answering from the old filter (or Mongo).
+            app.logger.exception("Meter filter rebuild failed: %s", e)
+        rebuild_at = time.monotonic() + app.config[
+            "METER_FILTER_REBUILD_SECONDS"]
+        while time.monotonic() < rebuild_at:
+            time.sleep(min(app.config["METER_FILTER_SYNC_SECONDS"],
+                           max(0, rebuild_at - time.monotonic())))
+            try:
+                sync_meter_filter()
+            except Exception as e:
+                app.logger.exception("Meter filter sync failed: %s", e)
+
+
+@stats_source("meter_filter")
+def meter_filter_report():
+    with meter_filter_lock:
+        return dict(meter_filter_stats,
+                    slots=meter_filter.size if meter_filter else 0)
+
+
+# Admin booking search.
+# Each way of searching has a function turning the search text into a
+# filter (None if the text can't match anything) and the sort order the
+# results are paged in.  Every sort ends in a unique field, so a page
+# cursor is just the sort key of the last booking on the page.
+# Text matches are ranked by their TEXT_SCORE_FIELD.
+TEXT_SCORE_FIELD = "score"
+
+
+def postcode_search(text):
+    # Bookings whose postcode starts with the text, e.g. "LS1" or "ls1 4".
+    prefix = normalize_postcode(text)
+    if not POSTCODE_PREFIX_PATTERN.match(prefix):
+        return None
+    # An anchored, case sensitive regex is a range scan of the index.
+    return {"postcode_normalized": {"$regex": "^" + prefix}}
+
+
+def meter_id_search(text):
+    # Bookings whose meter ID starts with the text.  Meter IDs are
+    # always 13 digits, so a prefix is a range of numbers.
+    text = text.strip()
+    if not METER_ID_PREFIX_PATTERN.match(text):
+        return None
+    scale = 10 ** (13 - len(text))
+    return {"meter_id": {"$gte": int(text) * scale,
+                         "$lt": (int(text) + 1) * scale}}
+
+
+def meter_serial_number_search(text):
+    text = text.strip()
+    if not text or not validate_MSN(text):
+        return None
+    return {"meter_serial_number": text}
+
+
+def text_search(text):
+    # Bookings with any of the words in their address, town or supplier.
+    if not text.strip():
+        return None
+    return {"$text": {"$search": text}}
+
+
+SEARCH_TYPES = OrderedDict([
+    ("postcode", ("Postcode", postcode_search,
+                  [("postcode_normalized", ASCENDING), ("_id", ASCENDING)])),
+    ("meter_id", ("Meter ID", meter_id_search, [("meter_id", ASCENDING)])),
+    ("meter_serial_number", ("Meter Serial Number",
+                             meter_serial_number_search,
+                             [("_id", ASCENDING)])),
+    ("text", ("Address, Town or Supplier", text_search,
+              [(TEXT_SCORE_FIELD, DESCENDING), ("_id", ASCENDING)])),
+])
+
+# Only the fields the search results display.
+SEARCH_RESULT_FIELDS = {
+    "meter_id": 1,
+    "meter_serial_number": 1,
+    "first_address_line": 1,
+    "town": 1,
+    "postcode": 1,
+    "postcode_normalized": 1,
+    "supplier": 1,
+    "install_date": 1,
+    "user_email_address": 1
+}
+
+
+def encode_search_cursor(booking, sort):
+    key = [booking[field] for field, _ in sort]
+    return base64.urlsafe_b64encode(json_util.dumps(
+        key, json_options=json_util.CANONICAL_JSON_OPTIONS).encode()).decode()
+
+
+def decode_search_cursor(cursor, sort):
+    # Returns None if the cursor has been tampered with.
+    try:
+        key = json_util.loads(base64.urlsafe_b64decode(cursor.encode()))
+    except (ValueError, TypeError, bson.errors.InvalidId):
+        return None
+    if not isinstance(key, list) or len(key) != len(sort):
+        return None
+    return key
+
+
+def keyset_filter(sort, key):
+    # Build the filter matching bookings that sort after the key.
+    clauses = []
+    for n, (field, direction) in enumerate(sort):
+        clause = {earlier: value for (earlier, _), value in zip(sort, key[:n])}
+        clause[field] = {"$gt" if direction == ASCENDING else "$lt": key[n]}
+        clauses.append(clause)
+    return clauses[0] if len(clauses) == 1 else {"$or": clauses}
+
+
+def search_bookings(search_type, text, after=None, page_size=None):
+    # Fetch one page of bookings matching the search.  after is a page
+    # cursor.  Each query is stopped after SEARCH_MAX_TIME_MS (raising
+    # ExecutionTimeout), so a search can't tie up the database.
+    # Returns the bookings and the cursor for the next page, or None
+    # if the search text can't match anything.
+    _, make_filter, sort = SEARCH_TYPES[search_type]
+    query = make_filter(text)
+    if query is None:
+        return None
+    after_key = {}
+    if after:
+        key = decode_search_cursor(after, sort)
+        if key is not None:
+            after_key = keyset_filter(sort, key)
+    page_size = page_size or app.config["SEARCH_PAGE_SIZE"]
+    if "$text" in query:
+        # The text index returns matches in no useful order, and
+        # sorting every match by _id runs out of time on common words.
+        # Ranked by score instead, the server only keeps the top
+        # page_size + 1 while it sorts.  The score can only be filtered
+        # on in an aggregation, after it has been added.
+        bookings = list(read_db().meter_installs.aggregate([
+            {"$match": query},
+            {"$addFields": {TEXT_SCORE_FIELD: {"$meta": "textScore"}}},
+            {"$match": after_key},
+            {"$sort": dict(sort)},
+            {"$limit": page_size + 1},
+            {"$project": dict(SEARCH_RESULT_FIELDS,
+                              **{TEXT_SCORE_FIELD: 1})}
+        ], session=read_session(),
+            maxTimeMS=app.config["SEARCH_MAX_TIME_MS"]))
+    else:
+        bookings = list(read_db().meter_installs.find(
+            dict(query, **after_key), SEARCH_RESULT_FIELDS,
+            session=read_session()).sort(sort).limit(
+                page_size + 1).max_time_ms(app.config["SEARCH_MAX_TIME_MS"]))
+    next_cursor = encode_search_cursor(
+        bookings[page_size - 1], sort) if len(bookings) > page_size else None
+    return bookings[:page_size], next_cursor
+
+
+def backfill_normalized_postcodes(batch_size):
+    # Set postcode_normalized on bookings made before it was added.
+    # Missing fields are indexed as null, so each batch is found with
+    # the postcode_normalized index.  Returns the number updated.
+    updated = 0
+    while True:
+        batch = list(mongo.db.meter_installs.find(
+            {"postcode_normalized": None}, {"postcode": 1}).limit(batch_size))
+        if not batch:
+            return updated
+        updated += mongo.db.meter_installs.bulk_write([UpdateOne(
+            {"_id": booking["_id"]},
+            {"$set": {"postcode_normalized": normalize_postcode(
+                booking["postcode"])}}) for booking in batch],
+            ordered=False).modified_count
+
+
+# Supplier export.
+# The booking fields a supplier receives, after the booking ID.
+EXPORT_FIELDS = [
+    "meter_id",
+    "meter_serial_number",
+    "first_address_line",
+    "second_address_line",
+    "third_address_line",
+    "town",
+    "county",
+    "postcode",
+    "supplier_acc_no",
+    "install_date",
+    "supplier_authorisation"
+]
+EXPORT_FORMATS = {"csv": "text/csv", "ndjson": "application/x-ndjson"}
+
+
+def export_query(supplier, start=None, end=None, after=None):
+    # Filter for a suppliers bookings installed from start up to (not
+    # including) end, after the booking ID after.
+    query = {"supplier": supplier}
+    if start or end:
+        query["install_date"] = {}
+        if start:
+            query["install_date"]["$gte"] = start
+        if end:
+            query["install_date"]["$lt"] = end
+    if after:
+        query["_id"] = {"$gt": after}
+    return query
+
+
+def export_values(booking):
+    values = [str(booking["_id"])]
+    for field in EXPORT_FIELDS:
+        value = booking.get(field)
+        values.append(value.strftime("%Y-%m-%d") if isinstance(
+            value, datetime) else value)
+    return values
+
+
+def export_lines(bookings, export_format):
+    # Format a batch of bookings as CSV rows or NDJSON lines.
+    if export_format == "csv":
+        return csv_lines([export_values(booking) for booking in bookings])
+    keys = ["id"] + EXPORT_FIELDS
+    return "".join(json.dumps(dict(zip(keys, export_values(booking)))) + "\n"
+                   for booking in bookings)
+
+
+def export_bookings_text(query, export_format):
+    # Yield the bookings matching an export_query as CSV or NDJSON, in
+    # _id order, one batch of EXPORT_BATCH_SIZE bookings at a time.
+    # Only one batch is ever held in memory, however many bookings
+    # there are.  Every row starts with the booking ID, so an export
+    # that was cut short can carry on after the last ID received.
+    batch_size = app.config["EXPORT_BATCH_SIZE"]
+    cursor = read_db().meter_installs.find(
+        query, dict.fromkeys(EXPORT_FIELDS, 1), collation=SUPPLIER_COLLATION,
+        session=read_session()).sort("_id", ASCENDING).batch_size(batch_size)
+    if export_format == "csv":
+        yield csv_lines([["id"] + EXPORT_FIELDS])
+    batch = []
+    for booking in cursor:
+        batch.append(booking)
+        if len(batch) == batch_size:
+            yield export_lines(batch, export_format)
+            batch = []
+    if batch:
+        yield export_lines(batch, export_format)
+
+
+def gzip_stream(chunks, level):
+    # Compress text chunks into one gzip stream as they are produced.
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    for chunk in chunks:
+        data = compressor.compress(chunk.encode())
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+# Install date capacity.
+# The install_capacity collection holds a booking counter for each day
+# (_id "2027-03-01") and for each postcode area on each day (_id
+# "2027-03-01:LS").  A booking takes a place in both of its slots.
+AVAILABILITY_MAX_DAYS = 732
+# validate_postcode accepts postcodes that don't start with letters
+# (e.g. "123456").  They all share one area.
+UNKNOWN_POSTCODE_AREA = "OTHER"
+capacity_cache = {}
+capacity_cache_lock = threading.Lock()
+capacity_stats = {
+    "reserved": 0,
+    "released": 0,
+    "rejected_full": 0
+}
+
+
+def postcode_area(postcode):
+    match = POSTCODE_AREA_PATTERN.match(postcode)
+    return match.group().upper() if match else UNKNOWN_POSTCODE_AREA
+
+
+def install_slots(install_date, postcode):
+    # The capacity slots a booking takes, as (_id, date, area).
+    # area is None for the whole day.
+    day = install_date.strftime("%Y-%m-%d")
+    area = postcode_area(postcode)
+    return [(day, install_date, None),
+            ("{}:{}".format(day, area), install_date, area)]
+
+
+def booking_slots(booking):
+    return install_slots(booking["install_date"], booking["postcode"])
+
+
+def slot_capacity(slot):
+    return app.config["CAPACITY_PER_AREA" if slot[2] else "CAPACITY_PER_DAY"]
+
+
+def reserve_slot(slot, places=1):
+    # Take places in a slot, all or none.  The counter is only
+    # incremented while that leaves it within capacity; on a full slot
+    # the filter doesn't match, the upsert tries to insert a second
+    # document with the same _id and the unique _id index rejects it.
+    # (A slot that doesn't exist yet is upserted, so places must be no
+    # more than its capacity.)
+    slot_id, install_date, area = slot
+    return UpdateOne(
+        {"_id": slot_id, "count": {"$lte": slot_capacity(slot) - places}},
+        {"$inc": {"count": places},
+         "$setOnInsert": {"date": install_date, "area": area}},
+        upsert=True)
+
+
+def reserve_slots(slots):
+    # Take a place in each slot.  Returns False (having given back any
+    # places already taken) if any slot is full.
+    taken = []
+    for slot in slots:
+        try:
+            mongo.db.install_capacity.bulk_write([reserve_slot(slot)])
+        except BulkWriteError as e:
+            release_slots(taken)
+            if e.details["writeErrors"][0]["code"] != 11000:
+                raise
+            with capacity_cache_lock:
+                capacity_stats["rejected_full"] += 1
+            return False
+        taken.append(slot)
+        with capacity_cache_lock:
+            capacity_stats["reserved"] += 1
+    return True
+
+
+def reserve_many_slots(slot_lists):
+    # Take a place in each slot of each booking in a list, as
+    # reserve_slots would, but with one bulk write taking all of the
+    # places in each slot.  A slot without room for all of them is left
+    # alone and its bookings are reserved one by one instead, so only
+    # bookings that don't fit are turned away.  Returns whether each
+    # booking got its places.
+    wanted = OrderedDict()
+    for slots in slot_lists:
+        for slot in slots:
+            wanted[slot] = wanted.get(slot, 0) + 1
+    # A slot can never take more places than its capacity.
+    short = {slot for slot, places in wanted.items()
+             if places > slot_capacity(slot)}
+    wanted = [(slot, places) for slot, places in wanted.items()
+              if slot not in short]
+    if wanted:
+        try:
+            mongo.db.install_capacity.bulk_write(
+                [reserve_slot(slot, places) for slot, places in wanted],
+                ordered=False)
+        except BulkWriteError as e:
+            short.update(wanted[error["index"]][0]
+                         for error in e.details["writeErrors"])
+    with capacity_cache_lock:
+        capacity_stats["reserved"] += sum(
+            places for slot, places in wanted if slot not in short)
+    # Bookings in a short slot give back the places they got in the
+    # others, then try again on their own.
+    retry = [slots for slots in slot_lists
+             if any(slot in short for slot in slots)]
+    release_slots([slot for slots in retry
+                   for slot in slots if slot not in short])
+    return [reserve_slots(slots) if any(slot in short for slot in slots)
+            else True for slots in slot_lists]
+
+
+def release_slots(slots):
+    # Give back a place in each slot, with one bulk write.
+    freed = OrderedDict()
+    for slot in slots:
+        freed[slot[0]] = freed.get(slot[0], 0) + 1
+    if not freed:
+        return
+    mongo.db.install_capacity.bulk_write([UpdateOne(
+        {"_id": slot_id, "count": {"$gte": places}},
+        {"$inc": {"count": -places}}) for slot_id, places in freed.items()],
+        ordered=False)
+    with capacity_cache_lock:
+        capacity_stats["released"] += len(slots)
+
+
+def capacity_calendar(area=None):
+    # Bookings per day from today on, keyed by "YYYY-MM-DD", for every
+    # postcode area (None) or one of them.  Read from install_capacity
+    # (never meter_installs) and cached for CAPACITY_CACHE_TTL seconds.
+    now = time.monotonic()
+    with capacity_cache_lock:
+        entry = capacity_cache.get(area)
+    if entry and entry[0] > now:
+        return entry[1]
+    today = datetime.combine(datetime.utcnow().date(), datetime.min.time())
+    counts = {slot["_id"].split(":")[0]: slot["count"]
+              for slot in mongo.db.install_capacity.find(
+                  {"area": area, "date": {"$gte": today}}, {"count": 1})}
+    with capacity_cache_lock:
+        capacity_cache[area] = (now + app.config["CAPACITY_CACHE_TTL"],
+                                counts)
+    return counts
 
 
-def validate_id(id):
-    # Validate if id is in right format for MongoDB object.
-    # Solution from:
-    # https://stackoverflow.com/questions/28774526/how-to-check-that-mongo-objectid-is-valid-in-python
-    return bson.objectid.ObjectId.is_valid(id)
+def rebuild_capacity():
+    # Recount every slot from the bookings, e.g. if a crash left a
+    # counter out.  Returns the number of slots written.
+    counts = {}
+    for booking in mongo.db.meter_installs.find(
+            {}, {"_id": 0, "install_date": 1, "postcode": 1}):
+        for slot in booking_slots(booking):
+            counts[slot] = counts.get(slot, 0) + 1
+    mongo.db.install_capacity.delete_many(
+        {"_id": {"$nin": [slot_id for slot_id, _, _ in counts]}})
+    for (slot_id, install_date, area), count in counts.items():
+        mongo.db.install_capacity.replace_one(
+            {"_id": slot_id},
+            {"date": install_date, "area": area, "count": count},
+            upsert=True)
+    with capacity_cache_lock:
+        capacity_cache.clear()
+    return len(counts)
 
 
-def validate_name(name):
-    # Validates users first & last names.
-    # Only allow letters and hyphens.  No spaces.
-    return re.match("^[a-zA-Z-]{0,30}$", name)
+@stats_source("capacity")
+def capacity_report():
+    with capacity_cache_lock:
+        return dict(capacity_stats)
 
 
-def validate_pw(pw):
-    # Validate users passwords.
-    # Allow any characters, length 6-15 characters only.
-    return re.match("^.{6,15}$", pw)
+# Booking statistics.
+# Counts of bookings per supplier, county, town, property type and
+# install week are kept in one booking_stats document, updated by every
+# route that writes bookings, so the dashboard reads one small document
+# instead of aggregating meter_installs.
+BOOKING_STATS_ID = "bookings"
+BOOKING_STATS_REBUILD_ID = "bookings-rebuild"
+BOOKING_STATS_DIMENSIONS = OrderedDict([
+    ("supplier", "Supplier"),
+    ("county", "County"),
+    ("town", "Town"),
+    ("property_type", "Property Type"),
+    ("install_week", "Install Week"),
+])
+# The fields of a booking the statistics are counted from.
+BOOKING_STATS_FIELDS = {
+    "supplier": 1,
+    "county": 1,
+    "town": 1,
+    "property_type": 1,
+    "install_date": 1
+}
 
 
-def validate_meter_id(id):
-    # Validation meter id.
-    # Allow only numbers, no spaces, must be length of 13 characters.
-    return re.match("^[0-9]{13}$", id)
+def booking_stats_keys(booking):
+    # The counters a booking is counted in, e.g. "supplier.eon".
+    # Names are lower case so "Leeds" and "leeds" are the same town.
+    # The validators only allow letters, digits and spaces, so every
+    # name is a safe field name.
+    keys = ["total"] + ["{}.{}".format(field, booking[field].lower())
+                        for field in BOOKING_STATS_DIMENSIONS
+                        if field != "install_week"]
+    keys.append("install_week." + booking["install_date"].strftime("%G-W%V"))
+    return keys
 
 
-def validate_MSN(msn):
-    # Validate meter serial number.
-    # Allow only number and letters, no spaces, length 0-12 characters.
-    return re.match("^[a-zA-Z0-9]{0,12}$", msn)
+def booking_stats_delta(added=(), removed=()):
+    # The $inc that counts the added bookings and uncounts the removed
+    # ones.  Counters that don't change are left out.
+    inc = {}
+    for bookings, step in [(added, 1), (removed, -1)]:
+        for booking in bookings:
+            for key in booking_stats_keys(booking):
+                inc[key] = inc.get(key, 0) + step
+    return {key: step for key, step in inc.items() if step}
 
 
-def validate_address(address):
-    # Validate address lines (1st, 2nd & 3rd)
-    # Allow only numbers, letters and spaces, max length 50 characters.
-    return re.match("^[a-zA-Z0-9 ]{0,50}$", address)
+def record_booking_stats(added=(), removed=()):
+    # Count new bookings (added), deleted bookings (removed) or a
+    # changed booking (both, with its old version removed).
+    inc = booking_stats_delta(added, removed)
+    if not inc:
+        return
+    mongo.db.booking_stats.update_one(
+        {"_id": BOOKING_STATS_ID}, {"$inc": inc}, upsert=True)
+    if not removed:
+        return
+    # A rebuild that is running has already counted the bookings up to
+    # its checkpoint, so changes to those are made to its counts too.
+    # Later bookings are counted as they are when it gets to them.
+    rebuild = mongo.db.booking_stats.find_one(
+        {"_id": BOOKING_STATS_REBUILD_ID}, {"after": 1})
+    if rebuild:
+        counted = {booking["_id"] for booking in removed
+                   if booking["_id"] <= rebuild["after"]}
+        inc = booking_stats_delta(
+            [booking for booking in added if booking["_id"] in counted],
+            [booking for booking in removed if booking["_id"] in counted])
+        if inc:
+            mongo.db.booking_stats.update_one(
+                {"_id": BOOKING_STATS_REBUILD_ID}, {"$inc": inc})
 
 
-def validate_postcode(postcode):
-    # Validate postcodes.
-    # Allow only numbers, letters and spaces, length 6-8 characters.
-    return re.match("^[a-zA-Z0-9 ]{6,8}$", postcode)
+def rebuild_booking_stats(batch_size, restart=False):
+    # Recount the statistics from meter_installs into a separate
+    # document, in _id order, then swap it in.  The counts and the
+    # checkpoint (the last _id counted) are saved together after each
+    # batch, so a rebuild that is stopped carries on where it left off
+    # unless restart is set.  Returns the number of bookings counted by
+    # this run.
+    if restart:
+        mongo.db.booking_stats.delete_one({"_id": BOOKING_STATS_REBUILD_ID})
+    mongo.db.booking_stats.update_one(
+        {"_id": BOOKING_STATS_REBUILD_ID},
+        {"$setOnInsert": {"after": ObjectId("0" * 24),
+                          "started": datetime.utcnow()}},
+        upsert=True)
+    counted = 0
+    while True:
+        after = mongo.db.booking_stats.find_one(
+            {"_id": BOOKING_STATS_REBUILD_ID})["after"]
+        batch = list(mongo.db.meter_installs.find(
+            {"_id": {"$gt": after}}, BOOKING_STATS_FIELDS).sort(
+                "_id", ASCENDING).limit(batch_size))
+        if not batch:
+            break
+        update = {"$set": {"after": batch[-1]["_id"]}}
+        inc = booking_stats_delta(added=batch)
+        if inc:
+            update["$inc"] = inc
+        mongo.db.booking_stats.update_one(
+            {"_id": BOOKING_STATS_REBUILD_ID, "after": after}, update)
+        counted += len(batch)
+    stats = mongo.db.booking_stats.find_one(
+        {"_id": BOOKING_STATS_REBUILD_ID})
+    for field in ["_id", "after", "started"]:
+        stats.pop(field)
+    stats["rebuilt"] = datetime.utcnow()
+    mongo.db.booking_stats.replace_one(
+        {"_id": BOOKING_STATS_ID}, stats, upsert=True)
+    mongo.db.booking_stats.delete_one({"_id": BOOKING_STATS_REBUILD_ID})
+    return counted
 
 
-def validate_text(text):
-    # Validate text inputs.
-    # Allow only letters and spaces.
-    return re.match("[a-zA-Z ]+$", text)
+def booking_stats_tables(stats):
+    # Turn the statistics document into (label, [(name, count), ...])
+    # tables for the dashboard.  Weeks are listed in order and
+    # everything else busiest first.  Counters that have gone back to
+    # zero are left out.
+    tables = []
+    for field, label in BOOKING_STATS_DIMENSIONS.items():
+        rows = [(name, count) for name, count in stats.get(
+            field, {}).items() if count]
+        if field == "install_week":
+            rows.sort()
+        else:
+            rows.sort(key=lambda row: (-row[1], row[0]))
+        tables.append((label, rows))
+    return tables
 
 
-def validate_alphanumeric(text):
-    # Validate text inputs.
-    # Allow only numbers, letters, spaces and full stops.
-    return re.match("[a-zA-Z0-9 .]+$", text)
+# Cached pages.
+# Pages listed here are rendered once per process for signed out
+# visitors, signed in users and signed in admins.  Signed in pages are
+# rendered as a stand-in user and the stand-in's Account link is
+# swapped for the real one on each request, and flash messages are
+# filled into the FLASH_PLACEHOLDER.
+CACHED_PAGES = ["index.html", "404.html"]
+# The kinds of visitor a cached page is rendered for, as
+# (signed in, admin).
+CACHED_PAGE_VISITORS = [(False, False), (True, False), (True, True)]
+CACHED_PAGE_USER = "cached-page-user@example.invalid"
+FLASH_PLACEHOLDER = "<!-- flash messages -->"
+page_cache = {}
+page_cache_lock = threading.Lock()
 
 
-def validate_yes_no(text):
-    # Validate that the input is eiter yes or no.
-    return text == "yes" or text == "no"
+def build_cached_page(template_name, signed_in, admin=False):
+    # Render a page outside of any real request, as a signed out
+    # visitor or as the stand-in user (given the admin links if admin).
+    with app.test_request_context():
+        if signed_in:
+            session["user_email_address"] = CACHED_PAGE_USER
+        return flask_render_template(
+            template_name, flash_placeholder=FLASH_PLACEHOLDER,
+            is_admin=lambda: admin), url_for(
+                "account", username=CACHED_PAGE_USER)
 
 
-def validate_property_type(text):
-    # Validate that the input is eiter residential or commercial.
-    return text == "residential" or text == "commercial"
+def warm_page_cache():
+    # Render every cached page up front.
+    for template_name in CACHED_PAGES:
+        for signed_in, admin in CACHED_PAGE_VISITORS:
+            cached = build_cached_page(template_name, signed_in, admin)
+            with page_cache_lock:
+                page_cache[(template_name, signed_in, admin)] = cached
 
 
-def validate_supplier(text):
-    # Validate supplier input.
-    # Allow only numbers, letters and spaces, max length 30 characters.
-    return re.match("^[a-zA-Z0-9 ]{0,30}$", text)
+def render_cached_page(template_name, status=200):
+    # Serve a page from page_cache, rendering only the parts that depend
+    # on the visitor.  Repeat visitors get a 304 if nothing has changed.
+    if not app.config["PAGE_CACHE"]:
+        return render_template(template_name), status
+    email = session.get("user_email_address")
+    key = (template_name, bool(email), is_admin())
+    with page_cache_lock:
+        cached = page_cache.get(key)
+    if cached is None:
+        cached = build_cached_page(*key)
+        with page_cache_lock:
+            page_cache[key] = cached
+    body, stand_in_url = cached
+    if email:
+        body = body.replace(stand_in_url, str(escape(url_for(
+            "account", username=email))))
+    # Flash messages are only shown once, so a page showing
+    # them mustn't be cached by the browser.  Pages without a
+    # placeholder leave them for the next page that has one.
+    has_flashes = (FLASH_PLACEHOLDER in body
+                   and bool(session.get("_flashes")))
+    body = body.replace(FLASH_PLACEHOLDER, render_template(
+        "flashes.html") if has_flashes else "")
+    response = make_response(body, status)
+    if has_flashes:
+        response.headers["Cache-Control"] = "no-store"
+    else:
+        # Browsers must check back each time, but get a
+        # 304 Not Modified if the page is the same.
+        response.cache_control.no_cache = True
+        if email:
+            response.cache_control.private = True
+        if status == 200:
+            response.set_etag(hashlib.sha1(body.encode()).hexdigest())
+            response.make_conditional(request)
+    return response
 
 
-def validate_account(text):
-    # Validate supplier account number input.
-    # Account numbers may have letters and forward slashes.
-    # Allow only numbers, letters, spaces and
-    # forward slashes, max length 20 characters.
-    return re.match("^[a-zA-Z0-9 /-]{0,20}$", text)
+# Static assets.
+# "flask build-assets" copies the static folder to ASSET_DIR with a hash
+# of each file's contents in its name, and records the hashed names in
+# a manifest.  A file's name changes whenever its contents do, so the
+# copies can be served from /assets with a cache lifetime of a year.
+ASSET_MANIFEST = "manifest.json"
+ASSET_MAX_AGE = 365 * 24 * 60 * 60
+RESIZABLE_IMAGES = (".jpg", ".jpeg", ".png")
+# Files in the static folder that aren't part of the site.
+ASSET_EXCLUDE = ["images/readme-images"]
+# Images are already compressed, so only text files get .br/.gz copies.
+COMPRESSIBLE_ASSETS = (".css", ".js", ".svg")
+# Precompressed copies in the order they are preferred.
+ASSET_ENCODINGS = [("br", ".br"), ("gzip", ".gz")]
+CSS_COMMENT_PATTERN = re.compile(r"/\*.*?\*/", re.S)
+CSS_SPACE_PATTERN = re.compile(r"\s*([{};,>])\s*")
+CSS_URL_PATTERN = re.compile(r"url\(\s*['\"]?([^'\")]+?)['\"]?\s*\)")
+CSS_BACKGROUND_PATTERN = re.compile(
+    r"([^{};]+)\{[^{}]*background-image:\s*url\(\s*['\"]?([^'\")]+)")
+asset_manifest = None
 
 
-def validate_meter_read(read):
-    # Validate meter read inputs.
-    # Allow only numbers, length 0-8 characters.
-    return re.match("^[0-9]{0,8}$", read)
+def fingerprint(name, content):
+    # Add a hash of the contents to a file name,
+    # e.g. css/style.css -> css/style.1a2b3c4d5e.css
+    root, ext = os.path.splitext(name)
+    return "{}.{}{}".format(
+        root, hashlib.sha256(content).hexdigest()[:10], ext)
 
 
-def validate_date(date):
-    # Validate date inputs.
-    # Allow only numbers and for slashes, must be length of 8 characters.
-    return re.match("^[0-9/]{10}$", date)
+def write_asset(manifest, name, content):
+    # Write a fingerprinted copy of a file to ASSET_DIR, along with
+    # brotli and gzip copies of text files where they are smaller.
+    hashed = fingerprint(name, content)
+    path = os.path.join(app.config["ASSET_DIR"], hashed)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "wb") as f:
+        f.write(content)
+    if name.endswith(COMPRESSIBLE_ASSETS):
+        compressed = {"gzip": gzip.compress(content, 9, mtime=0)}
+        if brotli:
+            compressed["br"] = brotli.compress(content)
+        encodings = []
+        for encoding, suffix in ASSET_ENCODINGS:
+            if len(compressed.get(encoding, content)) < len(content):
+                with open(path + suffix, "wb") as f:
+                    f.write(compressed[encoding])
+                encodings.append(encoding)
+        manifest["encodings"][hashed] = encodings
+    return hashed
 
 
-app = Flask(__name__)
+def build_image(manifest, name, content):
+    # Fingerprint an image and, if Pillow is installed, write resized
+    # and WebP copies of it for srcset and the CSS backgrounds.
+    hashed = write_asset(manifest, name, content)
+    if Image is None or not name.lower().endswith(RESIZABLE_IMAGES):
+        return hashed
+    root, ext = os.path.splitext(name)
+    variants = []
+    with Image.open(io.BytesIO(content)) as original:
+        image_format = original.format
+        source = original.convert("RGBA") if original.mode == "P" else (
+            original)
+        width, height = source.size
+        # Nothing wider than the widest ASSET_IMAGE_WIDTHS is served.
+        widest = min(width, max(app.config["ASSET_IMAGE_WIDTHS"]))
+        widths = sorted(set(
+            w for w in app.config["ASSET_IMAGE_WIDTHS"] if w < widest))
+        for variant_width in widths + [widest]:
+            resized = source if variant_width == width else source.resize(
+                (variant_width, round(height * variant_width / width)),
+                Image.LANCZOS)
+            size = None
+            for variant_ext, variant_format in [
+                    (ext, image_format), (".webp", "WEBP")]:
+                if variant_width == width and variant_ext == ext:
+                    variant, size = hashed, len(content)
+                else:
+                    buffer = io.BytesIO()
+                    resized.save(
+                        buffer, variant_format, quality=80, optimize=True)
+                    # A WebP copy that is bigger than the
+                    # JPG/PNG it was made from is no use.
+                    if size is not None and len(buffer.getvalue()) >= size:
+                        continue
+                    size = len(buffer.getvalue())
+                    variant = write_asset(
+                        manifest,
+                        "{}-{}w{}".format(root, variant_width, variant_ext),
+                        buffer.getvalue())
+                variants.append([
+                    variant_width, mimetypes.guess_type(variant)[0], variant])
+    manifest["variants"][name] = variants
+    return hashed
 
-app.config["MONGO_DBNAME"] = os.environ.get("MONGO_DBNAME")
-app.config["MONGO_URI"] = os.environ.get("MONGO_URI")
-app.secret_key = os.environ.get("SECRET_KEY")
 
-mongo = PyMongo(app)
+def minify_css(css):
+    css = CSS_COMMENT_PATTERN.sub("", css)
+    css = CSS_SPACE_PATTERN.sub(r"\1", " ".join(css.split()))
+    return css.replace(": ", ":").replace(";}", "}").strip()
+
+
+def minify_js(js):
+    # Only drop indentation, blank lines and whole line comments.
+    # Line breaks are kept so semicolon insertion still works.
+    lines = (line.strip() for line in js.splitlines())
+    return "\n".join(
+        line for line in lines if line and not line.startswith("//"))
+
+
+def build_css(manifest, name, content):
+    # Minify a stylesheet, point its urls at the fingerprinted images
+    # and add media queries that swap each background image for its
+    # resized and WebP copies.
+    css = minify_css(content.decode("utf-8"))
+
+    def static_name(url):
+        # The backgrounds are linked with absolute GitHub urls
+        # so the stylesheet also works when opened on its own.
+        if "/static/" in url:
+            return url.split("/static/", 1)[1]
+        if not url.startswith(("http:", "https:", "data:", "/")):
+            return posixpath.normpath(
+                posixpath.join(posixpath.dirname(name), url))
+        return None
+
+    def relative(hashed):
+        # The stylesheet is served from the same folder
+        # structure, so it can link to the copies relatively.
+        return posixpath.relpath(hashed, posixpath.dirname(name))
+
+    def rewrite_url(match):
+        static_file = static_name(match.group(1))
+        if static_file not in manifest["files"]:
+            return match.group(0)
+        return "url({})".format(relative(manifest["files"][static_file]))
+
+    backgrounds = CSS_BACKGROUND_PATTERN.findall(css)
+    css = CSS_URL_PATTERN.sub(rewrite_url, css)
+    overrides = OrderedDict()
+    for selector, url in backgrounds:
+        by_width = OrderedDict()
+        for width, mimetype, variant in manifest["variants"].get(
+                static_name(url), []):
+            by_width.setdefault(width, []).append((mimetype, variant))
+        # The widest copy is the original size, which is used unless
+        # the screen is narrow enough for a smaller copy.  Widest
+        # first so the narrowest matching media query wins.
+        for i, width in enumerate(reversed(by_width)):
+            variants = by_width[width]
+            image_set = ",".join('url({}) type("{}")'.format(
+                relative(variant), mimetype)
+                for mimetype, variant in reversed(variants))
+            overrides.setdefault(None if i == 0 else width, []).append(
+                "{}{{background-image:url({});background-image:"
+                "image-set({})}}".format(
+                    selector.strip(), relative(variants[0][1]), image_set))
+    for width, rules in sorted(
+            overrides.items(), key=lambda item: -(item[0] or 1e9)):
+        if width is None:
+            css += "".join(rules)
+        else:
+            css += "@media (max-width:{}px){{{}}}".format(
+                width, "".join(rules))
+    return write_asset(manifest, name, css.encode("utf-8"))
+
+
+def build_assets():
+    # Rebuild ASSET_DIR from the static folder and write the manifest.
+    asset_dir = os.path.abspath(app.config["ASSET_DIR"])
+    shutil.rmtree(asset_dir, ignore_errors=True)
+    names = []
+    for root, dirs, files in os.walk(app.static_folder):
+        dirs[:] = [d for d in dirs if os.path.abspath(
+            os.path.join(root, d)) != asset_dir]
+        for filename in files:
+            name = os.path.relpath(
+                os.path.join(root, filename),
+                app.static_folder).replace(os.sep, "/")
+            if not name.startswith(tuple(
+                    excluded + "/" for excluded in ASSET_EXCLUDE)):
+                names.append(name)
+    manifest = {"files": {}, "variants": {}, "encodings": {}}
+    # Images go first so the stylesheets can link to their hashed names.
+    for name in sorted(names, key=lambda n: (n.endswith(".css"), n)):
+        with open(os.path.join(app.static_folder, name), "rb") as f:
+            content = f.read()
+        if name.endswith(".css"):
+            manifest["files"][name] = build_css(manifest, name, content)
+        elif name.endswith(".js"):
+            manifest["files"][name] = write_asset(
+                manifest, name, minify_js(content.decode("utf-8")).encode(
+                    "utf-8"))
+        else:
+            manifest["files"][name] = build_image(manifest, name, content)
+    with open(os.path.join(asset_dir, ASSET_MANIFEST), "w") as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    return manifest
+
+
+def get_asset_manifest():
+    # Load the manifest once per process.  If "flask build-assets"
+    # hasn't been run the static files are served as they are.
+    global asset_manifest
+    if asset_manifest is None:
+        try:
+            with open(os.path.join(
+                    app.config["ASSET_DIR"], ASSET_MANIFEST)) as f:
+                asset_manifest = json.load(f)
+        except FileNotFoundError:
+            asset_manifest = {"files": {}, "variants": {}, "encodings": {}}
+    return asset_manifest
+
+
+@app.template_global()
+def asset_url(filename):
+    # Use instead of url_for("static", ...) to link to
+    # the fingerprinted copy of a static file.
+    hashed = get_asset_manifest()["files"].get(filename)
+    if hashed is None:
+        return url_for("static", filename=filename)
+    return url_for("asset", filename=hashed)
+
+
+@app.template_global()
+def asset_srcset(filename, mimetype=None):
+    # srcset listing an images resized copies of the given type
+    # (by default the same type as the image itself).
+    mimetype = mimetype or mimetypes.guess_type(filename)[0]
+    return ", ".join(
+        "{} {}w".format(url_for("asset", filename=variant), width)
+        for width, variant_type, variant in get_asset_manifest()[
+            "variants"].get(filename, [])
+        if variant_type == mimetype)
+
+
+@app.before_first_request
+def startup():
+    # The indexes are built by "flask create-indexes" when the app is
+    # deployed (see Procfile), not here, so a build that fails or takes
+    # a while can't hold up or fail every request.
+    # Render the cached pages.
+    if app.config["PAGE_CACHE"]:
+        warm_page_cache()
+    # Start this processes purge worker thread.
+    if app.config["PURGE_WORKER_THREAD"]:
+        threading.Thread(target=purge_worker, daemon=True).start()
+    # Build the booked meter ID filter, and keep it fresh.
+    if app.config["METER_FILTER"]:
+        threading.Thread(target=meter_filter_worker, daemon=True).start()
 
 
 @app.route("/")
 def home():
-    return render_template("index.html")
+    return render_cached_page("index.html")
+
+
+@app.route("/assets/<path:filename>")
+def asset(filename):
+    # Serve a fingerprinted file from ASSET_DIR, precompressed if the
+    # browser accepts it.  The name changes whenever the file does,
+    # so browsers never need to check back.
+    for encoding, suffix in ASSET_ENCODINGS:
+        if encoding in get_asset_manifest()["encodings"].get(
+                filename, []) and request.accept_encodings[encoding]:
+            response = send_from_directory(
+                app.config["ASSET_DIR"], filename + suffix,
+                mimetype=mimetypes.guess_type(filename)[0])
+            response.content_encoding = encoding
+            break
+    else:
+        response = send_from_directory(app.config["ASSET_DIR"], filename)
+    response.vary.add("Accept-Encoding")
+    response.cache_control.public = True
+    response.cache_control.max_age = ASSET_MAX_AGE
+    response.cache_control.immutable = True
+    return response
 
 
 @app.route("/register", methods=["GET", "POST"])
@@ -154,6 +2941,12 @@ def register():
 
         # If it does, display a flash message informing user that an
         # account already exists for this email address.
+        # A deleted account holds on to its email address until all of
+        # its bookings have been removed.
+        if existing_user and existing_user.get("deleted"):
+            flash("This account is still being deleted. "
+                  "Please try again in a few minutes.")
+            return redirect(url_for("register"))
         if existing_user:
             flash("Account already exists for this email address.")
             return redirect(url_for("register"))
@@ -164,12 +2957,13 @@ def register():
             "first_name": request.form.get("first-name").lower(),
             "last_name": request.form.get("last-name").lower(),
             "user_email_address": request.form.get("email").lower(),
-            "password": generate_password_hash(request.form.get("password"))
+            "password": hash_password(request.form.get("password"))
         }
         mongo.db.users.insert_one(record)
 
         # Put the new users email address into session cookie and
         # display flash success message using their first name.
+        rotate_session()
         session["user_email_address"] = request.form.get("email").lower()
         flash("Registration successful")
         # Redirect to account(username) function where
@@ -214,12 +3008,20 @@ def signin():
         # Check if username exists in db
         existing_user = mongo.db.users.find_one(
             {"user_email_address": request.form.get("email").lower()})
-        # If user exists in database:
-        if existing_user:
+        # If user exists in database (and hasn't deleted their account):
+        if existing_user and not existing_user.get("deleted"):
             # Ensure hashed password matches password input by user.
-            if check_password_hash(
+            if verify_password(
                     existing_user["password"], request.form.get("password")):
+                # If the stored hash was made with an older hashing
+                # policy, upgrade it now while we have the password.
+                if password_needs_rehash(existing_user["password"]):
+                    mongo.db.users.update_one(
+                        {"_id": existing_user["_id"]},
+                        {"$set": {"password": hash_password(
+                            request.form.get("password"))}})
                 # If so then put the users email address into session cookie.
+                rotate_session()
                 session["user_email_address"] = existing_user[
                         "user_email_address"].lower()
                 # And display flash success message.
@@ -256,25 +3058,39 @@ def account(username):
             if username == session["user_email_address"]:
                 # Use email address passed through in username variable
                 # to search users collection.  Asign results to user variable.
-                user = mongo.db.users.find_one(
-                    {"user_email_address": username})
+                # The profile never includes the users password.
+                # Even though it is hashed, I don't want to pass this
+                # through.
+                user = get_user_profile(username)
                 # Check whether any result is returned.
                 if user:
-                    # Remove the users password.
-                    # Even though it is hashed, I don't
-                    # want to pass this through.
-                    user.pop("password")
                     # Use email address passed through in username variable
                     # to search meter_installs collection.
-                    # Asign results to bookings.
-                    # Sort by install date and then address.
-                    bookings = list(mongo.db.meter_installs.find(
-                        {"user_email_address": username}).sort(
-                            [("install_date", 1), ("first_address_line", 1)]))
+                    # Only fetch one page of bookings, sorted by install
+                    # date and then address, and only the fields the
+                    # booking list displays.
+                    # The after/before cursors say which page to show.
+                    bookings, prev_cursor, next_cursor = fetch_bookings_page(
+                        {"user_email_address": username},
+                        app.config["ACCOUNT_PAGE_SIZE"],
+                        after=decode_cursor(request.args.get("after", "")),
+                        before=decode_cursor(request.args.get("before", "")))
+                    # The tab heading shows how many bookings there are
+                    # when they fit on one page, and "20+" (the page
+                    # size) when there are more, rather than counting
+                    # every booking on each load.
+                    if prev_cursor or next_cursor:
+                        booking_count = "{}+".format(
+                            app.config["ACCOUNT_PAGE_SIZE"])
+                    else:
+                        booking_count = len(bookings)
                     return render_template(
                             "account.html",
                             user=user,
-                            bookings=bookings)
+                            bookings=bookings,
+                            booking_count=booking_count,
+                            prev_cursor=prev_cursor,
+                            next_cursor=next_cursor)
                 # If email address is in session storage but no results found
                 # in users collection, something must have gone wrong.
                 # Redirect user to signout function.
@@ -303,6 +3119,8 @@ def signout():
     # in session variable. If so remove it from the session variable.
     if session["user_email_address"]:
         session.pop("user_email_address")
+        # Server-side sessions are also deleted from the session store.
+        rotate_session()
     # Display flash message and redirect user to signin page.
     flash("You have been signed out.")
     return redirect(url_for("signin"))
@@ -315,151 +3133,56 @@ def book():
         # If method is POST (i.e. form submitted),
         # add form data to meter installs collection.
         if request.method == "POST":
-            # Validate the data the user has provided is correct.
-            if request.form.get("meter_id") == "" or not validate_meter_id(
-               request.form.get("meter_id")):
-                flash("Invalid meter ID provided")
-                return render_template("book.html")
-            if request.form.get("meter_serial_number") != "":
-                if not validate_MSN(request.form.get("meter_serial_number")):
-                    flash("Invalid meter serial number provided")
-                    return render_template("book.html")
-            if request.form.get(
-                "first_address_line") == "" or not validate_address(
-                    request.form.get("first_address_line")):
-                flash("Invalid address provided")
-                return render_template("book.html")
-            if request.form.get("second_address_line") != "":
-                if not validate_address(request.form.get(
-                                        "second_address_line")):
-                    flash("Invalid address provided")
-                    return render_template("book.html")
-            if request.form.get("third_address_line") != "":
-                if not validate_address(request.form.get(
-                                        "third_address_line")):
-                    flash("Invalid address provided")
-                    return render_template("book.html")
-            if request.form.get("town") == "" or not validate_text(
-               request.form.get("town")):
-                flash("Invalid town/city provided")
-                return render_template("book.html")
-            if request.form.get("county") == "" or not validate_text(
-               request.form.get("county")):
-                flash("Invalid county provided")
-                return render_template("book.html")
-            if request.form.get("postcode") == "" or not validate_postcode(
-               request.form.get("postcode")):
-                flash("Invalid postcode provided")
-                return render_template("book.html")
-            if request.form.get(
-               "meter_location") == "" or not validate_alphanumeric(
-               request.form.get("meter_location")):
-                flash("Invalid meter location provided")
-                return render_template("book.html")
-            if request.form.get("access_instructions") != "":
-                if not validate_alphanumeric(request.form.get(
-                                             "access_instructions")):
-                    flash("Invalid access instructions provided")
-                    return render_template("book.html")
-            if request.form.get(
-               "parking_on_site") == "" or not validate_yes_no(
-               request.form.get("parking_on_site")):
-                flash("Please indicate if parking is available on site")
+            # Validate and convert the whole form in one pass.
+            booking, errors = validate_form(BOOKING_SCHEMA, request.form)
+            # If any of the data the user has provided is incorrect,
+            # display every problem found and return them to the form.
+            if errors:
+                for error in errors:
+                    flash(error)
                 return render_template("book.html")
-            if request.form.get(
-               "property_type") == "" or not validate_property_type(
-               request.form.get("property_type")):
-                flash("Please indicate the property type")
+            booking["user_email_address"] = session["user_email_address"]
+            booking["application_date"] = datetime.now()
+            booking["postcode_normalized"] = normalize_postcode(
+                booking["postcode"])
+            # Every change to a booking increments its version,
+            # which the JSON API uses for its ETags.
+            booking["version"] = 1
+            # First take a place on the install date (and in the postcode
+            # area that day).  If it's fully booked the user is asked to
+            # pick another date.
+            if not reserve_slots(booking_slots(booking)):
+                flash("Sorry, there are no installations left on " +
+                      request.form.get("install_date") +
+                      " in your area - please choose another date")
                 return render_template("book.html")
-            if request.form.get(
-               "supplier") == "" or not validate_supplier(
-               request.form.get("supplier")):
-                flash("Invalid supplier provided")
-                return render_template("book.html")
-            if request.form.get("supplier_acc_no") != "":
-                if not validate_account(
-                       request.form.get("supplier_acc_no")):
-                    flash("Invalid supplier account number provided")
-                    return render_template("book.html")
-            if request.form.get("meter_read_reg_1") != "":
-                if not validate_meter_read(
-                       request.form.get("meter_read_reg_1")):
-                    flash("Invalid meter read provided")
-                    return render_template("book.html")
-            if request.form.get("meter_read_reg_2") != "":
-                if not validate_meter_read(
-                       request.form.get("meter_read_reg_2")):
-                    flash("Invalid meter read provided")
-                    return render_template("book.html")
-            if request.form.get(
-               "install_date") == "" or not validate_date(
-               request.form.get("install_date")):
-                flash("Invalid installation date provided")
-                return render_template("book.html")
-            if request.form.get("supplier_authorisation") != "on":
-                flash("Please tick the supplier "
-                      "authorisation at the bottom of the form")
-                return render_template("book.html")
-
-            # Check whether there is a meter install
-            # already booked for this meter ID.
-            existing_booking = mongo.db.meter_installs.find_one(
-                {"meter_id": int(request.form.get("meter_id"))})
-            # If a record (booking) already exists for this meter ID,
-            # display a flash message to the user.
-            if existing_booking:
+            # Insert the booking dictionary into the meter_installs
+            # collection.  The unique index on meter_id rejects the insert
+            # if a booking already exists for this meter ID, so there is
+            # no need to look it up first (and two concurrent bookings
+            # can't both succeed).
+            # If the insert fails for any reason the places are given back.
+            try:
+                mongo.db.meter_installs.insert_one(booking)
+            except DuplicateKeyError:
+                release_slots(booking_slots(booking))
+                # If a record (booking) already exists for this meter ID,
+                # display a flash message to the user.
                 flash("A smart meter installation has already been"
                       " booked for Meter ID " + request.form.get("meter_id"))
                 return render_template("book.html")
-            # Else extract data from form and assign
-            # to keys in the booking dictionary.
-            else:
-                # Check whether the supplier authorisation is
-                # selected and asign True if so, False if not.
-                authorised = True if request.form.get(
-                    "supplier_authorisation") == "on" else False
-                booking = {
-                    "user_email_address": session["user_email_address"],
-                    "meter_id": int(request.form.get("meter_id")),
-                    "meter_serial_number": request.form.get(
-                        "meter_serial_number"),
-                    "first_address_line": request.form.get(
-                        "first_address_line"),
-                    "second_address_line": request.form.get(
-                        "second_address_line"),
-                    "third_address_line": request.form.get(
-                        "third_address_line"),
-                    "town": request.form.get("town"),
-                    "county": request.form.get("county"),
-                    "postcode": request.form.get("postcode"),
-                    "meter_location": request.form.get("meter_location"),
-                    "access_instructions": request.form.get(
-                        "access_instructions"),
-                    "parking_on_site": request.form.get("parking_on_site"),
-                    "property_type": request.form.get("property_type"),
-                    "supplier": request.form.get("supplier"),
-                    "supplier_acc_no": request.form.get("supplier_acc_no"),
-                    "meter_read_reg_1": int(request.form.get(
-                        "meter_read_reg_1"))
-                    if request.form.get("meter_read_reg_1") else "",
-                    "meter_read_reg_2": int(request.form.get(
-                        "meter_read_reg_2"))
-                    if request.form.get("meter_read_reg_2") else "",
-                    "install_date": datetime.strptime(
-                        request.form.get("install_date"), "%d/%m/%Y"),
-                    "supplier_authorisation": authorised,
-                    "application_date": datetime.now()
-                }
-                # Insert the booking dictionary into
-                # the meter_installs collection.
-                mongo.db.meter_installs.insert_one(booking)
-                # Display a flash message informing user
-                # that booking has been successful.
-                flash("Meter install successfully booked")
-                # Redirect to account(username) function where
-                # username is the users email address.
-                return redirect(url_for(
-                    "account", username=session["user_email_address"]))
+            except Exception:
+                release_slots(booking_slots(booking))
+                raise
+            note_meter_booked(booking["meter_id"])
+            record_booking_stats(added=[booking])
+            # Display a flash message informing user
+            # that booking has been successful.
+            flash("Meter install successfully booked")
+            # Redirect to account(username) function where
+            # username is the users email address.
+            return redirect(url_for(
+                "account", username=session["user_email_address"]))
         # If method is GET, render the Booking page.
         return render_template("book.html")
     # If the user is not signed in, redirect them to the Sign In page.
@@ -467,22 +3190,42 @@ def book():
     return redirect(url_for("signin"))
 
 
+@app.route("/book/bulk", methods=["GET", "POST"])
+def book_bulk():
+    # Check whether the user_email_address exists in the session variable.
+    if session.get("user_email_address"):
+        # If method is POST (i.e. file uploaded), book every row in it.
+        if request.method == "POST":
+            upload = request.files.get("bookings_csv")
+            if not upload or upload.filename == "":
+                flash("Please choose a CSV file to upload")
+                return render_template("book_bulk.html")
+            # Stream the report back while the file is processed so
+            # neither the file nor the report is held in memory.
+            response = Response(stream_with_context(bulk_booking_report(
+                upload.stream, session["user_email_address"])),
+                mimetype="text/csv")
+            response.headers["Content-Disposition"] = (
+                "attachment; filename=booking-report.csv")
+            return response
+        # If method is GET, render the Bulk Booking page.
+        return render_template("book_bulk.html")
+    # If the user is not signed in, redirect them to the Sign In page.
+    flash("Please sign in before trying to book a smart meter install")
+    return redirect(url_for("signin"))
+
+
 @app.route("/view_booking/<booking_id>")
 def view_booking(booking_id):
     # Check whether the user_email_address exists in the session variable.
     if session.get("user_email_address"):
-        # Check whether the booking_id is valid
-        if validate_id(booking_id):
-            # Find the record with the corresponding
-            # booking ID in the meter_installs collection.
-            booking = mongo.db.meter_installs.find_one(
-                {"_id": ObjectId(booking_id)})
-            # Check if booking exists and that the user_email_address
-            # matches the one in the session variable.
-            if booking and booking["user_email_address"] == session[
-               "user_email_address"]:
-                # If so, render the view_booking.html template.
-                return render_template("view_booking.html", booking=booking)
+        # Find the record with the corresponding booking ID in the
+        # meter_installs collection, if the booking_id is valid and
+        # the booking belongs to the user.
+        booking = find_own_booking(booking_id, session["user_email_address"])
+        if booking:
+            # If so, render the view_booking.html template.
+            return render_template("view_booking.html", booking=booking)
         # If the booking_id entered is not valid
         # return user to Account page with flash message.
         flash("The booking ID you are trying to find is not valid")
@@ -496,22 +3239,29 @@ def view_booking(booking_id):
 
 @app.route("/delete_booking/<booking_id>")
 def delete_booking(booking_id):
-    # Check whether the booking_id is valid
-    if validate_id(booking_id):
-        # Check whether there is a record in the
-        # meter_installs collection for that booking_id.
-        booking = mongo.db.meter_installs.find_one(
-            {"_id": ObjectId(booking_id)})
-        if booking:
-            # Find the booking in the meter_installs collection
-            # with the booking id that's been passed through and delete it.
-            mongo.db.meter_installs.delete_one({"_id": ObjectId(booking_id)})
-            # Display a flash message informing user
-            # that the booking has been deleted.
-            flash("Your meter install booking has been deleted")
-            # Redirect the user back to the account page.
-            return redirect(url_for(
-                "account", username=session["user_email_address"]))
+    # If the user is not signed in, redirect them to the Sign In page.
+    if not session.get("user_email_address"):
+        return redirect(url_for("signin"))
+    # Check whether the booking_id is valid and there is a record in the
+    # meter_installs collection for that booking_id that belongs to
+    # the user.
+    booking = find_own_booking(booking_id, session["user_email_address"])
+    if booking:
+        # Find the booking in the meter_installs collection
+        # with the booking id that's been passed through and delete it.
+        if mongo.db.meter_installs.delete_one(
+                {"_id": booking["_id"],
+                 "user_email_address": session["user_email_address"]}
+        ).deleted_count:
+            note_meter_released(booking["meter_id"])
+            release_slots(booking_slots(booking))
+            record_booking_stats(removed=[booking])
+        # Display a flash message informing user
+        # that the booking has been deleted.
+        flash("Your meter install booking has been deleted")
+        # Redirect the user back to the account page.
+        return redirect(url_for(
+            "account", username=session["user_email_address"]))
 
     # If there is no booking found with the booking_id passed through
     # return user to account page along with flash message.
@@ -527,194 +3277,94 @@ def update_booking(booking_id):
         # If method is POST (i.e. form submitted),
         # update the data in the meter_installs collection.
         if request.method == "POST":
-            # Retrieve the original booking from the meter_installs collection.
-            original_booking = mongo.db.meter_installs.find_one(
-                {"_id": ObjectId(booking_id)})
-            # Validate the data the user has provided is correct.
-            if request.form.get("meter_id") == "" or not validate_meter_id(
-               request.form.get("meter_id")):
-                flash("Invalid meter ID provided")
-                return render_template("update_booking.html",
-                                       booking=original_booking)
-            if request.form.get("meter_serial_number") != "":
-                if not validate_MSN(request.form.get("meter_serial_number")):
-                    flash("Invalid meter serial number provided")
-                    return render_template("update_booking.html",
-                                           booking=original_booking)
-            if request.form.get(
-                "first_address_line") == "" or not validate_address(
-                    request.form.get("first_address_line")):
-                flash("Invalid address provided")
-                return render_template("update_booking.html",
-                                       booking=original_booking)
-            if request.form.get("second_address_line") != "":
-                if not validate_address(request.form.get(
-                                        "second_address_line")):
-                    flash("Invalid address provided")
-                    return render_template("update_booking.html",
-                                           booking=original_booking)
-            if request.form.get("third_address_line") != "":
-                if not validate_address(request.form.get(
-                                        "third_address_line")):
-                    flash("Invalid address provided")
-                    return render_template("update_booking.html",
-                                           booking=original_booking)
-            if request.form.get("town") == "" or not validate_text(
-               request.form.get("town")):
-                flash("Invalid town/city provided")
-                return render_template("update_booking.html",
-                                       booking=original_booking)
-            if request.form.get("county") == "" or not validate_text(
-               request.form.get("county")):
-                flash("Invalid county provided")
-                return render_template("update_booking.html",
-                                       booking=original_booking)
-            if request.form.get("postcode") == "" or not validate_postcode(
-               request.form.get("postcode")):
-                flash("Invalid postcode provided")
-                return render_template("update_booking.html",
-                                       booking=original_booking)
-            if request.form.get(
-               "meter_location") == "" or not validate_alphanumeric(
-               request.form.get("meter_location")):
-                flash("Invalid meter location provided")
-                return render_template("update_booking.html",
-                                       booking=original_booking)
-            if request.form.get("access_instructions") != "":
-                if not validate_alphanumeric(request.form.get(
-                                             "access_instructions")):
-                    flash("Invalid access instructions provided")
-                    return render_template("update_booking.html",
-                                           booking=original_booking)
-            if request.form.get(
-               "parking_on_site") == "" or not validate_yes_no(
-               request.form.get("parking_on_site")):
-                flash("Please indicate if parking is available on site")
-                return render_template("update_booking.html",
-                                       booking=original_booking)
-            if request.form.get(
-               "property_type") == "" or not validate_property_type(
-               request.form.get("property_type")):
-                flash("Please indicate the property type")
-                return render_template("update_booking.html",
-                                       booking=original_booking)
-            if request.form.get(
-               "supplier") == "" or not validate_supplier(
-               request.form.get("supplier")):
-                flash("Invalid supplier provided")
+            # Retrieve the original booking from the meter_installs
+            # collection, if it exists and belongs to the user.
+            original_booking = find_own_booking(
+                booking_id, session["user_email_address"])
+            if not original_booking:
+                flash("The booking ID you are trying to find is not valid")
+                return redirect(url_for(
+                    "account", username=session["user_email_address"]))
+            # Validate and convert the whole form in one pass.
+            update, errors = validate_form(BOOKING_SCHEMA, request.form)
+            # If any of the data the user has provided is incorrect,
+            # display every problem found and return them to the form.
+            if errors:
+                for error in errors:
+                    flash(error)
                 return render_template("update_booking.html",
                                        booking=original_booking)
-            if request.form.get("supplier_acc_no") != "":
-                if not validate_account(
-                       request.form.get("supplier_acc_no")):
-                    flash("Invalid supplier account number provided")
-                    return render_template("update_booking.html",
-                                           booking=original_booking)
-            if request.form.get("meter_read_reg_1") != "":
-                if not validate_meter_read(
-                       request.form.get("meter_read_reg_1")):
-                    flash("Invalid meter read provided")
-                    return render_template("update_booking.html",
-                                           booking=original_booking)
-            if request.form.get("meter_read_reg_2") != "":
-                if not validate_meter_read(
-                       request.form.get("meter_read_reg_2")):
-                    flash("Invalid meter read provided")
-                    return render_template("update_booking.html",
-                                           booking=original_booking)
-            if request.form.get(
-               "install_date") == "" or not validate_date(
-               request.form.get("install_date")):
-                flash("Invalid installation date provided")
+            update["postcode_normalized"] = normalize_postcode(
+                update["postcode"])
+            # Only send the fields the user has actually changed.
+            # The rest of the booking (including the application date)
+            # is left as it is.
+            changes = {field: value for field, value in update.items()
+                       if original_booking.get(field) != value}
+            # If nothing has changed there is nothing to write.
+            if not changes:
+                flash("No changes made to your booking")
+                return redirect(url_for(
+                    "account", username=session["user_email_address"]))
+            # Let other processes' meter ID filters know about the move.
+            if "meter_id" in changes:
+                changes["meter_id_moved"] = datetime.utcnow()
+            # If the booking moves to another day or postcode area, take a
+            # place in the new slots before giving up the old ones.
+            old_slots = booking_slots(original_booking)
+            new_slots = booking_slots(update)
+            taken = [slot for slot in new_slots if slot not in old_slots]
+            freed = [slot for slot in old_slots if slot not in new_slots]
+            if not reserve_slots(taken):
+                flash("Sorry, there are no installations left on " +
+                      request.form.get("install_date") +
+                      " in your area - please choose another date")
                 return render_template("update_booking.html",
                                        booking=original_booking)
-            if request.form.get("supplier_authorisation") != "on":
-                flash("Please tick the supplier "
-                      "authorisation at the bottom of the form")
+            # Find record with original booking id and update it.
+            # If the meter_id has changed to one that is already booked,
+            # the unique index on meter_id rejects the update.
+            # If the update fails for any reason the new places are
+            # given back.
+            try:
+                result = mongo.db.meter_installs.update_one(
+                    {"_id": original_booking["_id"]},
+                    {"$set": changes, "$inc": {"version": 1}})
+            except DuplicateKeyError:
+                release_slots(taken)
+                # Display a flash message to the user advising them that
+                # there is an existing booking for the updated meter_id.
+                flash("A smart meter installation has already been"
+                      " booked for Meter ID " + request.form.get(
+                          "meter_id"))
                 return render_template("update_booking.html",
                                        booking=original_booking)
+            except Exception:
+                release_slots(taken)
+                raise
+            release_slots(freed if result.modified_count else taken)
+            if result.modified_count:
+                if "meter_id" in changes:
+                    note_meter_booked(changes["meter_id"])
+                    note_meter_released(original_booking["meter_id"])
+                record_booking_stats(
+                    added=[dict(original_booking, **changes)],
+                    removed=[original_booking])
+            # Display a flash message informing user that
+            # booking has been successfully updated.
+            flash("Meter install booking updated")
+            # Redirect to account(username) function where
+            # username is the users email address.
+            return redirect(url_for(
+                "account", username=session["user_email_address"]))
 
-            # Check whether the supplier authorisation is selected
-            # and asign True if so, False if not.
-            authorised = True if request.form.get(
-                "supplier_authorisation") == "on" else False
-            # Asign form elements to keys in update dict.
-            update = {
-                "user_email_address": session["user_email_address"],
-                "meter_id": int(request.form.get("meter_id")),
-                "meter_serial_number": request.form.get("meter_serial_number"),
-                "first_address_line": request.form.get("first_address_line"),
-                "second_address_line": request.form.get("second_address_line"),
-                "third_address_line": request.form.get("third_address_line"),
-                "town": request.form.get("town"),
-                "county": request.form.get("county"),
-                "postcode": request.form.get("postcode"),
-                "meter_location": request.form.get("meter_location"),
-                "access_instructions": request.form.get("access_instructions"),
-                "parking_on_site": request.form.get("parking_on_site"),
-                "property_type": request.form.get("property_type"),
-                "supplier": request.form.get("supplier"),
-                "supplier_acc_no": request.form.get("supplier_acc_no"),
-                "meter_read_reg_1": int(request.form.get("meter_read_reg_1"))
-                if request.form.get("meter_read_reg_1") else None,
-                "meter_read_reg_2": int(request.form.get("meter_read_reg_2"))
-                if request.form.get("meter_read_reg_2") else None,
-                "install_date": datetime.strptime(
-                    request.form.get("install_date"), "%d/%m/%Y"),
-                "supplier_authorisation": authorised,
-                "application_date": original_booking["application_date"]
-            }
-            # Check whether the meter_id has changed.
-            if original_booking["meter_id"] != update["meter_id"]:
-                # If so, check the meter_installs collection to see if
-                # another booking has been made with the updated meter_id.
-                existing_booking = mongo.db.meter_installs.find_one(
-                    {"meter_id": update["meter_id"]})
-                # If there is another meter found in the
-                # meter_installs collection.
-                if existing_booking:
-                    # Display a flash message to the user advising them that
-                    # there is an existing booking for the updated meter_id.
-                    flash("A smart meter installation has already been"
-                          "booked for Meter ID " + request.form.get(
-                              "meter_id"))
-                # Else, update the booking in the meter_installs collection.
-                else:
-                    # Find record with original booking id and update it.
-                    mongo.db.meter_installs.update(
-                        {"_id": ObjectId(booking_id)}, update)
-                    # Display a flash message informing user that
-                    # booking has been successfully updated.
-                    flash("Meter install booking updated")
-                    # Redirect to account(username) function where
-                    # username is the users email address.
-                    return redirect(url_for(
-                        "account", username=session["user_email_address"]))
-            # Else if meter_id has not changed
-            else:
-                # Then update  the booking in the meter_installs collection.
-                mongo.db.meter_installs.update(
-                    {"_id": ObjectId(booking_id)}, update)
-                # Display a flash message informing user that
-                # booking has been successfully updated.
-                flash("Meter install booking updated")
-                # Redirect to account(username) function where
-                # username is the users email address.
-                return redirect(url_for(
-                    "account", username=session["user_email_address"]))
-
-        # If method is GET, first check the booking_id is valid
-        if validate_id(booking_id):
-            # Find the record with the corresponding
-            # booking ID in the meter_installs collection.
-            booking = mongo.db.meter_installs.find_one(
-                {"_id": ObjectId(booking_id)})
-            # Check if booking exists and that the user_email_address
-            # matches the one in the session variable.
-            if booking and booking["user_email_address"] == session[
-               "user_email_address"]:
-                # If so, render the update_booking.html template.
-                return render_template("update_booking.html", booking=booking)
+        # If method is GET, find the record with the corresponding
+        # booking ID in the meter_installs collection, if the booking_id
+        # is valid and the booking belongs to the user.
+        booking = find_own_booking(booking_id, session["user_email_address"])
+        if booking:
+            # If so, render the update_booking.html template.
+            return render_template("update_booking.html", booking=booking)
         # If the booking_id entered is not valid
         # return user to Account page with flash message.
         flash("The booking ID you are trying to find is not valid")
@@ -726,6 +3376,216 @@ def update_booking(booking_id):
     return redirect(url_for("signin"))
 
 
+@app.route("/api/v1/bookings")
+def api_bookings():
+    # List the signed in users bookings as JSON, a page at a time,
+    # in the same order as the Account page.
+    email = session.get("user_email_address")
+    if not email:
+        return api_error("Please sign in", 401)
+    fields = api_fields()
+    if fields is None:
+        return api_error("Unknown field requested", 400)
+    try:
+        limit = int(request.args.get(
+            "limit", app.config["ACCOUNT_PAGE_SIZE"]))
+    except ValueError:
+        limit = 0
+    if not 1 <= limit <= API_MAX_PAGE_SIZE:
+        return api_error("limit must be between 1 and {}".format(
+            API_MAX_PAGE_SIZE), 400)
+    cursors = {}
+    for name in ["after", "before"]:
+        if request.args.get(name):
+            cursors[name] = decode_cursor(request.args[name])
+            if cursors[name] is None:
+                return api_error("Invalid {} cursor".format(name), 400)
+    # The sort fields are always fetched to build the page cursors.
+    projection = dict.fromkeys(fields + ["version"] + [
+        field for field, _ in BOOKING_PAGE_SORT], 1)
+    bookings, prev_cursor, next_cursor = fetch_bookings_page(
+        {"user_email_address": email}, limit, projection=projection,
+        **cursors)
+    return jsonify({
+        "bookings": [booking_json(booking, fields) for booking in bookings],
+        "prev": prev_cursor,
+        "next": next_cursor
+    })
+
+
+@app.route("/api/v1/bookings/<booking_id>")
+def api_booking(booking_id):
+    # One of the signed in users bookings as JSON.
+    email = session.get("user_email_address")
+    if not email:
+        return api_error("Please sign in", 401)
+    fields = api_fields()
+    if fields is None:
+        return api_error("Unknown field requested", 400)
+    # A client with a copy already sends its ETag.  If the version
+    # hasn't changed, reply 304 Not Modified having only read the
+    # version from the index.
+    if request.if_none_match:
+        current = find_own_booking(
+            booking_id, email, {"_id": 1, "version": 1})
+        if current and booking_etag(
+                current, fields) in request.if_none_match:
+            response = make_response("", 304)
+            response.set_etag(booking_etag(current, fields))
+            return response
+    booking = find_own_booking(
+        booking_id, email, dict.fromkeys(fields + ["version"], 1))
+    if not booking:
+        return api_error("Booking not found", 404)
+    response = jsonify(booking_json(booking, fields))
+    response.set_etag(booking_etag(booking, fields))
+    # Clients must check back each time, but get a
+    # 304 Not Modified if the booking is the same.
+    response.cache_control.private = True
+    response.cache_control.no_cache = True
+    return response
+
+
+@app.route("/api/meter/<meter_id>/available")
+def meter_available(meter_id):
+    # Whether a meter ID can still be booked, for the booking
+    # forms to check as the user types.
+    if not session.get("user_email_address"):
+        return api_error("Please sign in", 401)
+    if not validate_meter_id(meter_id):
+        return api_error("Invalid meter ID provided", 400)
+    return jsonify({"meter_id": meter_id,
+                    "available": meter_id_available(int(meter_id))})
+
+
+@app.route("/api/availability")
+def availability():
+    # How many installs are booked on each day from "from" to "to"
+    # (YYYY-MM-DD), in all or (with ?postcode=) in one postcode area.
+    # Served from the cached capacity calendar, so days in the past
+    # show as empty.
+    try:
+        start = datetime.strptime(request.args["from"], "%Y-%m-%d")
+        end = datetime.strptime(request.args["to"], "%Y-%m-%d")
+    except (KeyError, ValueError):
+        return api_error("from and to must be dates (YYYY-MM-DD)", 400)
+    if not 0 <= (end - start).days <= AVAILABILITY_MAX_DAYS:
+        return api_error("to must be on or after from and at most {} days "
+                         "later".format(AVAILABILITY_MAX_DAYS), 400)
+    area = None
+    if request.args.get("postcode"):
+        if not validate_postcode(request.args["postcode"]):
+            return api_error("Invalid postcode provided", 400)
+        area = postcode_area(request.args["postcode"])
+    capacity = app.config["CAPACITY_PER_AREA" if area else "CAPACITY_PER_DAY"]
+    counts = capacity_calendar(area)
+    days = []
+    for offset in range((end - start).days + 1):
+        day = (start + timedelta(days=offset)).strftime("%Y-%m-%d")
+        booked = counts.get(day, 0)
+        days.append({"date": day, "booked": booked,
+                     "available": booked < capacity})
+    return jsonify({"area": area, "capacity": capacity, "days": days})
+
+
+@app.route("/admin/search")
+def admin_search():
+    # Search every booking by postcode prefix, meter ID prefix, meter
+    # serial number or words in the address/supplier.  Only the
+    # ADMIN_EMAILS may search; anyone else gets a 404.
+    if not session.get("user_email_address"):
+        return redirect(url_for("signin"))
+    if not is_admin():
+        abort(404)
+    search_type = request.args.get("by", "postcode")
+    if search_type not in SEARCH_TYPES:
+        search_type = "postcode"
+    text = request.args.get("q", "")
+    bookings, next_cursor = [], None
+    if text:
+        try:
+            results = search_bookings(
+                search_type, text, after=request.args.get("after"))
+        except ExecutionTimeout:
+            results = None
+            flash("That search took too long - please make it more specific")
+        except OperationFailure as e:
+            # e.g. the server ran out of sort memory on a broad search.
+            app.logger.warning("Admin search failed: %s", e)
+            results = None
+            flash("That search couldn't be run - please make it more"
+                  " specific")
+        else:
+            if results is None:
+                flash("Please enter a valid " +
+                      SEARCH_TYPES[search_type][0].lower())
+        if results:
+            bookings, next_cursor = results
+    return render_template("admin_search.html",
+                           search_types=SEARCH_TYPES,
+                           search_type=search_type,
+                           text=text,
+                           bookings=bookings,
+                           next_cursor=next_cursor)
+
+
+@app.route("/admin/stats")
+def admin_stats():
+    # Bookings per supplier, county, town, property type and install
+    # week for the ADMIN_EMAILS, read from the one booking_stats document.
+    if not session.get("user_email_address"):
+        return redirect(url_for("signin"))
+    if not is_admin():
+        abort(404)
+    stats = read_db().booking_stats.find_one(
+        {"_id": BOOKING_STATS_ID}, session=read_session()) or {}
+    return render_template("admin_stats.html",
+                           total=stats.get("total", 0),
+                           rebuilt=stats.get("rebuilt"),
+                           tables=booking_stats_tables(stats))
+
+
+@app.route("/export/bookings.<export_format>")
+def export_bookings(export_format):
+    # Stream a suppliers bookings (?supplier=) as CSV or NDJSON,
+    # optionally only those installed from ?from= to ?to= (YYYY-MM-DD,
+    # inclusive) and after the booking ID ?after= (to resume).
+    # The response is gzipped on the fly if the client accepts it.
+    # For the ADMIN_EMAILS, or requests carrying the INTERNAL_TOKEN.
+    if not (is_admin() or internal_request()):
+        abort(404)
+    if export_format not in EXPORT_FORMATS:
+        abort(404)
+    supplier = request.args.get("supplier", "")
+    if not supplier or not validate_supplier(supplier):
+        return api_error("Invalid supplier provided", 400)
+    try:
+        start = end = None
+        if request.args.get("from"):
+            start = datetime.strptime(request.args["from"], "%Y-%m-%d")
+        if request.args.get("to"):
+            end = datetime.strptime(
+                request.args["to"], "%Y-%m-%d") + timedelta(days=1)
+    except ValueError:
+        return api_error("from and to must be dates (YYYY-MM-DD)", 400)
+    after = request.args.get("after")
+    if after and not validate_id(after):
+        return api_error("after must be a booking ID", 400)
+    chunks = export_bookings_text(
+        export_query(supplier, start, end, ObjectId(after) if after else None),
+        export_format)
+    if request.accept_encodings["gzip"]:
+        chunks = gzip_stream(chunks, app.config["EXPORT_GZIP_LEVEL"])
+    response = Response(stream_with_context(chunks),
+                        mimetype=EXPORT_FORMATS[export_format])
+    if request.accept_encodings["gzip"]:
+        response.content_encoding = "gzip"
+    response.vary.add("Accept-Encoding")
+    response.headers["Content-Disposition"] = (
+        "attachment; filename=bookings.{}".format(export_format))
+    return response
+
+
 @app.route("/update_account/<username>", methods=["GET", "POST"])
 def update_account(username):
     # Check whether the user_email_address exists in the session variable.
@@ -736,12 +3596,17 @@ def update_account(username):
         if validate_email(username):
             # Use email address that's been passed through
             # to search users collection.  Asign results to user.
-            user = mongo.db.users.find_one(
-                {"user_email_address": username})
+            # Only a form submission needs the password hash,
+            # otherwise the cached profile is enough.
+            if request.method == "POST":
+                user = mongo.db.users.find_one(
+                    {"user_email_address": username})
+            else:
+                user = get_user_profile(username)
             # Check that a record is found and if so, that
             # the user email address matches the one in the session variable.
-            if user and user["user_email_address"] == session[
-                             "user_email_address"]:
+            if user and not user.get("deleted") and user[
+               "user_email_address"] == session["user_email_address"]:
                 # If method is POST (i.e. form submitted),
                 # update the data in the meter_installs collection.
                 if request.method == "POST":
@@ -773,64 +3638,48 @@ def update_account(username):
 
                     # Check that the password the user has entered
                     # matches the users password in the users collection.
-                    if check_password_hash(user["password"],
-                                           request.form.get("password")):
+                    if verify_password(user["password"],
+                                       request.form.get("password")):
                         # Create update_user dict containing
                         # the updated details.
-                        # Password will be the existing hashed password.
+                        # The password isn't touched.
                         update_user = {
                             "first_name": request.form.get(
                                 "first-name").lower(),
                             "last_name": request.form.get(
                                 "last-name").lower(),
                             "user_email_address": request.form.get(
-                                "email").lower(),
-                            "password": user["password"]
+                                "email").lower()
                         }
-                        # Check if the user has changed their email address.
-                        if user["user_email_address"] != request.form.get(
-                           "email").lower():
-                            # If so, check if new email address exists in db.
-                            existing_user = mongo.db.users.find_one(
-                                {"user_email_address": request.form.get(
-                                    "email").lower()})
-                            # If it does, display a flash message
-                            # informing user that
-                            # an account already exists for this email address.
-                            if existing_user:
-                                flash("Another account already exists for the "
-                                      "email address you entered")
-                                # Redirect user to update_account page.
-                                return redirect(url_for(
-                                    "update_account", username=username))
-                            # Else, email address has changed
-                            # but is unique in collection:
-                            else:
-                                # Use the update_many method to
-                                # find all meter_installs
-                                # records with old email address and
-                                # update to the new email address.
-                                # Solution reached referring to:
-                                # https://www.w3schools.com/python/python_mongodb_update.asp
-                                mongo.db.meter_installs.update_many({
-                                    "user_email_address": user[
-                                        "user_email_address"]
-                                    }, {
-                                        "$set": {
-                                            "user_email_address": update_user[
-                                                "user_email_address"]
-                                        },
-                                    }
-                                )
-                                # Update the users details in
-                                # the users collection
-                                # when the user has changed
-                                # their email address.
-                                session["user_email_address"] = update_user[
-                                    "user_email_address"].lower()
-                        # Update the existing record using the user id.
-                        mongo.db.users.update(
-                            {"_id": ObjectId(user["_id"])}, update_user)
+                        # Update the user and, if the user has changed
+                        # their email address, move all of their
+                        # bookings over to it in one transaction so
+                        # the collections can't end up out of step.
+                        start = time.perf_counter()
+                        try:
+                            moved = run_in_transaction(
+                                lambda db_session: change_user_details(
+                                    user, update_user, db_session))
+                        except DuplicateKeyError:
+                            # The unique index on user_email_address
+                            # rejects an email address that another
+                            # account already has, and nothing is changed.
+                            flash("Another account already exists for the "
+                                  "email address you entered")
+                            # Redirect user to update_account page.
+                            return redirect(url_for(
+                                "update_account", username=username))
+                        if user["user_email_address"] != update_user[
+                           "user_email_address"]:
+                            record_email_cascade(
+                                moved, time.perf_counter() - start)
+                            # Put the new email address into the session.
+                            session["user_email_address"] = update_user[
+                                "user_email_address"]
+                        # Drop the cached profile for the old (and
+                        # if changed, the new) email address.
+                        invalidate_user(user["user_email_address"])
+                        invalidate_user(update_user["user_email_address"])
                         # Display flash message informing user that account
                         # details have been successfully updated.
                         flash("Account details updated")
@@ -845,10 +3694,9 @@ def update_account(username):
                         # Redirect user back to update_account page.
                         return redirect(url_for(
                             "update_account", username=username))
-                # If method is GET, remove the users password.
-                # Even though it is hashed, I don't want to pass
-                # this through for security reasons.
-                user.pop("password")
+                # If method is GET, the cached profile doesn't include
+                # the users password.  Even though it is hashed, I don't
+                # want to pass this through for security reasons.
                 # Check if there is a user email address saved
                 # in session variable, if so render update_account page.
                 if session["user_email_address"]:
@@ -877,8 +3725,9 @@ def delete_account(username):
         # Find the user account record in the users collection.
         user = mongo.db.users.find_one(
             {"user_email_address": username})
-        # Check to ensure user variable exists.
-        if user:
+        # Check to ensure user variable exists
+        # and the account isn't already being deleted.
+        if user and not user.get("deleted"):
             # Validate the password that the user has submitted.
             if request.form.get("password") == "" or not validate_pw(
                request.form.get("password")):
@@ -886,21 +3735,22 @@ def delete_account(username):
                 return redirect(url_for(
                         "account", username=session["user_email_address"]))
             # Check whether the user has provided the correct password.
-            if check_password_hash(
+            if verify_password(
                     user["password"], request.form.get("password")):
-                # If so, find bookings in meter_installs collection with
-                # corresponding user email address and delete them all.
-                # Solution reached referring to:
-                # https://www.w3schools.com/python/python_mongodb_delete.asp
-                mongo.db.meter_installs.delete_many({
-                    "user_email_address": username})
-                # Find the users record in the users collection and delete it.
-                # There will only be one record with corresponding
-                # email address but use the id anyway.
-                mongo.db.users.delete_one({
-                    "_id": ObjectId(user["_id"])})
+                # If so, mark the account as deleted straight away and
+                # queue a job to delete all of the users bookings in the
+                # background.  The purge job deletes the users record
+                # once the bookings are gone.
+                run_in_transaction(lambda db_session: mark_account_deleted(
+                    user, db_session))
+                invalidate_user(username)
+                # Sign the user out of every session, not just this one.
+                revoke_user_sessions(username)
                 # Delete the users email address out of session storage.
-                session.pop("user_email_address")
+                session.pop("user_email_address", None)
+                # This session still carries the flash message below, so
+                # it is saved under a new ID rather than the revoked one.
+                rotate_session()
                 # Redirect user to the registration page
                 # and display flash message
                 # informing them that account and bookings have been deleted.
@@ -916,20 +3766,900 @@ def delete_account(username):
                         "account", username=session["user_email_address"]))
     # If email address is not valid or no record found in the users collection
     # then redirect user to Account page with flash message.
-    session.pop("user_email_address")
+    session.pop("user_email_address", None)
     flash("Your account has already been deleted")
     return redirect(url_for("register"))
 
 
+@app.route("/internal/stats")
+def internal_stats():
+    # Report the counters from every STATS_SOURCES function as JSON.
+    # Only served to requests carrying the INTERNAL_TOKEN.
+    if not internal_request():
+        abort(404)
+    return jsonify({name: report() for name, report in
+                    STATS_SOURCES.items()})
+
+
+@app.route("/healthz")
+def healthz():
+    # Health check for load balancers.  Reports whether a primary is
+    # reachable, from the drivers own monitoring rather than a query.
+    # Requests carrying the INTERNAL_TOKEN also get the connection pool
+    # counters and each servers state.
+    description = topology_monitor.description
+    primary = bool(description and description.has_writable_server())
+    health = {"status": "ok" if primary else "unavailable",
+              "primary_reachable": primary}
+    if internal_request():
+        health["pool"] = mongo_pool_report()
+        lag = replica_lag_monitor.lag()
+        health["servers"] = [{
+            "address": "{}:{}".format(*server.address),
+            "type": server.server_type_name,
+            "round_trip_ms": server.round_trip_time * 1000
+            if server.round_trip_time is not None else None,
+            "lag_seconds": lag.get("{}:{}".format(*server.address))
+        } for server in (description.server_descriptions().values()
+                         if description else [])]
+    return jsonify(health), 200 if primary else 503
+
+
+@app.route("/metrics")
+def metrics():
+    # Prometheus scrape endpoint.
+    # Only served to requests carrying the INTERNAL_TOKEN.
+    if not internal_request():
+        abort(404)
+    return Response(prometheus_metrics(),
+                    mimetype="text/plain; version=0.0.4")
+
+
+@app.errorhandler(HashPoolBusy)
+def hash_pool_busy(e):
+    # The password hashing queue is full.  Rather than tie up a request
+    # thread waiting for it, ask the user to try again and send them
+    # back to the page they came from.
+    flash("We're very busy at the moment - please try again shortly.")
+    if "GET" in request.url_rule.methods:
+        return redirect(request.path)
+    if session.get("user_email_address"):
+        return redirect(url_for(
+            "account", username=session["user_email_address"]))
+    return redirect(url_for("home"))
+
+
 @app.errorhandler(404)
 def page_not_found(e):
     # This function handles 404 (page not found errors)
     # Solution copied from:
     # https://flask.palletsprojects.com/en/master/errorhandling/
-    return render_template('404.html'), 404
+    # The page is served from the page cache.
+    return render_cached_page("404.html", 404)
+
+
+@app.cli.command("create-indexes")
+def create_indexes_command():
+    # Build the indexes.  Heroku runs this in the release phase (see
+    # Procfile), so a deploy whose indexes can't be built is stopped
+    # before it goes live.
+    try:
+        create_indexes()
+    except OperationFailure as e:
+        # Most likely rows written before a unique index existed.
+        for collection, keys, options in INDEXES:
+            if not options.get("unique"):
+                continue
+            for duplicate in duplicate_keys(collection, keys):
+                click.echo("{} documents in {} share {}".format(
+                    duplicate["count"], collection, duplicate["_id"]))
+        raise click.ClickException(
+            "The indexes could not be built: {}".format(e))
+    click.echo("Indexes created")
+
+
+@app.cli.command("check-indexes")
+def check_indexes_command():
+    # Run explain() on every query shape and fail
+    # if any of them would do a collection scan.
+    collscans = 0
+    for collection, query, sort, *collation in QUERY_SHAPES:
+        cursor = mongo.db[collection].find(
+            query, collation=collation[0] if collation else None).limit(1)
+        if sort:
+            cursor = cursor.sort(sort)
+        plan = cursor.explain()["queryPlanner"]["winningPlan"]
+        stages = list(plan_stages(plan))
+        click.echo("{}.find({}) -> {}".format(
+            collection, sorted(query), " <- ".join(stages)))
+        if "COLLSCAN" in stages:
+            collscans += 1
+    if collscans:
+        raise click.ClickException(
+            "{} query shape(s) use a collection scan".format(collscans))
+    click.echo("All query shapes use an index")
+
+
+@app.cli.command("purge-worker")
+@click.option("--once", is_flag=True,
+              help="Run the pending jobs and exit instead of polling.")
+def purge_worker_command(once):
+    # Run deleted account purge jobs as a separate process.
+    if once:
+        run_purge_jobs()
+        click.echo(purge_report())
+    else:
+        purge_worker()
+
+
+@app.cli.command("build-assets")
+def build_assets_command():
+    # Build the fingerprinted and compressed static files and
+    # show how many bytes each one saves.
+    manifest = build_assets()
+    before = after = 0
+    for name, hashed in sorted(manifest["files"].items()):
+        # The smallest a full size copy can be sent as: compressed
+        # for text files, or as WebP for images.
+        copies = [hashed] + [
+            hashed + suffix for encoding, suffix in ASSET_ENCODINGS
+            if encoding in manifest["encodings"].get(hashed, [])]
+        variants = manifest["variants"].get(name, [])
+        copies += [variant for width, mimetype, variant in variants
+                   if width == variants[-1][0]]
+        size = os.path.getsize(os.path.join(app.static_folder, name))
+        built = min(os.path.getsize(os.path.join(
+            app.config["ASSET_DIR"], copy)) for copy in copies)
+        before += size
+        after += built
+        click.echo("{} -> {} ({} -> {} bytes)".format(
+            name, hashed, size, built))
+    if Image is None:
+        click.echo("Pillow isn't installed, images were not resized")
+    if brotli is None:
+        click.echo("brotli isn't installed, only gzip copies were built")
+    click.echo("{} files, {} -> {} bytes at the smallest size".format(
+        len(manifest["files"]), before, after))
+
+
+@app.cli.command("export-bookings")
+@click.option("--supplier", required=True, help="Supplier to export.")
+@click.option("--from", "start", type=click.DateTime(["%Y-%m-%d"]),
+              help="First install date to export.")
+@click.option("--to", "end", type=click.DateTime(["%Y-%m-%d"]),
+              help="Last install date to export.")
+@click.option("--after", help="Only export bookings after this booking ID.")
+@click.option("--format", "export_format", default="csv",
+              type=click.Choice(sorted(EXPORT_FORMATS)))
+@click.option("--gzip", "compress", is_flag=True, help="Gzip the output.")
+@click.option("--output", type=click.File("wb"), default="-",
+              help="File to write to (standard output by default).")
+def export_bookings_command(supplier, start, end, after, export_format,
+                            compress, output):
+    # Write a suppliers bookings out as the export endpoint would.
+    if after and not validate_id(after):
+        raise click.ClickException("--after must be a booking ID")
+    chunks = export_bookings_text(export_query(
+        supplier, start, end + timedelta(days=1) if end else None,
+        ObjectId(after) if after else None), export_format)
+    if compress:
+        chunks = gzip_stream(chunks, app.config["EXPORT_GZIP_LEVEL"])
+    else:
+        chunks = (chunk.encode() for chunk in chunks)
+    for chunk in chunks:
+        output.write(chunk)
+
+
+@app.cli.command("backfill-postcodes")
+@click.option("--batch-size", default=1000, help="Bookings per update.")
+def backfill_postcodes_command(batch_size):
+    # Add the normalized postcode the admin search uses to bookings
+    # made before it existed.  Safe to stop and run again.
+    click.echo("{} bookings updated".format(
+        backfill_normalized_postcodes(batch_size)))
+
+
+@app.cli.command("rebuild-booking-stats")
+@click.option("--batch-size", default=1000, help="Bookings per checkpoint.")
+@click.option("--restart", is_flag=True,
+              help="Start again instead of resuming a stopped rebuild.")
+def rebuild_booking_stats_command(batch_size, restart):
+    # Recount the dashboard statistics from the bookings.
+    click.echo("{} bookings counted".format(
+        rebuild_booking_stats(batch_size, restart)))
+
+
+@app.cli.command("rebuild-capacity")
+def rebuild_capacity_command():
+    # Recount the install date capacity counters from the bookings.
+    click.echo("{} capacity slots rebuilt".format(rebuild_capacity()))
+
+
+# Sample booking form used by the tests and benchmark commands.
+def sample_booking_form(meter_id):
+    return {
+        "meter_id": meter_id,
+        "meter_serial_number": "ABC123",
+        "first_address_line": "5 Princess Gardens",
+        "second_address_line": "",
+        "third_address_line": "",
+        "town": "Ipswich",
+        "county": "Suffolk",
+        "postcode": "IP99 0ZZ",
+        "meter_location": "Under the stairs",
+        "access_instructions": "",
+        "parking_on_site": "yes",
+        "property_type": "residential",
+        "supplier": "Wired and Wiser",
+        "supplier_acc_no": "WW12345",
+        "meter_read_reg_1": "12345",
+        "meter_read_reg_2": "",
+        "install_date": "01/03/2027",
+        "supplier_authorisation": "on"
+    }
+
+
+def use_mongomock():
+    # Swap the Mongo client for an in-memory mongomock client so the
+    # tests and benchmark commands can run without a real database.
+    if mongomock is None:
+        raise click.ClickException("mongomock is not installed")
+    client = mongomock.MongoClient()
+    # mongomock doesn't support sessions or transactions,
+    # and has no secondaries.
+    app.config["MONGO_TRANSACTIONS"] = False
+    app.config["MONGO_SECONDARY_READS"] = False
+    mongo.cx = client
+    mongo.db = client[app.config["MONGO_DBNAME"] or "wired_and_wiser"]
+
+
+def use_benchmark_database(database):
+    # The load test and benchmark commands seed and delete made up users
+    # and bookings, so they never touch the apps own database.  They use
+    # an in-memory mongomock database unless --database names a scratch
+    # database on the same server.
+    if not database:
+        use_mongomock()
+        return
+    if mongo.db is not None and database == mongo.db.name:
+        raise click.ClickException(
+            "--database must be a scratch database, not the app's "
+            "database ({})".format(database))
+    mongo.db = mongo.cx[database]
+
+
+def benchmark_database_option(help_text="Scratch database to use instead "
+                              "of an in-memory mongomock database."):
+    return click.option("--database", help=help_text)
+
+
+def legacy_validate_booking(form):
+    # The field by field validation book() and update_booking() used
+    # before BOOKING_SCHEMA, kept only as the bench-validation baseline.
+    # Each field is read from the form several times and each pattern
+    # is looked up by string on every call.
+    checks = [
+        ("meter_id", "^[0-9]{13}$", True),
+        ("meter_serial_number", "^[a-zA-Z0-9]{0,12}$", False),
+        ("first_address_line", "^[a-zA-Z0-9 ]{0,50}$", True),
+        ("second_address_line", "^[a-zA-Z0-9 ]{0,50}$", False),
+        ("third_address_line", "^[a-zA-Z0-9 ]{0,50}$", False),
+        ("town", "[a-zA-Z ]+$", True),
+        ("county", "[a-zA-Z ]+$", True),
+        ("postcode", "^[a-zA-Z0-9 ]{6,8}$", True),
+        ("meter_location", "[a-zA-Z0-9 .]+$", True),
+        ("access_instructions", "[a-zA-Z0-9 .]+$", False),
+        ("supplier", "^[a-zA-Z0-9 ]{0,30}$", True),
+        ("supplier_acc_no", "^[a-zA-Z0-9 /-]{0,20}$", False),
+        ("meter_read_reg_1", "^[0-9]{0,8}$", False),
+        ("meter_read_reg_2", "^[0-9]{0,8}$", False),
+        ("install_date", "^[0-9/]{10}$", True),
+    ]
+    for name, pattern, required in checks:
+        if required:
+            if form.get(name) == "" or not re.match(
+               pattern, form.get(name)):
+                return None
+        elif form.get(name) != "":
+            if not re.match(pattern, form.get(name)):
+                return None
+    if form.get("parking_on_site") == "" or not validate_yes_no(
+       form.get("parking_on_site")):
+        return None
+    if form.get("property_type") == "" or not validate_property_type(
+       form.get("property_type")):
+        return None
+    if form.get("supplier_authorisation") != "on":
+        return None
+    return {
+        "meter_id": int(form.get("meter_id")),
+        "meter_read_reg_1": int(form.get("meter_read_reg_1"))
+        if form.get("meter_read_reg_1") else None,
+        "meter_read_reg_2": int(form.get("meter_read_reg_2"))
+        if form.get("meter_read_reg_2") else None,
+        "install_date": datetime.strptime(
+            form.get("install_date"), "%d/%m/%Y"),
+        "supplier_authorisation": True if form.get(
+            "supplier_authorisation") == "on" else False
+    }
+
+
+@app.cli.command("bench-validation")
+@click.option("--iterations", default=20000,
+              help="Number of forms to validate with each approach.")
+def bench_validation_command(iterations):
+    # Compare the per-request cost of validating a booking form
+    # field by field against validating it with BOOKING_SCHEMA.
+    form = ImmutableMultiDict(sample_booking_form("1234567890123"))
+    for name, validate in [
+            ("before (field by field)", legacy_validate_booking),
+            ("after (BOOKING_SCHEMA)",
+             lambda form: validate_form(BOOKING_SCHEMA, form))]:
+        start = time.perf_counter()
+        for _ in range(iterations):
+            validate(form)
+        elapsed = time.perf_counter() - start
+        click.echo("{:<24} {:8.2f} us per form".format(
+            name, elapsed / iterations * 1000000))
+
+
+@app.cli.command("bench-password-hash")
+@click.option("--candidate", "candidates", multiple=True,
+              help="Method and iterations to try, e.g. pbkdf2:sha256:260000."
+              "  May be given more than once.")
+@click.option("--seconds", default=2.0,
+              help="How long to hash for with each candidate.")
+def bench_password_hash_command(candidates, seconds):
+    # Report how many hashes per second one core manages for each
+    # candidate setting, to help pick a cost the web nodes can afford.
+    candidates = candidates or [password_method()] + [
+        password_method("pbkdf2:sha256", iterations)
+        for iterations in [50000, 100000, 260000, 600000]]
+    cores = os.cpu_count() or 1
+    click.echo("{:<28} {:>14} {:>14} {:>16}".format(
+        "method", "ms per hash", "hashes/s/core",
+        "hashes/s ({} cores)".format(cores)))
+    for method in candidates:
+        count = 0
+        start = time.perf_counter()
+        while time.perf_counter() - start < seconds:
+            generate_password_hash(
+                "benchmark", method=method,
+                salt_length=app.config["PASSWORD_SALT_LENGTH"])
+            count += 1
+        elapsed = time.perf_counter() - start
+        click.echo("{:<28} {:>14.2f} {:>14.1f} {:>16.1f}{}".format(
+            method, elapsed / count * 1000, count / elapsed,
+            count / elapsed * cores,
+            "  (current policy)" if method == password_method() else ""))
+
+
+@app.cli.command("bench-session")
+@click.option("--requests", "count", default=20000,
+              help="Requests to time for each session store.")
+@benchmark_database_option()
+def bench_session_command(count, database):
+    # Time loading and saving a signed in session for each session
+    # store, both for requests that only read the session and for
+    # requests that flash a message, and show the cookie each one
+    # makes the browser send.
+    use_benchmark_database(database)
+    interfaces = [("cookie", SecureCookieSessionInterface())] + [
+        (name, ServerSideSessionInterface(store()))
+        for name, store in SESSION_STORES.items()]
+    click.echo("{:<8} {:>14} {:>14} {:>14}".format(
+        "store", "cookie bytes", "us per read", "us per write"))
+    for name, interface in interfaces:
+        # Sign in and flash a message, as the signin route does.
+        response = Response()
+        with app.test_request_context():
+            user_session = interface.open_session(app, request)
+        user_session["user_email_address"] = "bench-session@example.com"
+        user_session["_flashes"] = [("message", "Welcome back Bench")]
+        interface.save_session(app, user_session, response)
+        cookie = response.headers["Set-Cookie"].split(";")[0]
+        environ = EnvironBuilder(
+            headers={"Cookie": cookie}).get_environ()
+        timings = []
+        for write in [False, True]:
+            start = time.perf_counter()
+            for i in range(count):
+                user_session = interface.open_session(
+                    app, app.request_class(environ))
+                user_session.get("user_email_address")
+                if write:
+                    user_session["_flashes"] = [("message", str(i))]
+                interface.save_session(app, user_session, Response())
+            timings.append((time.perf_counter() - start) / count * 1e6)
+        click.echo("{:<8} {:>14} {:>14.1f} {:>14.1f}".format(
+            name, len(cookie), *timings))
+        if isinstance(interface, ServerSideSessionInterface):
+            interface.store.delete_user("bench-session@example.com")
+
+
+def percentile(samples, pct):
+    # Nearest-rank percentile of a list of latencies.
+    if not samples:
+        return 0.0
+    ordered = sorted(samples)
+    rank = max(int(round(pct / 100.0 * len(ordered))) - 1, 0)
+    return ordered[min(rank, len(ordered) - 1)]
+
+
+def latency_summary(samples):
+    # p50/p95/p99 of a list of latencies in seconds, as milliseconds.
+    return "p50 {:7.1f}ms  p95 {:7.1f}ms  p99 {:7.1f}ms  ({} requests)".format(
+        percentile(samples, 50) * 1000, percentile(samples, 95) * 1000,
+        percentile(samples, 99) * 1000, len(samples))
+
+
+@app.cli.command("load-test-signin")
+@click.option("--storm", default=16, help="Threads signing in at once.")
+@click.option("--seconds", default=10.0, help="Length of each phase.")
+@benchmark_database_option()
+def load_test_signin_command(storm, seconds, database):
+    # Measure the latency of cheap routes (home and view_booking) on
+    # their own and then during a login storm, to show that password
+    # hashing doesn't starve them.  Run it with HASH_POOL_WORKERS=0 to
+    # compare against hashing on the request threads.
+    use_benchmark_database(database)
+    create_indexes()
+    email = "loadtest@example.com"
+    mongo.db.users.delete_many({"user_email_address": email})
+    mongo.db.meter_installs.delete_many({"user_email_address": email})
+    mongo.db.users.insert_one({
+        "first_name": "load", "last_name": "test",
+        "user_email_address": email, "password": hash_password("loadtest")})
+    booking, _ = validate_form(
+        BOOKING_SCHEMA, sample_booking_form("9999999999998"))
+    booking["user_email_address"] = email
+    booking["application_date"] = datetime.now()
+    booking_id = mongo.db.meter_installs.insert_one(booking).inserted_id
+
+    def probe(stop, samples):
+        # Hit the cheap routes in a loop, timing each request.
+        client = app.test_client()
+        with client.session_transaction() as sess:
+            sess["user_email_address"] = email
+        while not stop.is_set():
+            for url in ["/", "/view_booking/{}".format(booking_id)]:
+                start = time.perf_counter()
+                client.get(url)
+                samples.append(time.perf_counter() - start)
+
+    def sign_in(stop, samples, busy):
+        # Sign in over and over, as a login burst would.
+        client = app.test_client()
+        while not stop.is_set():
+            start = time.perf_counter()
+            response = client.post("/signin", data={
+                "email": email, "password": "loadtest"})
+            samples.append(time.perf_counter() - start)
+            if response.location and response.location.endswith("/signin"):
+                busy.append(1)
+            client.get("/signout")
+
+    for phase, storm_threads in [("quiet", 0), ("login storm", storm)]:
+        stop = threading.Event()
+        probe_samples, signin_samples, busy = [], [], []
+        threads = [threading.Thread(target=probe, args=(stop, probe_samples))]
+        threads += [threading.Thread(target=sign_in,
+                                     args=(stop, signin_samples, busy))
+                    for _ in range(storm_threads)]
+        for thread in threads:
+            thread.start()
+        time.sleep(seconds)
+        stop.set()
+        for thread in threads:
+            thread.join()
+        click.echo("{:<12} cheap routes: {}".format(
+            phase, latency_summary(probe_samples)))
+        if storm_threads:
+            click.echo("{:<12} signin:       {}  {} turned away".format(
+                "", latency_summary(signin_samples), len(busy)))
+    click.echo("hash pool: {}".format(hash_pool_report()))
+    mongo.db.users.delete_many({"user_email_address": email})
+    mongo.db.meter_installs.delete_many({"user_email_address": email})
+
+
+# Meter IDs the load test books from.  The search benchmark's made up
+# bookings start at SEARCH_BENCH_METER_IDS and the server mode
+# benchmark's at BENCH_BOOK_METER_IDS, well clear of them.
+LOAD_TEST_METER_IDS = 7000000000000
+BENCH_BOOK_METER_IDS = 8000000000000
+
+
+def load_test_emails(users):
+    return ["loadtest{}@example.com".format(n) for n in range(users)]
+
+
+def seed_load_test_data(users, bookings_per_user):
+    # Seed users and bookings for the load test.  Every user shares
+    # one password hash so seeding doesn't spend minutes hashing.
+    # Returns the seeded email addresses.
+    pwhash = hash_password("loadtest")
+    emails = load_test_emails(users)
+    mongo.db.users.insert_many([{
+        "first_name": "load", "last_name": "test",
+        "user_email_address": email, "password": pwhash
+    } for email in emails])
+    form = sample_booking_form("0")
+    batch = []
+    for n, email in enumerate(emails):
+        for i in range(bookings_per_user):
+            meter_id = LOAD_TEST_METER_IDS + 1000000000 + (
+                n * bookings_per_user + i)
+            booking, _ = validate_form(BOOKING_SCHEMA, dict(
+                form, meter_id=str(meter_id),
+                install_date="{:02d}/03/2027".format(i % 28 + 1)))
+            booking["user_email_address"] = email
+            booking["application_date"] = datetime.now()
+            batch.append(booking)
+            if len(batch) == 1000:
+                mongo.db.meter_installs.insert_many(batch)
+                batch = []
+    if batch:
+        mongo.db.meter_installs.insert_many(batch)
+    return emails
+
+
+def clear_load_test_data(emails):
+    # Remove the users the load test seeded or registered, by their
+    # exact email addresses, and their bookings.
+    mongo.db.users.delete_many({"user_email_address": {"$in": emails}})
+    mongo.db.meter_installs.delete_many(
+        {"user_email_address": {"$in": emails}})
+
+
+def load_test_flow(client, email, meter_id, timings):
+    # Run one scripted pass through the booking flow as a signed in
+    # user, timing each request against its route.
+    def timed(route, method, url, **kwargs):
+        start = time.perf_counter()
+        response = getattr(client, method)(url, **kwargs)
+        timings.setdefault(route, []).append(time.perf_counter() - start)
+        return response
+
+    timed("signin", "post", "/signin",
+          data={"email": email, "password": "loadtest"})
+    form = sample_booking_form(str(meter_id))
+    timed("book", "post", "/book", data=form)
+    timed("account", "get", "/account/{}".format(email))
+    # Only the booking this flow just made (if it was booked) is
+    # updated and deleted.
+    booking = mongo.db.meter_installs.find_one(
+        {"meter_id": meter_id, "user_email_address": email}, {"_id": 1})
+    if booking:
+        timed("update_booking", "post",
+              "/update_booking/{}".format(booking["_id"]),
+              data=dict(form, town="Colchester"))
+        timed("delete_booking", "get",
+              "/delete_booking/{}".format(booking["_id"]))
+    timed("signout", "get", "/signout")
+
+
+@app.cli.command("bench-server-modes")
+@click.option("--concurrency", default=50, help="Requests in flight at once.")
+@click.option("--requests", "count", default=2000,
+              help="Requests sent to each server.")
+@click.option("--port", default=5099, help="Port to run the servers on.")
+@click.option("--database", required=True,
+              help="Scratch database on the MongoDB at MONGO_URI "
+              "for the servers to use.")
+def bench_server_modes_command(concurrency, count, port, database):
+    # Run "python app.py" once in each SERVER_MODE and send it concurrent
+    # requests for the Mongo-bound pages (account, view_booking and
+    # update_booking), then concurrent bookings (POST /book), reporting
+    # the throughput of the one process for each.
+    # The servers need a real MongoDB at MONGO_URI, and use the scratch
+    # database given by --database.
+    use_benchmark_database(database)
+    uri = urllib.parse.urlsplit(app.config["MONGO_URI"])
+    database_uri = urllib.parse.urlunsplit(uri._replace(path="/" + database))
+    create_indexes()
+    clear_load_test_data(load_test_emails(1))
+    email = seed_load_test_data(1, 50)[0]
+    paths = ["/account/" + email] + [
+        "/{}/{}".format(route, booking["_id"])
+        for booking in mongo.db.meter_installs.find(
+            {"user_email_address": email}, {"_id": 1})
+        for route in ["view_booking", "update_booking"]]
+    base = "http://127.0.0.1:{}".format(port)
+
+    class NoRedirect(urllib.request.HTTPRedirectHandler):
+        # A booking redirects to the account page, which
+        # isn't part of what's being timed.
+        def redirect_request(self, *args):
+            return None
+
+    click.echo("{:<9} {:<5} {:>10}  {}".format(
+        "mode", "load", "req/s", "latency"))
+    try:
+        for number, mode in enumerate(["threaded", "gevent"]):
+            server = subprocess.Popen(
+                [sys.executable, "app.py"], cwd=app.root_path,
+                env=dict(os.environ, SERVER_MODE=mode, IP="127.0.0.1",
+                         MONGO_URI=database_uri, MONGO_DBNAME=database,
+                         PORT=str(port), PURGE_WORKER_THREAD="off",
+                         # So no booking is turned away for capacity.
+                         CAPACITY_PER_DAY=str(10 ** 9),
+                         CAPACITY_PER_AREA=str(10 ** 9)),
+                stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+            try:
+                opener = urllib.request.build_opener(
+                    urllib.request.HTTPCookieProcessor(), NoRedirect())
+                # Wait for the server to start, then sign in.
+                for attempt in range(100):
+                    try:
+                        opener.open(base + "/signin", urllib.parse.urlencode(
+                            {"email": email, "password": "loadtest"}
+                        ).encode()).read()
+                        break
+                    except urllib.error.URLError:
+                        time.sleep(0.1)
+                else:
+                    raise click.ClickException(
+                        "The {} server didn't start".format(mode))
+
+                def fetch(path):
+                    start = time.perf_counter()
+                    opener.open(base + path).read()
+                    return time.perf_counter() - start
+
+                def book(meter_id):
+                    start = time.perf_counter()
+                    try:
+                        opener.open(base + "/book", urllib.parse.urlencode(
+                            sample_booking_form(str(meter_id))).encode())
+                    except urllib.error.HTTPError as e:
+                        # A successful booking is a 302 to the account.
+                        if e.code != 302:
+                            raise
+                    return time.perf_counter() - start
+
+                first_id = BENCH_BOOK_METER_IDS + number * count
+                for load, run, items in [
+                        ("read", fetch,
+                         (paths[i % len(paths)] for i in range(count))),
+                        ("book", book, range(first_id, first_id + count))]:
+                    start = time.perf_counter()
+                    with ThreadPoolExecutor(concurrency) as executor:
+                        samples = list(executor.map(run, items))
+                    elapsed = time.perf_counter() - start
+                    click.echo("{:<9} {:<5} {:>10.1f}  {}".format(
+                        mode, load, count / elapsed,
+                        latency_summary(samples)))
+            finally:
+                server.terminate()
+                server.wait()
+    finally:
+        clear_load_test_data([email])
+        # The bookings were deleted directly, so recount the
+        # scratch databases capacity and statistics.
+        rebuild_capacity()
+        rebuild_booking_stats(1000, restart=True)
+
+
+@app.cli.command("loadtest")
+@click.option("--users", default=50, help="Users to seed.")
+@click.option("--bookings", default=20, help="Bookings to seed per user.")
+@click.option("--concurrency", default=8, help="Simulated clients.")
+@click.option("--flows", default=10, help="Flows run by each client.")
+@benchmark_database_option()
+@click.option("--output", type=click.Path(), help="Write JSON results here.")
+@click.option("--baseline", type=click.Path(exists=True),
+              help="Earlier JSON results to compare against.")
+def loadtest_command(users, bookings, concurrency, flows, database,
+                     output, baseline):
+    # Seed the database, drive the real app through register, signin,
+    # book, account, update_booking and delete_booking from several
+    # clients at once, and report latency percentiles and throughput
+    # per route.
+    use_benchmark_database(database)
+    create_indexes()
+    registered = ["loadreg{}x{}@example.com".format(number, flow)
+                  for number in range(concurrency) for flow in range(flows)]
+    # Clear out anything left by a run that was stopped.
+    clear_load_test_data(load_test_emails(users) + registered)
+    emails = seed_load_test_data(users, bookings)
+    timings = {}
+    timings_lock = threading.Lock()
+
+    def client_thread(number):
+        client = app.test_client()
+        local = {}
+        for flow in range(flows):
+            # Register a new user now and again, as real traffic would.
+            start = time.perf_counter()
+            client.post("/register", data={
+                "first-name": "load", "last-name": "reg",
+                "email": registered[number * flows + flow],
+                "password": "loadtest"})
+            local.setdefault("register", []).append(
+                time.perf_counter() - start)
+            client.get("/signout")
+            load_test_flow(
+                client, emails[(number * flows + flow) % len(emails)],
+                LOAD_TEST_METER_IDS + number * flows + flow, local)
+        with timings_lock:
+            for route, samples in local.items():
+                timings.setdefault(route, []).extend(samples)
+
+    threads = [threading.Thread(target=client_thread, args=(number,))
+               for number in range(concurrency)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+    clear_load_test_data(emails + registered)
+
+    results = {
+        # So results can be lined up with the commit they were run on.
+        "commit": subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], capture_output=True,
+            text=True).stdout.strip(),
+        "run_at": datetime.utcnow().isoformat(),
+        "settings": {"users": users, "bookings": bookings,
+                     "concurrency": concurrency, "flows": flows,
+                     "database": database or "mongomock"},
+        "seconds": elapsed,
+        "routes": {}
+    }
+    for route, samples in sorted(timings.items()):
+        results["routes"][route] = {
+            "requests": len(samples),
+            "p50_ms": percentile(samples, 50) * 1000,
+            "p95_ms": percentile(samples, 95) * 1000,
+            "p99_ms": percentile(samples, 99) * 1000,
+            "throughput_rps": len(samples) / elapsed
+        }
+    previous = {}
+    if baseline:
+        with open(baseline) as f:
+            previous = json.load(f)["routes"]
+    click.echo("{:<16} {:>8} {:>10} {:>10} {:>10} {:>10}{}".format(
+        "route", "requests", "p50 ms", "p95 ms", "p99 ms", "req/s",
+        "  p95 vs baseline" if previous else ""))
+    for route, result in results["routes"].items():
+        change = ""
+        if route in previous and previous[route]["p95_ms"]:
+            change = "  {:+.1f}%".format(
+                (result["p95_ms"] / previous[route]["p95_ms"] - 1) * 100)
+        click.echo("{:<16} {:>8} {:>10.1f} {:>10.1f} {:>10.1f} {:>10.1f}{}"
+                   .format(route, result["requests"], result["p50_ms"],
+                           result["p95_ms"], result["p99_ms"],
+                           result["throughput_rps"], change))
+    if output:
+        with open(output, "w") as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+        click.echo("Results written to {}".format(output))
+
+
+# Made up addresses for the search benchmark.
+SEARCH_BENCH_EMAIL = "bench-search@example.com"
+SEARCH_BENCH_METER_IDS = 6000000000000
+SEARCH_BENCH_TOWNS = [
+    "leeds", "manchester", "colchester", "ipswich", "norwich", "bristol",
+    "cardiff", "glasgow", "york", "bath", "exeter", "derby"]
+SEARCH_BENCH_STREETS = [
+    "high street", "station road", "church lane", "mill road",
+    "park avenue", "queens road", "victoria street", "the green"]
+SEARCH_BENCH_SUPPLIERS = [
+    "british gas", "edf energy", "eon", "octopus energy", "ovo energy",
+    "scottish power", "bulb", "utility warehouse"]
+SEARCH_BENCH_AREAS = ["LS", "M", "CO", "IP", "NR", "BS", "CF", "G", "YO",
+                      "BA", "EX", "DE"]
+
+
+def search_bench_booking(n):
+    # The nth made up booking.  Every value is derived from n, so the
+    # benchmark can pick search terms without reading the bookings.
+    area = n % len(SEARCH_BENCH_AREAS)
+    postcode = "{}{} {}{}".format(
+        SEARCH_BENCH_AREAS[area], n // 12 % 30 + 1, n // 360 % 10,
+        "ABDEFGHJLNPQRSTUWXYZ"[n // 3600 % 20] + "AB"[n % 2])
+    return {
+        "meter_id": SEARCH_BENCH_METER_IDS + n,
+        "meter_serial_number": "S{:011d}".format(n),
+        "first_address_line": "{} {}".format(
+            n % 200 + 1, SEARCH_BENCH_STREETS[n // 7 % 8]),
+        "second_address_line": "",
+        "third_address_line": "",
+        "town": SEARCH_BENCH_TOWNS[area],
+        "county": "essex",
+        "postcode": postcode,
+        "postcode_normalized": normalize_postcode(postcode),
+        "meter_location": "kitchen",
+        "parking_on_site": "yes",
+        "property_type": "house",
+        "supplier": SEARCH_BENCH_SUPPLIERS[n // 11 % 8],
+        "install_date": datetime(2027, 3, n % 28 + 1),
+        "user_email_address": SEARCH_BENCH_EMAIL,
+        "application_date": datetime.now(),
+        "version": 1
+    }
+
+
+def search_bench_text(search_type, documents):
+    # Search text of the given type that matches some made up bookings.
+    n = random.randrange(documents)
+    booking = search_bench_booking(n)
+    if search_type == "postcode":
+        return booking["postcode_normalized"][:-2]
+    if search_type == "meter_id":
+        return str(booking["meter_id"])[:9]
+    if search_type == "meter_serial_number":
+        return booking["meter_serial_number"]
+    return "{} {}".format(booking["town"], booking["supplier"].split()[0])
+
+
+@app.cli.command("bench-search")
+@click.option("--documents", default=10000000,
+              help="Bookings to search through.")
+@click.option("--queries", default=200, help="Searches of each type.")
+@click.option("--target-ms", default=100.0,
+              help="Fail if any search type's p95 is slower than this.")
+@click.option("--keep", is_flag=True,
+              help="Keep the made up bookings for the next run.")
+@benchmark_database_option(
+    "Scratch database to use instead of an in-memory mongomock database "
+    "(which can't run text searches).")
+def bench_search_command(documents, queries, target_ms, keep, database):
+    # Seed made up bookings (unless a kept run already did) and time the
+    # first and next page of each type of admin search.
+    use_benchmark_database(database)
+    create_indexes()
+    seeded = mongo.db.meter_installs.count_documents(
+        {"user_email_address": SEARCH_BENCH_EMAIL})
+    if seeded != documents:
+        mongo.db.meter_installs.delete_many(
+            {"user_email_address": SEARCH_BENCH_EMAIL})
+        with click.progressbar(range(0, documents, 10000),
+                               label="Seeding bookings") as starts:
+            for start in starts:
+                mongo.db.meter_installs.insert_many(
+                    [search_bench_booking(n) for n in range(
+                        start, min(start + 10000, documents))],
+                    ordered=False)
+    slow = []
+    with app.test_request_context():
+        for search_type in SEARCH_TYPES:
+            if not database and search_type == "text":
+                continue
+            samples = []
+            for _ in range(queries):
+                text = search_bench_text(search_type, documents)
+                after = None
+                for page in range(2):
+                    start = time.perf_counter()
+                    _, after = search_bookings(search_type, text, after)
+                    samples.append(time.perf_counter() - start)
+                    if not after:
+                        break
+            click.echo("{:<20} {}".format(
+                search_type, latency_summary(samples)))
+            if percentile(samples, 95) * 1000 > target_ms:
+                slow.append(search_type)
+    if not keep:
+        mongo.db.meter_installs.delete_many(
+            {"user_email_address": SEARCH_BENCH_EMAIL})
+    if slow:
+        raise click.ClickException("p95 over {}ms for: {}".format(
+            target_ms, ", ".join(slow)))
+
+
+def serve(host, port):
+    # Run the app in the configured SERVER_MODE.  Both modes run the
+    # same routes; only how requests are scheduled differs.
+    if app.config["SERVER_MODE"] == "gevent":
+        # gevent is only needed in this mode.
+        from gevent.pywsgi import WSGIServer
+        WSGIServer((host or "", port), app).serve_forever()
+    else:
+        app.run(host=host, port=port, debug=False)
 
 
 if __name__ == "__main__":
-    app.run(host=os.environ.get("IP"),
-            port=int(os.environ.get("PORT")),
-            debug=False)
+    serve(os.environ.get("IP"), int(os.environ.get("PORT")))
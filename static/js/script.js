@@ -68,6 +68,61 @@ $(document).ready(function() {
         }
     });
     
+    // ----------------------------------------------------------------------------------------------------------Meter ID availability
+    // Check whether a meter ID has already been booked as the user types it, rather than after they submit the form.
+    // Used on both the book.html and update_booking.html pages.  On the update page the booking's own meter ID is fine.
+    var meterIdCheck;
+    $("#meter_id").on("input", function() {
+        var meterId = $(this).val();
+        clearTimeout(meterIdCheck);
+        $("#meter-id-availability").text("").removeClass("text-success text-warning");
+        if (!/^[0-9]{13}$/.test(meterId) || meterId == this.defaultValue) {
+            return;
+        }
+        // Wait until the user stops typing before checking.
+        meterIdCheck = setTimeout(function() {
+            $.getJSON("/api/meter/" + meterId + "/available", function(data) {
+                if (data.meter_id != $("#meter_id").val()) {
+                    return;
+                }
+                if (data.available) {
+                    $("#meter-id-availability").text("This meter ID is available.").addClass("text-success");
+                } else {
+                    $("#meter-id-availability").text("A smart meter installation has already been booked for this meter ID.").addClass("text-warning");
+                }
+            });
+        }, 300);
+    });
+
+    // ----------------------------------------------------------------------------------------------------------Install date availability
+    // Fetch which days are fully booked (in the postcode area if one has been entered) so the datepicker can grey them out.
+    // The server still checks the date when the form is submitted.
+    var fullDays = {};
+    function isoDate(date) {
+        return $.datepicker.formatDate("yy-mm-dd", date);
+    }
+    function loadAvailability() {
+        if (!$("#install_date").length) {
+            return;
+        }
+        var today = new Date();
+        var until = new Date(today.getFullYear() + 2, today.getMonth(), today.getDate());
+        var params = {from: isoDate(today), to: isoDate(until)};
+        if (/^[a-zA-Z]{1,2}[0-9]/.test($("#postcode").val())) {
+            params.postcode = $("#postcode").val();
+        }
+        $.getJSON("/api/availability", params, function(data) {
+            fullDays = {};
+            $.each(data.days, function(i, day) {
+                if (!day.available) {
+                    fullDays[day.date] = true;
+                }
+            });
+            $("#install_date").datepicker("refresh");
+        });
+    }
+    $("#postcode").on("change", loadAvailability);
+
     // ----------------------------------------------------------------------------------------------------------Booking form date picker
     // Set up the install date with a datepicker widget using jQuery UI:  https://api.jqueryui.com/datepicker/
     $("#install_date" ).datepicker({
@@ -79,9 +134,10 @@ $(document).ready(function() {
         // Below solution for preventing Sundays taken from: https://stackoverflow.com/questions/31770976/disable-specific-days-in-jquery-ui-datepicker
         beforeShowDay: function(date) {
             var day = date.getDay();
-            return [(day != 0)];
+            return [(day != 0 && !fullDays[isoDate(date)])];
         }
     });
+    loadAvailability();
 
     // This prevents users typing or pasting values into the install date field meaning input is limited to datepicker ranges.
     // This solution was needed since readonly and required attributes can't both be set on one input fied.
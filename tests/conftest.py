@@ -0,0 +1,50 @@
+import os
+
+import pytest
+
+# The app reads its configuration when it is imported.  The tests never
+# reach a real database: every test gets a fresh mongomock database.
+os.environ.setdefault("MONGO_URI", "mongodb://localhost:27017/test")
+os.environ.setdefault("SECRET_KEY", "test")
+os.environ.setdefault("HASH_POOL_WORKERS", "0")
+os.environ.setdefault("PASSWORD_HASH_ITERATIONS", "1000")
+os.environ.setdefault("PURGE_WORKER_THREAD", "off")
+os.environ.setdefault("METER_FILTER", "off")
+os.environ.setdefault("PAGE_CACHE", "off")
+
+pytest.importorskip("mongomock")
+
+import app as wired  # noqa: E402
+
+
+@pytest.fixture
+def db():
+    wired.use_mongomock()
+    wired.create_indexes()
+    wired.user_cache.clear()
+    wired.capacity_cache.clear()
+    wired.page_cache.clear()
+    wired.meter_filter = None
+    wired.app.testing = True
+    return wired.mongo.db
+
+
+@pytest.fixture
+def client(db):
+    return wired.app.test_client()
+
+
+def sign_in_as(client, email):
+    with client.session_transaction() as sess:
+        sess["user_email_address"] = email
+    return client
+
+
+@pytest.fixture
+def user(client):
+    # A registered, signed in user.
+    client.post("/register", data={
+        "first-name": "test", "last-name": "user",
+        "email": "test@example.com", "password": "secret1",
+        "confirm-password": "secret1"})
+    return "test@example.com"
@@ -0,0 +1,21 @@
+import re
+
+import app as wired
+
+
+def heading(response):
+    return re.search(rb"Bookings \((.*?)\)", response.data).group(1)
+
+
+def test_booking_count_comes_from_the_page(client, user, monkeypatch):
+    monkeypatch.setitem(wired.app.config, "ACCOUNT_PAGE_SIZE", 2)
+    assert heading(client.get("/account/" + user)) == b"0"
+    for meter_id in range(1000000000001, 1000000000004):
+        client.post("/book", data=wired.sample_booking_form(str(meter_id)))
+        if meter_id == 1000000000002:
+            assert heading(client.get("/account/" + user)) == b"2"
+    response = client.get("/account/" + user)
+    assert heading(response) == b"2+"
+    after = re.search(rb"after=([^\"&]+)", response.data).group(1).decode()
+    assert heading(client.get(
+        "/account/{}?after={}".format(user, after))) == b"2+"
@@ -0,0 +1,53 @@
+from pymongo.errors import ExecutionTimeout, OperationFailure
+
+import app as wired
+
+
+def test_text_pages_follow_the_score():
+    _, _, sort = wired.SEARCH_TYPES["text"]
+    assert wired.keyset_filter(sort, [1.5, "id"]) == {"$or": [
+        {"score": {"$lt": 1.5}},
+        {"score": 1.5, "_id": {"$gt": "id"}}]}
+
+
+def test_postcode_search_pages(client, user, db):
+    for meter_id in range(1000000000001, 1000000000004):
+        client.post("/book", data=wired.sample_booking_form(str(meter_id)))
+    seen, after = [], None
+    while True:
+        bookings, after = wired.search_bookings(
+            "postcode", "ip", after=after, page_size=2)
+        seen += [booking["meter_id"] for booking in bookings]
+        if not after:
+            break
+    assert sorted(seen) == list(range(1000000000001, 1000000000004))
+
+
+def test_failed_search_is_reported(client, user, monkeypatch):
+    monkeypatch.setitem(wired.app.config, "ADMIN_EMAILS", {user})
+    for error, message in [
+            (ExecutionTimeout("operation exceeded time limit"),
+             b"took too long"),
+            (OperationFailure("Sort exceeded memory limit"),
+             b"couldn&#39;t be run")]:
+        def fail(*args, **kwargs):
+            raise error
+
+        monkeypatch.setattr(wired, "search_bookings", fail)
+        response = client.get("/admin/search?by=text&q=road")
+        assert response.status_code == 200
+        assert message in response.data
+
+
+def test_any_bookable_postcode_can_be_searched(client, user, db):
+    for meter_id, postcode in [(1000000000001, "123456"),
+                               (1000000000002, "1A1 1AA"),
+                               (1000000000003, "ls1 4ap")]:
+        client.post("/book", data=dict(
+            wired.sample_booking_form(str(meter_id)), postcode=postcode))
+    for text, meter_id in [("123", 1000000000001), ("1a1 1", 1000000000002),
+                           ("LS14", 1000000000003)]:
+        bookings, _ = wired.search_bookings("postcode", text)
+        assert [booking["meter_id"] for booking in bookings] == [meter_id]
+    assert wired.search_bookings("postcode", "1") is None
+    assert wired.search_bookings("postcode", "LS1-4") is None
@@ -0,0 +1,79 @@
+import app as wired
+from conftest import sign_in_as
+
+
+def book(client, meter_id, **fields):
+    client.post("/book", data=dict(
+        wired.sample_booking_form(str(meter_id)), **fields))
+    return wired.mongo.db.meter_installs.find_one({"meter_id": meter_id})
+
+
+def test_booking_is_sent_again_only_when_it_changes(client, user):
+    booking = book(client, 1000000000001)
+    url = "/api/v1/bookings/{}".format(booking["_id"])
+    response = client.get(url)
+    assert response.status_code == 200
+    assert response.get_json()["meter_id"] == 1000000000001
+    version = response.get_json()["version"]
+    etag = response.headers["ETag"]
+    response = client.get(url, headers={"If-None-Match": etag})
+    assert response.status_code == 304
+    assert response.headers["ETag"] == etag
+    client.post("/update_booking/{}".format(booking["_id"]), data=dict(
+        wired.sample_booking_form("1000000000001"), town="Colchester"))
+    response = client.get(url, headers={"If-None-Match": etag})
+    assert response.status_code == 200
+    assert response.headers["ETag"] != etag
+    assert response.get_json()["town"] == "Colchester"
+    assert response.get_json()["version"] == version + 1
+
+
+def test_etag_depends_on_the_fields(client, user):
+    booking = book(client, 1000000000001)
+    url = "/api/v1/bookings/{}".format(booking["_id"])
+    etag = client.get(url).headers["ETag"]
+    response = client.get(url + "?fields=meter_id,town",
+                          headers={"If-None-Match": etag})
+    assert response.status_code == 200
+    assert sorted(response.get_json()) == ["id", "meter_id", "town",
+                                           "version"]
+
+
+def test_other_users_bookings_are_not_found(client, user):
+    booking = book(client, 1000000000001)
+    other = sign_in_as(wired.app.test_client(), "other@example.com")
+    response = other.get("/api/v1/bookings/{}".format(booking["_id"]))
+    assert response.status_code == 404
+    response = wired.app.test_client().get(
+        "/api/v1/bookings/{}".format(booking["_id"]))
+    assert response.status_code == 401
+
+
+def test_bookings_are_paged(client, user):
+    for meter_id in range(1000000000001, 1000000000004):
+        book(client, meter_id)
+    page = client.get("/api/v1/bookings?limit=2&fields=meter_id").get_json()
+    assert len(page["bookings"]) == 2
+    assert page["prev"] is None
+    rest = client.get("/api/v1/bookings?limit=2&fields=meter_id&after=" +
+                      page["next"]).get_json()
+    assert len(rest["bookings"]) == 1
+    assert rest["next"] is None
+    assert sorted(booking["meter_id"] for booking in
+                  page["bookings"] + rest["bookings"]) == list(
+                      range(1000000000001, 1000000000004))
+
+
+def test_bad_requests_are_rejected(client, user):
+    booking = book(client, 1000000000001)
+    for url in ["/api/v1/bookings?limit=0",
+                "/api/v1/bookings?limit=101",
+                "/api/v1/bookings?limit=ten",
+                "/api/v1/bookings?after=not-a-cursor",
+                "/api/v1/bookings?fields=meter_id,password",
+                "/api/v1/bookings/{}?fields=user_email_address".format(
+                    booking["_id"])]:
+        response = client.get(url)
+        assert response.status_code == 400, url
+        assert "error" in response.get_json()
+    assert client.get("/api/v1/bookings?limit=100").status_code == 200
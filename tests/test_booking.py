@@ -0,0 +1,52 @@
+import threading
+
+import app as wired
+from conftest import sign_in_as
+
+
+def test_book_stores_converted_booking(client, user):
+    response = client.post("/book", data=wired.sample_booking_form(
+        "1000000000001"))
+    assert response.status_code == 302
+    booking = wired.mongo.db.meter_installs.find_one(
+        {"meter_id": 1000000000001})
+    assert booking["user_email_address"] == user
+    assert booking["install_date"].year == 2027
+    assert booking["supplier_authorisation"] is True
+
+
+def test_book_rejects_booked_meter_id(client, user):
+    form = wired.sample_booking_form("1000000000002")
+    client.post("/book", data=form)
+    response = client.post("/book", data=form)
+    assert response.status_code == 200
+    assert b"already been booked" in response.data
+    assert wired.mongo.db.meter_installs.count_documents(
+        {"meter_id": 1000000000002}) == 1
+
+
+def test_parallel_bookings_of_one_meter_id(db):
+    # Many parallel bookings of one meter ID: exactly one succeeds.
+    workers = 20
+    form = wired.sample_booking_form("9999999999999")
+    barrier = threading.Barrier(workers)
+    statuses = []
+
+    def attempt(worker):
+        client = sign_in_as(wired.app.test_client(),
+                            "race{}@example.com".format(worker))
+        barrier.wait()
+        statuses.append(client.post("/book", data=form).status_code)
+
+    threads = [threading.Thread(target=attempt, args=(worker,))
+               for worker in range(workers)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    # A successful booking redirects to the account page,
+    # a rejected one re-renders the booking form.
+    assert statuses.count(302) == 1
+    assert statuses.count(200) == workers - 1
+    assert db.meter_installs.count_documents(
+        {"meter_id": 9999999999999}) == 1
@@ -0,0 +1,60 @@
+from datetime import datetime
+
+import app as wired
+
+
+def book(client, meter_id, **fields):
+    client.post("/book", data=dict(
+        wired.sample_booking_form(str(meter_id)), **fields))
+    return wired.mongo.db.meter_installs.find_one({"meter_id": meter_id})
+
+
+def stats(db):
+    doc = db.booking_stats.find_one({"_id": wired.BOOKING_STATS_ID}) or {}
+    return {key: value for key, value in doc.items()
+            if key not in ["_id", "rebuilt"]}
+
+
+def test_stats_follow_bookings_and_rebuild(client, user, db):
+    first = book(client, 1000000000001)
+    book(client, 1000000000002)
+    book(client, 1000000000003, town="Leeds", county="West Yorkshire",
+         postcode="LS1 4AP", supplier="Other")
+    counts = stats(db)
+    assert counts["total"] == 3
+    assert counts["supplier"] == {"wired and wiser": 2, "other": 1}
+    assert counts["town"] == {"ipswich": 2, "leeds": 1}
+    assert counts["install_week"] == {"2027-W09": 3}
+    client.get("/delete_booking/{}".format(first["_id"]))
+    counts = stats(db)
+    assert counts["total"] == 2
+    assert counts["supplier"] == {"wired and wiser": 1, "other": 1}
+    # Rebuilt from scratch, the counts are the same.
+    db.booking_stats.delete_many({})
+    assert wired.rebuild_booking_stats(1) == 2
+    assert stats(db) == counts
+    assert db.booking_stats.count_documents({}) == 1
+
+
+def test_delete_during_a_rebuild(client, user, db):
+    first = book(client, 1000000000001)
+    book(client, 1000000000002)
+    # A rebuild that stopped after counting the first booking.
+    db.booking_stats.update_one(
+        {"_id": wired.BOOKING_STATS_REBUILD_ID},
+        {"$set": {"after": first["_id"], "started": datetime.utcnow()},
+         "$inc": wired.booking_stats_delta(added=[first])}, upsert=True)
+    client.get("/delete_booking/{}".format(first["_id"]))
+    assert wired.rebuild_booking_stats(10) == 1
+    counts = stats(db)
+    assert counts["total"] == 1
+    assert counts["supplier"] == {"wired and wiser": 1}
+
+
+def test_admins_see_the_dashboard(client, user, db, monkeypatch):
+    book(client, 1000000000001)
+    assert client.get("/admin/stats").status_code == 404
+    monkeypatch.setitem(wired.app.config, "ADMIN_EMAILS", {user})
+    response = client.get("/admin/stats")
+    assert response.status_code == 200
+    assert b"ipswich" in response.data.lower()
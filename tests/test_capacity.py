@@ -0,0 +1,80 @@
+import pytest
+from pymongo.errors import AutoReconnect
+
+import app as wired
+
+
+@pytest.fixture
+def small_capacity():
+    config = wired.app.config
+    saved = config["CAPACITY_PER_DAY"], config["CAPACITY_PER_AREA"]
+    config["CAPACITY_PER_DAY"], config["CAPACITY_PER_AREA"] = 3, 2
+    yield
+    config["CAPACITY_PER_DAY"], config["CAPACITY_PER_AREA"] = saved
+
+
+def counts(db):
+    return {slot["_id"]: slot["count"] for slot in db.install_capacity.find()}
+
+
+def book(client, meter_id, **fields):
+    return client.post("/book", data=dict(
+        wired.sample_booking_form(str(meter_id)), **fields))
+
+
+@pytest.mark.parametrize("postcode", ["123456", "1A1 1AA"])
+def test_digit_leading_postcode(client, user, db, postcode):
+    # validate_postcode accepts these, so they must be bookable.
+    response = book(client, 1000000000001, postcode=postcode)
+    assert response.status_code == 302
+    assert counts(db) == {"2027-03-01": 1, "2027-03-01:OTHER": 1}
+    booking = db.meter_installs.find_one()
+    client.get("/delete_booking/{}".format(booking["_id"]))
+    assert counts(db) == {"2027-03-01": 0, "2027-03-01:OTHER": 0}
+    assert wired.rebuild_capacity() == 0
+
+
+def test_full_area_and_day_are_rejected(client, user, db, small_capacity):
+    assert book(client, 1000000000001).status_code == 302
+    assert book(client, 1000000000002).status_code == 302
+    response = book(client, 1000000000003)
+    assert b"no installations left" in response.data
+    assert book(client, 1000000000004, postcode="CO4 3ZZ").status_code == 302
+    response = book(client, 1000000000005, postcode="LS1 4AP")
+    assert b"no installations left" in response.data
+    assert counts(db) == {"2027-03-01": 3, "2027-03-01:IP": 2,
+                          "2027-03-01:CO": 1}
+
+
+def test_failed_insert_gives_places_back(client, user, db, monkeypatch):
+    def fail(*args, **kwargs):
+        raise AutoReconnect("connection lost")
+
+    monkeypatch.setattr(
+        type(db.meter_installs), "insert_one", fail)
+    with pytest.raises(AutoReconnect):
+        book(client, 1000000000001)
+    assert counts(db) == {"2027-03-01": 0, "2027-03-01:IP": 0}
+
+
+def test_bulk_booking_reserves_a_chunk_together(db, small_capacity):
+    rows = [(n, dict(wired.sample_booking_form(str(1000000000000 + n)),
+                     postcode=postcode))
+            for n, postcode in enumerate(
+                ["IP1 1AA", "IP1 1AB", "IP1 1AC", "CO1 1AA", "CO1 1AB"])]
+    report = wired.book_chunk(rows, "bulk@example.com")
+    assert [status for _, _, status, _ in report] == [
+        "booked", "booked", "error", "booked", "error"]
+    assert counts(db) == {"2027-03-01": 3, "2027-03-01:IP": 2,
+                          "2027-03-01:CO": 1}
+    assert db.meter_installs.count_documents({}) == 3
+
+
+def test_bulk_booking_into_a_part_full_slot(client, user, db,
+                                            small_capacity):
+    assert book(client, 1000000000001).status_code == 302
+    rows = [(n, wired.sample_booking_form(str(1000000000010 + n)))
+            for n in range(2)]
+    report = wired.book_chunk(rows, "bulk@example.com")
+    assert [status for _, _, status, _ in report] == ["booked", "error"]
+    assert counts(db) == {"2027-03-01": 2, "2027-03-01:IP": 2}
@@ -0,0 +1,65 @@
+import csv
+import gzip
+import io
+import json
+
+import pytest
+
+import app as wired
+
+
+@pytest.fixture
+def bookings(client, user, monkeypatch):
+    monkeypatch.setitem(wired.app.config, "ADMIN_EMAILS", {user})
+    # Small batches, so the export is streamed in several chunks.
+    monkeypatch.setitem(wired.app.config, "EXPORT_BATCH_SIZE", 2)
+    for meter_id in range(1000000000001, 1000000000006):
+        client.post("/book", data=wired.sample_booking_form(str(meter_id)))
+    client.post("/book", data=dict(
+        wired.sample_booking_form("1000000000006"), supplier="Other"))
+
+
+def export(client, export_format, **headers):
+    return client.get("/export/bookings.{}?supplier=Wired+and+Wiser".format(
+        export_format), headers=headers)
+
+
+def test_csv_export(client, bookings):
+    response = export(client, "csv")
+    assert response.status_code == 200
+    assert response.mimetype == "text/csv"
+    rows = list(csv.reader(io.StringIO(response.get_data(as_text=True))))
+    assert rows[0] == ["id"] + wired.EXPORT_FIELDS
+    assert len(rows) == 6
+    assert [row[1] for row in rows[1:]] == [
+        str(meter_id) for meter_id in range(1000000000001, 1000000000006)]
+    assert rows[1][wired.EXPORT_FIELDS.index("install_date") + 1] == (
+        "2027-03-01")
+
+
+def test_ndjson_export(client, bookings):
+    response = export(client, "ndjson")
+    assert response.status_code == 200
+    assert response.mimetype == "application/x-ndjson"
+    lines = [json.loads(line) for line in
+             response.get_data(as_text=True).splitlines()]
+    assert len(lines) == 5
+    assert sorted(lines[0]) == sorted(["id"] + wired.EXPORT_FIELDS)
+    # An export that was cut short carries on after the last ID.
+    response = client.get(
+        "/export/bookings.ndjson?supplier=Wired+and+Wiser&after=" +
+        lines[2]["id"])
+    assert [json.loads(line)["id"] for line in
+            response.get_data(as_text=True).splitlines()] == [
+                line["id"] for line in lines[3:]]
+
+
+def test_gzipped_export(client, bookings):
+    plain = export(client, "csv").get_data()
+    response = export(client, "csv", **{"Accept-Encoding": "gzip"})
+    assert response.content_encoding == "gzip"
+    assert gzip.decompress(response.get_data()) == plain
+
+
+def test_export_is_for_admins(client, user):
+    assert export(client, "csv").status_code == 404
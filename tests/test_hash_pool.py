@@ -0,0 +1,33 @@
+import os
+
+import pytest
+
+import app as wired
+
+
+@pytest.fixture
+def pool(monkeypatch):
+    monkeypatch.setitem(wired.app.config, "HASH_POOL_WORKERS", 1)
+    yield
+    if wired.hash_pool:
+        wired.hash_pool.shutdown()
+    wired.hash_pool = None
+
+
+def test_failed_call_leaves_the_queue_empty(pool):
+    with pytest.raises(ValueError):
+        wired.run_in_hash_pool(int, "not a number")
+    assert wired.hash_pool_report()["queued"] == 0
+    # The queue slot was given back too.
+    assert wired.run_in_hash_pool(int, "12") == 12
+
+
+def test_broken_pool_is_replaced(pool):
+    restarts = wired.hash_pool_report()["restarts"]
+    broken = wired.hash_pool = wired.ProcessPoolExecutor(max_workers=1)
+    with pytest.raises(wired.BrokenProcessPool):
+        broken.submit(os._exit, 1).result()
+    assert wired.run_in_hash_pool(pow, 2, 3) == 8
+    assert wired.hash_pool is not broken
+    assert wired.hash_pool_report()["restarts"] == restarts + 1
+    assert wired.hash_pool_report()["queued"] == 0
@@ -0,0 +1,21 @@
+import app as wired
+
+
+def test_create_indexes_reports_duplicates(db):
+    db.users.drop_indexes()
+    for name in ["first", "second"]:
+        db.users.insert_one({"user_email_address": "twice@example.com",
+                             "first_name": name})
+    result = wired.app.test_cli_runner().invoke(args=["create-indexes"])
+    assert result.exit_code != 0
+    assert "2 documents in users share" in result.output
+    assert "twice@example.com" in result.output
+
+
+def test_first_request_doesnt_build_indexes(client, db, monkeypatch):
+    def fail():
+        raise AssertionError("indexes built on a request")
+
+    monkeypatch.setattr(wired, "create_indexes", fail)
+    monkeypatch.setattr(wired.app, "_got_first_request", False)
+    assert client.get("/").status_code == 200
@@ -0,0 +1,47 @@
+import click
+import pytest
+
+import app as wired
+from conftest import sign_in_as
+
+
+def test_benchmarks_refuse_the_app_database(db):
+    with pytest.raises(click.ClickException):
+        wired.use_benchmark_database(db.name)
+
+
+def test_delete_booking_only_deletes_own_booking(client, db):
+    sign_in_as(client, "owner@example.com")
+    client.post("/book", data=wired.sample_booking_form("1000000000001"))
+    booking = db.meter_installs.find_one()
+    other = sign_in_as(wired.app.test_client(), "other@example.com")
+    other.get("/delete_booking/{}".format(booking["_id"]))
+    assert db.meter_installs.count_documents({}) == 1
+    client.get("/delete_booking/{}".format(booking["_id"]))
+    assert db.meter_installs.count_documents({}) == 0
+
+
+def test_flow_leaves_other_bookings_alone(client, db):
+    # A real booking on the meter ID the flow tries to book.
+    sign_in_as(client, "customer@example.com")
+    client.post("/book", data=wired.sample_booking_form(
+        str(wired.LOAD_TEST_METER_IDS)))
+    client.get("/signout")
+    email = wired.seed_load_test_data(1, 1)[0]
+    wired.load_test_flow(client, email, wired.LOAD_TEST_METER_IDS, {})
+    assert db.meter_installs.find_one(
+        {"meter_id": wired.LOAD_TEST_METER_IDS}
+    )["user_email_address"] == "customer@example.com"
+    # Only the exact seeded addresses are cleared.
+    db.users.insert_one({"user_email_address": "loadtester@example.com"})
+    wired.clear_load_test_data([email])
+    assert db.users.count_documents({}) == 1
+    assert db.meter_installs.count_documents({}) == 1
+
+
+def test_loadtest_runs_in_memory(db):
+    result = wired.app.test_cli_runner().invoke(args=[
+        "loadtest", "--users", "2", "--bookings", "2",
+        "--concurrency", "2", "--flows", "2"])
+    assert result.exit_code == 0, result.output
+    assert "book" in result.output
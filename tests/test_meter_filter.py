@@ -0,0 +1,93 @@
+import pytest
+
+import app as wired
+
+
+def book(client, meter_id):
+    return client.post("/book", data=wired.sample_booking_form(str(meter_id)))
+
+
+@pytest.fixture
+def processes(db):
+    # Two web processes sharing one database.  Each has its own filter;
+    # run_in(name) swaps that process' filter in.
+    filters = {}
+    for name in ["first", "second"]:
+        wired.rebuild_meter_filter()
+        filters[name] = (wired.meter_filter, wired.meter_filter_synced_since,
+                         dict(wired.meter_filter_synced))
+    state = {"current": None}
+
+    def run_in(name):
+        if state["current"]:
+            filters[state["current"]] = (
+                wired.meter_filter, wired.meter_filter_synced_since,
+                dict(wired.meter_filter_synced))
+        bloom, since, synced = filters[name]
+        wired.meter_filter, wired.meter_filter_synced_since = bloom, since
+        wired.meter_filter_synced.clear()
+        wired.meter_filter_synced.update(synced)
+        state["current"] = name
+
+    yield run_in
+    wired.meter_filter = None
+    wired.meter_filter_synced_since = None
+    wired.meter_filter_synced.clear()
+
+
+def test_sync_picks_up_other_process_bookings(client, user, db, processes):
+    processes("second")
+    book(client, 1000000000001)
+    assert not wired.meter_id_available(1000000000001)
+    processes("first")
+    # Until it syncs the first process only has a hint.
+    assert wired.meter_id_available(1000000000001)
+    wired.sync_meter_filter()
+    assert not wired.meter_id_available(1000000000001)
+    # Syncing again doesn't count the booking twice.
+    wired.sync_meter_filter()
+    booking = db.meter_installs.find_one()
+    client.get("/delete_booking/{}".format(booking["_id"]))
+    assert wired.meter_id_available(1000000000001)
+
+
+def test_sync_picks_up_other_process_moves(client, user, db, processes):
+    processes("first")
+    book(client, 1000000000001)
+    booking = db.meter_installs.find_one()
+    processes("second")
+    form = wired.sample_booking_form("1000000000002")
+    client.post("/update_booking/{}".format(booking["_id"]), data=form)
+    assert db.meter_installs.find_one()["meter_id"] == 1000000000002
+    processes("first")
+    assert wired.meter_id_available(1000000000002)
+    wired.sync_meter_filter()
+    assert not wired.meter_id_available(1000000000002)
+
+
+def test_releasing_an_id_never_added_keeps_others():
+    bloom = wired.CountingBloomFilter(10, 0.1)
+    bloom.add(1000000000001)
+    bloom.add(1000000000002)
+    # An ID sharing one of B's counters, as a booking made by another
+    # process (and not yet synced) might.
+    shared = next(meter_id for meter_id in range(1000000000003, 1000010000000)
+                  if set(bloom.positions(meter_id))
+                  & set(bloom.positions(1000000000002))
+                  and meter_id not in bloom)
+    bloom.remove(shared)
+    assert 1000000000001 in bloom
+    assert 1000000000002 in bloom
+    # Adding twice counts once.
+    bloom.add(1000000000001)
+    bloom.remove(1000000000001)
+    assert 1000000000001 not in bloom
+
+
+def test_release_during_rebuild_is_dropped(db, monkeypatch):
+    building = wired.CountingBloomFilter(10, 0.1)
+    building.add(1000000000001)
+    monkeypatch.setattr(wired, "meter_filter", None)
+    monkeypatch.setattr(wired, "meter_filter_building", building)
+    wired.note_meter_released(1000000000001)
+    assert 1000000000001 in building
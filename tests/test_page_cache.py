@@ -0,0 +1,39 @@
+import pytest
+
+import app as wired
+
+
+@pytest.fixture
+def page_cache(monkeypatch):
+    monkeypatch.setitem(wired.app.config, "PAGE_CACHE", True)
+
+
+def flash(client, message):
+    with client.session_transaction() as sess:
+        sess["_flashes"] = [("message", message)]
+
+
+def flashes(client):
+    with client.session_transaction() as sess:
+        return sess.get("_flashes")
+
+
+def test_page_without_placeholder_keeps_flashes(client, page_cache):
+    flash(client, "Booking deleted")
+    response = client.get("/")
+    assert b"Booking deleted" not in response.data
+    assert response.headers["Cache-Control"] != "no-store"
+    assert flashes(client) == [("message", "Booking deleted")]
+    response = client.get("/no-such-page")
+    assert b"Booking deleted" in response.data
+    assert response.headers["Cache-Control"] == "no-store"
+    assert not flashes(client)
+
+
+def test_admins_get_the_admin_links(client, user, page_cache, monkeypatch):
+    assert b"Stats" not in client.get("/").data
+    monkeypatch.setitem(wired.app.config, "ADMIN_EMAILS", {user})
+    for path in ["/", "/no-such-page"]:
+        data = client.get(path).data
+        assert b"Stats" in data
+        assert b"cached-page-user" not in data
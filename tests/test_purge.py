@@ -0,0 +1,91 @@
+import pytest
+
+import app as wired
+from conftest import sign_in_as
+
+
+@pytest.fixture(autouse=True)
+def no_pause(monkeypatch):
+    monkeypatch.setitem(wired.app.config, "PURGE_BATCH_PAUSE", 0)
+    monkeypatch.setitem(wired.app.config, "PURGE_BATCH_SIZE", 2)
+
+
+def book(client, meter_id):
+    return client.post("/book", data=wired.sample_booking_form(str(meter_id)))
+
+
+def counts(db):
+    return {slot["_id"]: slot["count"] for slot in db.install_capacity.find()}
+
+
+def total(db):
+    return db.booking_stats.find_one({"_id": wired.BOOKING_STATS_ID})["total"]
+
+
+def delete_account(client, email):
+    return client.post("/delete_account/" + email,
+                       data={"password": "secret1"})
+
+
+def test_purge_releases_everything(client, user, db):
+    for meter_id in range(1000000000001, 1000000000006):
+        book(client, meter_id)
+    assert delete_account(client, user).status_code == 302
+    assert db.purge_jobs.count_documents({"status": "pending"}) == 1
+    wired.run_purge_jobs()
+    assert db.meter_installs.count_documents({}) == 0
+    assert db.users.count_documents({}) == 0
+    assert counts(db) == {"2027-03-01": 0, "2027-03-01:IP": 0}
+    assert total(db) == 0
+
+
+def test_deleted_account_without_a_job_is_swept(client, user, db):
+    # As if the process died between marking the account deleted and
+    # queueing its job.
+    book(client, 1000000000001)
+    db.users.update_one({"user_email_address": user},
+                        {"$set": {"deleted": True}})
+    wired.run_purge_jobs()
+    assert db.meter_installs.count_documents({}) == 0
+    assert db.users.count_documents({}) == 0
+    assert db.purge_jobs.find_one()["status"] == "done"
+
+
+def test_retry_leaves_a_new_account_alone(client, user, db):
+    book(client, 1000000000001)
+    delete_account(client, user)
+    job = db.purge_jobs.find_one()
+    wired.run_purge_jobs()
+    # The same email address is registered again and books, then the
+    # finished job is run a second time.
+    client.post("/register", data={
+        "first-name": "test", "last-name": "user",
+        "email": user, "password": "secret1",
+        "confirm-password": "secret1"})
+    sign_in_as(client, user)
+    book(client, 1000000000002)
+    wired.run_purge_job(job)
+    assert db.meter_installs.count_documents({"meter_id": 1000000000002}) == 1
+    assert db.users.count_documents({"user_email_address": user}) == 1
+
+
+def test_cut_short_batch_is_released_on_resume(client, user, db, monkeypatch):
+    for meter_id in range(1000000000001, 1000000000004):
+        book(client, meter_id)
+    delete_account(client, user)
+    release_slots = wired.release_slots
+
+    def crash(slots):
+        raise SystemExit("worker killed")
+
+    monkeypatch.setattr(wired, "release_slots", crash)
+    with pytest.raises(SystemExit):
+        wired.run_purge_jobs()
+    job = db.purge_jobs.find_one()
+    assert len(job["batch"]) == 2
+    assert db.meter_installs.count_documents({}) == 1
+    monkeypatch.setattr(wired, "release_slots", release_slots)
+    wired.run_purge_job(job)
+    assert db.meter_installs.count_documents({}) == 0
+    assert counts(db) == {"2027-03-01": 0, "2027-03-01:IP": 0}
+    assert total(db) == 0
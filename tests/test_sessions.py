@@ -0,0 +1,77 @@
+from datetime import datetime, timedelta
+
+import pytest
+
+import app as wired
+
+
+@pytest.fixture(params=sorted(wired.SESSION_STORES))
+def store(request, db, monkeypatch):
+    # Run the test with each server-side session store.
+    interface = wired.ServerSideSessionInterface(
+        wired.SESSION_STORES[request.param]())
+    monkeypatch.setattr(wired.app, "session_interface", interface)
+    return interface.store
+
+
+def signed_in_client():
+    client = wired.app.test_client()
+    client.post("/signin", data={"email": "test@example.com",
+                                 "password": "secret1"})
+    return client
+
+
+def session_id(client):
+    return next(cookie.value for cookie in client.cookie_jar
+                if cookie.name == wired.app.session_cookie_name)
+
+
+def signed_in(client):
+    response = client.get("/account/test@example.com")
+    return response.status_code == 200
+
+
+def later(monkeypatch, seconds):
+    # Move the apps clock on.
+    now = datetime.utcnow() + timedelta(seconds=seconds)
+
+    class Later(datetime):
+        @classmethod
+        def utcnow(cls):
+            return now
+
+    monkeypatch.setattr(wired, "datetime", Later)
+
+
+def test_deleting_an_account_signs_out_every_session(store, user):
+    first, second = signed_in_client(), signed_in_client()
+    assert signed_in(first) and signed_in(second)
+    old_sid = session_id(first)
+    first.post("/delete_account/test@example.com",
+               data={"password": "secret1"})
+    assert not signed_in(second)
+    # The session carrying the flash message has a new ID.
+    assert session_id(first) != old_sid
+    assert store.load(old_sid) is None
+    assert b"have been deleted" in first.get("/register").data
+
+
+def test_revoking_from_another_client(store, user):
+    first, second = signed_in_client(), signed_in_client()
+    with wired.app.test_request_context():
+        wired.revoke_user_sessions("test@example.com")
+    assert not signed_in(first)
+    assert not signed_in(second)
+
+
+def test_idle_sessions_expire(store, user, monkeypatch):
+    client = signed_in_client()
+    idle = wired.app.config["SESSION_IDLE_SECONDS"]
+    # Used after most of its idle time, the session is kept
+    # (and its expiry pushed back).
+    later(monkeypatch, idle * 0.9)
+    assert signed_in(client)
+    later(monkeypatch, idle * 1.5)
+    assert signed_in(client)
+    later(monkeypatch, idle * 2.5)
+    assert not signed_in(client)
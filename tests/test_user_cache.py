@@ -0,0 +1,24 @@
+import app as wired
+
+
+def test_invalidation_during_a_read_isnt_undone(client, user, db,
+                                                monkeypatch):
+    find_one = type(db.users).find_one
+
+    def racing_find_one(self, *args, **kwargs):
+        # Read the old profile, then the user is updated (and
+        # invalidated) before the read is cached.
+        old = find_one(self, *args, **kwargs)
+        self.update_one({"user_email_address": user},
+                        {"$set": {"first_name": "changed"}})
+        wired.invalidate_user(user)
+        return old
+
+    wired.user_cache.clear()
+    monkeypatch.setattr(type(db.users), "find_one", racing_find_one)
+    assert wired.get_user_profile(user)["first_name"] == "test"
+    assert user not in wired.user_cache
+    assert not wired.user_cache_fills
+    monkeypatch.setattr(type(db.users), "find_one", find_one)
+    assert wired.get_user_profile(user)["first_name"] == "changed"
+    assert user in wired.user_cache
@@ -0,0 +1,36 @@
+from werkzeug.datastructures import ImmutableMultiDict
+
+import app as wired
+
+
+def test_valid_form_is_converted():
+    booking, errors = wired.validate_form(
+        wired.BOOKING_SCHEMA, wired.sample_booking_form("1234567890123"))
+    assert errors == []
+    assert booking["meter_id"] == 1234567890123
+    assert booking["meter_read_reg_1"] == 12345
+    assert booking["meter_read_reg_2"] is None
+    assert booking["supplier_authorisation"] is True
+
+
+def test_every_error_is_reported_once():
+    form = dict(wired.sample_booking_form("12"), first_address_line="!",
+                second_address_line="?", install_date="31/02/2027")
+    _, errors = wired.validate_form(wired.BOOKING_SCHEMA, form)
+    assert errors == ["Invalid meter ID provided",
+                      "Invalid address provided",
+                      "Invalid installation date provided"]
+
+
+def test_schema_matches_legacy_validation():
+    # BOOKING_SCHEMA accepts and converts the same forms
+    # as the field by field validation it replaced.
+    good = wired.sample_booking_form("1234567890123")
+    for form in [good, dict(good, meter_id="123"), dict(good, town="")]:
+        form = ImmutableMultiDict(form)
+        legacy = wired.legacy_validate_booking(form)
+        booking, errors = wired.validate_form(wired.BOOKING_SCHEMA, form)
+        assert (legacy is None) == bool(errors)
+        if legacy:
+            for field, value in legacy.items():
+                assert booking[field] == value